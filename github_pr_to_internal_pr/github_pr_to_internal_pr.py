@@ -3,14 +3,65 @@
 # SPDX-FileCopyrightText: 2021 Espressif Systems (Shanghai) CO LTD
 # SPDX-License-Identifier: Apache-2.0
 
+import contextlib
 import json
 import os
 import shutil
+import tempfile
 import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import gitlab
-import requests
-from git import Git, Repo
+import reference_repo
+from git import Git, GitCommandError, Repo
+from http_session import get_session, new_session
+
+GITHUB_REMOTE = 'origin'
+GITLAB_REMOTE = 'gitlab'
+LABEL_MERGE = 'PR-Sync-Merge'
+LABEL_REBASE = 'PR-Sync-Rebase'
+LABEL_UPDATE = 'PR-Sync-Update'
+# Shallow fetch mode: fetch only the last GIT_FETCH_DEPTH commits of the internal base branch and of the PR
+# (or the commits since GIT_SHALLOW_SINCE, for example '2 weeks ago'), without their file contents.
+# Git fetches the file contents it needs later, when checking out or rebasing. 0 fetches the full history.
+GIT_FETCH_DEPTH = int(os.environ.get('GIT_FETCH_DEPTH', 0))
+GIT_SHALLOW_SINCE = os.environ.get('GIT_SHALLOW_SINCE')
+# Errors of a fetch with --shallow-since which are retried with --depth: no commits since the date, or a server without support for it
+SHALLOW_SINCE_REJECTED = ('no commits selected for shallow requests', 'does not support --shallow-since')
+# Path of a bare repository with the objects of both remotes, kept between runs (see reference_repo.py)
+GIT_REFERENCE_REPO = os.environ.get('GIT_REFERENCE_REPO')
+# Number of items in each page of GitHub API lists (the maximum GitHub allows)
+GITHUB_PER_PAGE = 100
+# Number of PRs rebased and pushed at the same time (each in its own process and worktree) by a batch run
+PR_SYNC_JOBS = int(os.environ.get('PR_SYNC_JOBS', 4))
+
+
+def get_pages(url, headers, reverse=False):
+    """
+    Yield the items of a GitHub API list, fetching each page (by following the Link headers) only when the previous one is used up.
+
+    With reverse=True the items are yielded last to first, starting from the last page.
+    """
+    session = get_session()
+    r = session.get(url, headers=headers, params={'per_page': GITHUB_PER_PAGE})
+    r.raise_for_status()
+    first_page = r.json()
+    if not reverse:
+        yield from first_page
+        while 'next' in r.links:
+            r = session.get(r.links['next']['url'], headers=headers)
+            r.raise_for_status()
+            yield from r.json()
+        return
+
+    page_url = r.links.get('last', {}).get('url')
+    while page_url and urllib.parse.parse_qs(urllib.parse.urlsplit(page_url).query).get('page') != ['1']:
+        r = session.get(page_url, headers=headers)
+        r.raise_for_status()
+        yield from reversed(r.json())
+        page_url = r.links.get('prev', {}).get('url')
+    yield from reversed(first_page)
 
 
 def pr_check_approver(pr_creator, pr_comments_url, pr_approve_labeller):
@@ -18,10 +69,8 @@ def pr_check_approver(pr_creator, pr_comments_url, pr_approve_labeller):
     # Requires Github Access Token, with Push Access
     GITHUB_TOKEN = os.environ['GITHUB_TOKEN']
 
-    r = requests.get(pr_comments_url, headers={'Authorization': 'token ' + GITHUB_TOKEN})
-    r_data = r.json()
-
-    for comment in reversed(r_data):
+    # The latest command comment counts, so start from the last comment
+    for comment in get_pages(pr_comments_url, {'Authorization': 'token ' + GITHUB_TOKEN}, reverse=True):
         comment_body = comment['body']
         if comment_body.startswith('sha=') and comment['user']['login'] == pr_approve_labeller != pr_creator:
                 return comment_body[4:]
@@ -34,178 +83,284 @@ def pr_check_forbidden_files(pr_files_url):
     # Requires Github Access Token, with Push Access
     GITHUB_TOKEN = os.environ['GITHUB_TOKEN']
 
-    r = requests.get(pr_files_url, headers={'Authorization': 'token ' + GITHUB_TOKEN})
-    r_data = r.json()
+    for file_info in get_pages(pr_files_url, {'Authorization': 'token ' + GITHUB_TOKEN}):
+        if (file_info['filename']).find('.gitlab') != -1 or (file_info['filename']).find('.github') != -1:
+            raise RuntimeError('PR modifying forbidden files!!!')
 
-    pr_files = [file_info['filename'] for file_info in r_data
-                if (file_info['filename']).find('.gitlab') != -1 or (file_info['filename']).find('.github') != -1]
-    if pr_files:
-        raise RuntimeError('PR modifying forbidden files!!!')
+
+def pr_run_checks(pr_creator, pr_comments_url, pr_approve_labeller, pr_files_url):
+    """
+    Run the approver and forbidden files checks at the same time, and return the approved commit ID
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        approver = executor.submit(pr_check_approver, pr_creator, pr_comments_url, pr_approve_labeller)
+        forbidden_files = executor.submit(pr_check_forbidden_files, pr_files_url)
+        pr_commit_id = approver.result()
+        forbidden_files.result()
+    return pr_commit_id
 
 
 def setup_project(project_html_url, repo_fullname, pr_base_branch):
+    gl = connect_gitlab()
+    fetch_internal_base(gitlab_project_url(repo_fullname), pr_base_branch)
+
+    return gl
+
+
+def connect_gitlab():
     print('Connecting to GitLab...')
     GITLAB_URL = os.environ['GITLAB_URL']
     GITLAB_TOKEN = os.environ['GITLAB_TOKEN']
 
-    gl = gitlab.Gitlab(url=GITLAB_URL, private_token=GITLAB_TOKEN)
+    gl = gitlab.Gitlab(url=GITLAB_URL, private_token=GITLAB_TOKEN, session=new_session())
     gl.auth()
+    return gl
+
+
+def gitlab_project_url(repo_fullname):
+    GITLAB_URL = os.environ['GITLAB_URL']
+    GITLAB_TOKEN = os.environ['GITLAB_TOKEN']
 
     HDR_LEN = 8
-    gl_project_url = GITLAB_URL[:HDR_LEN] + GITLAB_TOKEN + ':' + GITLAB_TOKEN + '@' + GITLAB_URL[HDR_LEN:] + '/' + repo_fullname + '.git'
+    return GITLAB_URL[:HDR_LEN] + GITLAB_TOKEN + ':' + GITLAB_TOKEN + '@' + GITLAB_URL[HDR_LEN:] + '/' + repo_fullname + '.git'
 
+
+def fetch_internal_base(gl_project_url, pr_base_branch):
     git = Git('.')
-    GITLAB_REMOTE = 'gitlab'
+    add_internal_remote(git, gl_project_url)
+    if not shallow_fetch():
+        git.pull(GITLAB_REMOTE, pr_base_branch)
+        return
+
+    update_base_branch(git, pr_base_branch)
+
+
+def add_internal_remote(git, gl_project_url):
+    if GIT_REFERENCE_REPO:
+        reference_repo.use_reference(git, GIT_REFERENCE_REPO)
 
     print('Adding and fetching the internal remote...')
     git.remote('add', GITLAB_REMOTE, gl_project_url)
-    git.pull(GITLAB_REMOTE, pr_base_branch)
 
-    return gl
 
+def update_base_branch(git, pr_base_branch):
+    """
+    Point the local base branch at the internal one, without checking it out (which would fetch all its files)
+    """
+    fetch_ref(git, GITLAB_REMOTE, pr_base_branch)
+    git.checkout('--detach')
+    git.branch('--force', pr_base_branch, 'FETCH_HEAD')
 
-def check_update_label(pr_labels_list):
-    LABEL_MERGE = 'PR-Sync-Merge'
-    LABEL_REBASE = 'PR-Sync-Rebase'
 
+def shallow_fetch():
+    return GIT_FETCH_DEPTH > 0 or bool(GIT_SHALLOW_SINCE)
+
+
+def fetch_ref(git, remote, *refs):
+    """
+    Fetch refs (into FETCH_HEAD, or as given by refspecs), with only the recent history in the shallow fetch mode
+    """
+    if not shallow_fetch():
+        git.fetch(remote, *refs)
+        return
+
+    if GIT_SHALLOW_SINCE:
+        try:
+            git.fetch('--filter=blob:none', '--shallow-since=' + GIT_SHALLOW_SINCE, remote, *refs)
+            return
+        except GitCommandError as e:
+            if not any(message in e.stderr for message in SHALLOW_SINCE_REJECTED):
+                raise
+            print(f'Server rejected --shallow-since={GIT_SHALLOW_SINCE}, fetching the last commits instead...')
+    git.fetch('--filter=blob:none', '--depth=' + str(max(GIT_FETCH_DEPTH, 1)), remote, *refs)
+
+
+def deepen_to_merge_base(git, pr_base_branch, pr_num, pr_ref='HEAD'):
+    """
+    In the shallow fetch mode, fetch more of the history of the base branch and of the PR (at 'pr_ref') until they have a commit in common.
+
+    The rebase needs this merge base, and the internal remote refuses a push of commits whose parents it doesn't have.
+    Each time, twice as many commits are fetched as the time before.
+    """
+    if not shallow_fetch():
+        return
+
+    deepen = max(GIT_FETCH_DEPTH, 1)
+    commits = None
+    while True:
+        try:
+            return git.merge_base(pr_base_branch, pr_ref)
+        except GitCommandError:
+            pass
+
+        fetched = git.rev_list('--count', pr_base_branch, pr_ref)
+        if fetched == commits:
+            raise RuntimeError('PR branch has no commits in common with the base branch!')
+        commits = fetched
+
+        print(f'Fetching {deepen} more commits to find the merge base...')
+        git.fetch('--filter=blob:none', '--deepen=' + str(deepen), GITLAB_REMOTE, pr_base_branch)
+        git.fetch('--filter=blob:none', '--deepen=' + str(deepen), GITHUB_REMOTE, 'pull/' + str(pr_num) + '/head')
+        deepen *= 2
+
+
+def maintain_reference_repo(project_html_url, repo_fullname):
+    if not GIT_REFERENCE_REPO:
+        raise RuntimeError('Scheduled run: GIT_REFERENCE_REPO is not set, there is no reference repository to maintain!')
+
+    reference_repo.refresh(GIT_REFERENCE_REPO, {GITHUB_REMOTE: project_html_url, GITLAB_REMOTE: gitlab_project_url(repo_fullname)})
+    reference_repo.repack(GIT_REFERENCE_REPO)
+
+
+def check_update_label(pr_labels_list):
     label_validity = [label['name'] for label in pr_labels_list if label['name'] == LABEL_MERGE or label['name'] == LABEL_REBASE]
 
     if not label_validity:
         raise RuntimeError('PR-Sync-Update Label: Illegal use!')
 
 
-# Update existing MR
-def update_mr(pr_num, pr_head_branch, pr_commit_id, project_gl):
+def check_internal_branch(project_gl, pr_head_branch, update):
+    """
+    Check that the internal branch for the PR exists if it is updated, or doesn't exist yet otherwise
+    """
     try:
         project_gl.branches.get(pr_head_branch)
     except:
-        raise RuntimeError('PR Update: No branch found on internal remote to update!')
+        if update:
+            raise RuntimeError('PR Update: No branch found on internal remote to update!')
+    else:
+        if not update:
+            raise RuntimeError('PR Merge/Rebase: Branch/MR already exists for PR!')
 
-    GITHUB_REMOTE = 'origin'
-    GITLAB_REMOTE = 'gitlab'
-    git = Git('.')
 
-    print('Updating the PR branch...')
-    git.fetch(GITHUB_REMOTE, 'pull/' + str(pr_num) + '/head')
-    git.checkout('FETCH_HEAD', b=pr_head_branch)
+def is_synced(project_gl, pr, pr_label):
+    """
+    Return True if a PR labelled to be merged or rebased was synced before, i.e. its internal branch exists
+    """
+    if pr_label == LABEL_UPDATE:
+        return False
+    try:
+        check_internal_branch(project_gl, 'contrib/github_pr_' + str(pr['number']), update=False)
+        return False
+    except RuntimeError:
+        return True
 
+
+def check_commit_id(git, pr_commit_id):
     print('Checking whether specified commit ID matches with user branch HEAD...')
     expected_commit_id = git.rev_parse('--short', 'HEAD')
 
     if not pr_commit_id.startswith(expected_commit_id):
         raise RuntimeError('PR Commit SHA1 in workflow comment and user branch do not match!')
 
+
+def set_git_user(repo):
+    repo.config_writer().set_value('user', 'name', os.environ['GIT_CONFIG_NAME']).release()
+    repo.config_writer().set_value('user', 'email', os.environ['GIT_CONFIG_EMAIL']).release()
+
+
+def rebase_pr(git, repo, pr_base_branch, pr_html_url):
+    print(f'Rebasing with the latest {pr_base_branch} branch...')
+    git.rebase(pr_base_branch)
+
+    commit = repo.head.commit
+    new_cmt_msg = commit.message + '\nMerges ' + pr_html_url
+
+    print('Amending commit message (Adding additional info about commit)...')
+    git.execute(['git','commit', '--amend', '-m', new_cmt_msg])
+
+
+# Update existing MR
+def update_mr(pr_num, pr_head_branch, pr_commit_id, project_gl, pr_base_branch):
+    check_internal_branch(project_gl, pr_head_branch, update=True)
+
+    git = Git('.')
+
+    print('Updating the PR branch...')
+    fetch_ref(git, GITHUB_REMOTE, 'pull/' + str(pr_num) + '/head')
+    git.checkout('FETCH_HEAD', b=pr_head_branch)
+
+    check_commit_id(git, pr_commit_id)
+    deepen_to_merge_base(git, pr_base_branch, pr_num)
+
     print('Pushing to remote...')
     git.push('--force', GITLAB_REMOTE, pr_head_branch)
 
 
 # Merge PRs with/without Rebase
 def sync_pr(pr_num, pr_head_branch, pr_commit_id, project_gl, pr_base_branch, pr_html_url, rebase_flag):
-    try:
-        project_gl.branches.get(pr_head_branch)
-    except:
-        pass
-    else:
-        raise RuntimeError('PR Merge/Rebase: Branch/MR already exists for PR!')
+    check_internal_branch(project_gl, pr_head_branch, update=False)
 
-    GITHUB_REMOTE = 'origin'
-    GITLAB_REMOTE = 'gitlab'
     git = Git('.')
 
     print('Fetching the PR branch...')
-    git.fetch(GITHUB_REMOTE, 'pull/' + str(pr_num) + '/head')
+    fetch_ref(git, GITHUB_REMOTE, 'pull/' + str(pr_num) + '/head')
 
     print('Checking out the PR branch...')
     git.checkout('FETCH_HEAD', b=pr_head_branch)
 
-    print('Checking whether specified commit ID matches with user branch HEAD...')
-    expected_commit_id = git.rev_parse('--short', 'HEAD')
-
-    if not pr_commit_id.startswith(expected_commit_id):
-        raise RuntimeError('PR Commit SHA1 in workflow comment and user branch do not match!')
+    check_commit_id(git, pr_commit_id)
+    deepen_to_merge_base(git, pr_base_branch, pr_num)
 
     if rebase_flag:
         repo = Repo('.')
-        repo.config_writer().set_value('user', 'name', os.environ['GIT_CONFIG_NAME']).release()
-        repo.config_writer().set_value('user', 'email', os.environ['GIT_CONFIG_EMAIL']).release()
-
-        print(f'Rebasing with the latest {pr_base_branch} branch...')
-        git.rebase(pr_base_branch)
-
-        commit = repo.head.commit
-        new_cmt_msg = commit.message + '\nMerges ' + pr_html_url
-
-        print('Amending commit message (Adding additional info about commit)...')
-        git.execute(['git','commit', '--amend', '-m', new_cmt_msg])
+        set_git_user(repo)
+        rebase_pr(git, repo, pr_base_branch, pr_html_url)
 
     print('Pushing to remote...')
     git.push('--set-upstream', GITLAB_REMOTE, pr_head_branch)
 
 
-def main():
-    if 'GITHUB_REPOSITORY' not in os.environ:
-        print('Not running in GitHub action context, nothing to do')
-        return
+def check_pr(pr, pr_label, pr_approve_labeller):
+    """
+    Check a labelled PR (the "pull_request" of a GitHub event), returning the approved commit ID
+    """
+    pr_creator = pr['user']['login']
+    pr_comments_url = pr['comments_url']
+    pr_files_url = pr['url'] + '/files'
 
-    if not os.environ['GITHUB_REPOSITORY'].startswith('espressif/'):
-        print('Not an Espressif repo!')
-        return
+    if pr_label == LABEL_UPDATE:
+        check_update_label(pr['labels'])
+    elif pr_label not in (LABEL_MERGE, LABEL_REBASE):
+        raise RuntimeError('Illegal program flow!')
 
-    # The path of the file with the complete webhook event payload. For example, /github/workflow/event.json.
-    with open(os.environ['GITHUB_EVENT_PATH'], 'r') as f:
-        event = json.load(f)
+    # Checks whether the approve labeller and workflow initiator are the same, and whether the PR has modified forbidden files
+    return pr_run_checks(pr_creator, pr_comments_url, pr_approve_labeller, pr_files_url)
 
-    LABEL_MERGE = 'PR-Sync-Merge'
-    LABEL_REBASE = 'PR-Sync-Rebase'
-    LABEL_UPDATE = 'PR-Sync-Update'
 
-    pr_label = event['label']['name']
-    pr_labels_list = event['pull_request']['labels']
+def sync_checked_pr(pr, pr_label, pr_commit_id, project_gl):
+    """
+    Push a PR checked by check_pr() to the internal remote, and create its MR (or update the existing one)
+    """
+    pr_num = pr['number']
+    pr_head_branch = 'contrib/github_pr_' + str(pr_num)
+    pr_html_url = pr['html_url']
+    pr_base_branch = pr['base']['ref']
 
-    pr_approve_labeller = event['sender']['login']
-    pr_creator = event['pull_request']['user']['login']
-    pr_comments_url = event['pull_request']['comments_url']
-    # Checks whether the approve labeller and workflow initiator are the same
-    pr_commit_id = pr_check_approver(pr_creator, pr_comments_url, pr_approve_labeller)
+    if pr_label == LABEL_REBASE:
+        sync_pr(pr_num, pr_head_branch, pr_commit_id, project_gl, pr_base_branch, pr_html_url, rebase_flag=True)
+    elif pr_label == LABEL_MERGE:
+        sync_pr(pr_num, pr_head_branch, pr_commit_id, project_gl, pr_base_branch, pr_html_url, rebase_flag=False)
+    else:
+        update_mr(pr_num, pr_head_branch, pr_commit_id, project_gl, pr_base_branch)
+        return
 
-    repo_fullname = event['repository']['full_name']
-    project_html_url = event['repository']['clone_url']
+    create_mr(pr, project_gl)
 
-    pr_num = event['pull_request']['number']
-    pr_head_branch = 'contrib/github_pr_' + str(pr_num)
-    pr_rest_url = event['pull_request']['url']
-    pr_html_url = event['pull_request']['html_url']
-    pr_base_branch = event['pull_request']['base']['ref']
 
-    pr_files_url = pr_rest_url + '/files'
-    # Check whether the PR has modified forbidden files
-    pr_check_forbidden_files(pr_files_url)
+def create_mr(pr, project_gl):
+    pr_head_branch = 'contrib/github_pr_' + str(pr['number'])
+    pr_html_url = pr['html_url']
 
     # Getting the PR title and body
-    pr_title = event['pull_request']['title']
+    pr_title = pr['title']
     idx = pr_title.find(os.environ['JIRA_PROJECT'])  # Finding the JIRA issue tag
     pr_title_desc = pr_title[0:idx - 2] + ' (GitHub PR)'
     pr_jira_issue = pr_title[idx:-1]
-    pr_body = str(event['pull_request']['body'])
-
-    # Gitlab setup and cloning internal codebase
-    gl = setup_project(project_html_url, repo_fullname, pr_base_branch)
-    project_gl = gl.projects.get(repo_fullname)
-
-    if pr_label == LABEL_REBASE:
-        sync_pr(pr_num, pr_head_branch, pr_commit_id, project_gl, pr_base_branch, pr_html_url, rebase_flag=True)
-    elif pr_label == LABEL_MERGE:
-        sync_pr(pr_num, pr_head_branch, pr_commit_id, project_gl, pr_base_branch, pr_html_url, rebase_flag=False)
-    elif pr_label == LABEL_UPDATE:
-        check_update_label(pr_labels_list)
-        update_mr(pr_num, pr_head_branch, pr_commit_id, project_gl)
-        print('Done with the workflow!')
-        return
-    else:
-        raise RuntimeError('Illegal program flow!')
+    pr_body = str(pr['body'])
 
     print('Creating a merge request...')
-    mr = project_gl.mergerequests.create({'source_branch': pr_head_branch, 'target_branch': pr_base_branch, 'title': pr_title_desc})
+    mr = project_gl.mergerequests.create({'source_branch': pr_head_branch, 'target_branch': pr['base']['ref'], 'title': pr_title_desc})
 
     print('Updating merge request description...')
     mr_desc = '## Description \n' + pr_body + '\n ##### (Add more info here)' + '\n## Related'
@@ -216,6 +371,246 @@ def main():
     mr.description = mr_desc
     mr.save()
 
+
+def get_labelled_prs(repo_fullname, pr_numbers):
+    """
+    Return (PR, label, labeller) for each PR to sync in a batch: the open PRs with the given numbers, or all open PRs if there are none.
+
+    The label is the PR-Sync label added last to the PR, and the labeller is the user who added it. PRs without a PR-Sync label are skipped.
+    """
+    # Requires Github Access Token, with Push Access
+    GITHUB_TOKEN = os.environ['GITHUB_TOKEN']
+    headers = {'Authorization': 'token ' + GITHUB_TOKEN}
+    api_url = os.environ.get('GITHUB_API_URL', 'https://api.github.com') + '/repos/' + repo_fullname
+
+    if pr_numbers:
+        prs = []
+        for pr_num in pr_numbers:
+            r = get_session().get(api_url + '/pulls/' + str(pr_num), headers=headers)
+            r.raise_for_status()
+            prs.append(r.json())
+    else:
+        prs = get_pages(api_url + '/pulls', headers)
+
+    labelled_prs = []
+    for pr in prs:
+        if pr['state'] != 'open':
+            print(f'PR #{pr["number"]} is {pr["state"]}, skipping')
+            continue
+        pr_labels = [label['name'] for label in pr['labels'] if label['name'] in (LABEL_MERGE, LABEL_REBASE, LABEL_UPDATE)]
+        if not pr_labels:
+            print(f'PR #{pr["number"]} has no PR-Sync label, skipping')
+            continue
+        for event in get_pages(pr['issue_url'] + '/events', headers, reverse=True):
+            if event['event'] == 'labeled' and event['label']['name'] in pr_labels:
+                labelled_prs.append((pr, event['label']['name'], event['actor']['login']))
+                break
+        else:
+            raise RuntimeError(f'PR #{pr["number"]}: No event found for the PR-Sync label!')
+    return labelled_prs
+
+
+def add_worktree(git, pr_num):
+    """
+    Add a worktree, sharing the objects and branches of the repository of 'git', to sync a PR in. Returns its path.
+    """
+    path = tempfile.mkdtemp(prefix=f'github_pr_{pr_num}_')
+    git.worktree('add', '--detach', '--no-checkout', path)
+    return path
+
+
+def remove_worktree(git, path):
+    try:
+        git.worktree('remove', '--force', path)
+    except GitCommandError:
+        shutil.rmtree(path, ignore_errors=True)
+        git.worktree('prune')
+
+
+def push_from_worktree(path, pr_ref, pr_head_branch, pr_commit_id, pr_base_branch, pr_html_url, rebase_flag, update):
+    """
+    Check out a fetched PR as its internal branch in the worktree at 'path', rebase it if needed, and push it.
+
+    This runs in a worker process at the same time as other PRs, so it only writes to its own worktree and branch
+    (for example the branch's upstream isn't set, as it would be written to the shared config).
+    """
+    git = Git(path)
+    git.checkout(pr_ref, b=pr_head_branch)
+    check_commit_id(git, pr_commit_id)
+
+    if rebase_flag:
+        rebase_pr(git, Repo(path), pr_base_branch, pr_html_url)
+
+    print(f'Pushing {pr_head_branch} to remote...')
+    if update:
+        git.push('--force', GITLAB_REMOTE, pr_head_branch)
+    else:
+        git.push(GITLAB_REMOTE, pr_head_branch)
+
+
+@contextlib.contextmanager
+def pr_worktrees(git, pr_nums):
+    """
+    Add a worktree for each PR, and remove them afterwards, even if syncing failed
+    """
+    paths = {}
+    try:
+        for pr_num in pr_nums:
+            paths[pr_num] = add_worktree(git, pr_num)
+        yield paths
+    finally:
+        for path in paths.values():
+            remove_worktree(git, path)
+
+
+def sync_in_worktrees(git, checked_prs, project_gl):
+    """
+    Sync PRs checked by check_pr(), given as (PR, label, commit ID), rebasing and pushing up to PR_SYNC_JOBS of them at the same time
+    in worker processes. Returns the numbers of the PRs which failed.
+
+    All steps which write files shared by the worktrees (fetches, the shallow history and the config) and the GitLab requests are done here,
+    for one PR at a time, and the fetches are all done before the workers start. The workers only check out, rebase, amend and push.
+    """
+    failed = []
+    prs = []
+    for pr, pr_label, pr_commit_id in checked_prs:
+        try:
+            check_internal_branch(project_gl, 'contrib/github_pr_' + str(pr['number']), update=pr_label == LABEL_UPDATE)
+            prs.append((pr, pr_label, pr_commit_id))
+        except RuntimeError as e:
+            print(f'Failed to sync PR #{pr["number"]}: {e}')
+            failed.append(pr['number'])
+    if not prs:
+        return failed
+
+    pr_nums = [pr['number'] for pr, _, _ in prs]
+    try:
+        print(f'Fetching {len(prs)} PR branches...')
+        fetch_ref(git, GITHUB_REMOTE, *[f'+pull/{pr_num}/head:refs/pr-sync/{pr_num}' for pr_num in pr_nums])
+        # the history of every PR is complete before any worker starts
+        ready_prs = []
+        for pr, pr_label, pr_commit_id in prs:
+            try:
+                deepen_to_merge_base(git, pr['base']['ref'], pr['number'], f'refs/pr-sync/{pr["number"]}')
+                ready_prs.append((pr, pr_label, pr_commit_id))
+            except RuntimeError as e:
+                print(f'Failed to sync PR #{pr["number"]}: {e}')
+                failed.append(pr['number'])
+        if any(pr_label == LABEL_REBASE for _, pr_label, _ in ready_prs):
+            set_git_user(Repo(git.working_dir))
+
+        with pr_worktrees(git, [pr['number'] for pr, _, _ in ready_prs]) as paths, ProcessPoolExecutor(max_workers=PR_SYNC_JOBS) as executor:
+            futures = []
+            for pr, pr_label, pr_commit_id in ready_prs:
+                pr_num = pr['number']
+                future = executor.submit(push_from_worktree, paths[pr_num], f'refs/pr-sync/{pr_num}', 'contrib/github_pr_' + str(pr_num), pr_commit_id,
+                                         pr['base']['ref'], pr['html_url'], rebase_flag=pr_label == LABEL_REBASE, update=pr_label == LABEL_UPDATE)
+                futures.append((pr, pr_label, future))
+
+            for pr, pr_label, future in futures:
+                try:
+                    future.result()
+                    if pr_label != LABEL_UPDATE:
+                        create_mr(pr, project_gl)
+                    print(f'Synced PR #{pr["number"]}')
+                except Exception as e:
+                    print(f'Failed to sync PR #{pr["number"]}: {e}')
+                    failed.append(pr['number'])
+    finally:
+        for pr_num in pr_nums:
+            try:
+                git.update_ref('-d', f'refs/pr-sync/{pr_num}')
+            except GitCommandError:
+                pass
+    return failed
+
+
+def sync_batch(repo_fullname, pr_numbers):
+    """
+    Sync several labelled PRs (see get_labelled_prs()), connecting to GitLab and fetching the internal base branches only once.
+    """
+    labelled_prs = get_labelled_prs(repo_fullname, pr_numbers)
+    if not labelled_prs:
+        print('No PRs to sync')
+        return
+
+    gl = connect_gitlab()
+    project_gl = gl.projects.get(repo_fullname)
+    if not pr_numbers:
+        # PRs keep their PR-Sync label once synced, only the PRs given by number are synced again (and fail)
+        with ThreadPoolExecutor(max_workers=PR_SYNC_JOBS) as executor:
+            synced = list(executor.map(lambda labelled_pr: is_synced(project_gl, *labelled_pr[:2]), labelled_prs))
+        for (pr, _, _), pr_synced in zip(labelled_prs, synced):
+            if pr_synced:
+                print(f'PR #{pr["number"]} was synced before, skipping')
+        labelled_prs = [labelled_pr for labelled_pr, pr_synced in zip(labelled_prs, synced) if not pr_synced]
+    print(f'Syncing {len(labelled_prs)} PRs...')
+    if not labelled_prs:
+        return
+
+    git = Git('.')
+    git.worktree('prune')  # worktrees left by a run which was killed
+    add_internal_remote(git, gitlab_project_url(repo_fullname))
+    for pr_base_branch in sorted(set(pr['base']['ref'] for pr, _, _ in labelled_prs)):
+        update_base_branch(git, pr_base_branch)
+
+    failed = []
+    checked_prs = []
+    with ThreadPoolExecutor(max_workers=PR_SYNC_JOBS) as executor:
+        checks = [(pr, pr_label, executor.submit(check_pr, pr, pr_label, pr_approve_labeller)) for pr, pr_label, pr_approve_labeller in labelled_prs]
+    for pr, pr_label, future in checks:
+        try:
+            checked_prs.append((pr, pr_label, future.result()))
+        except Exception as e:
+            print(f'Failed to sync PR #{pr["number"]}: {e}')
+            failed.append(pr['number'])
+
+    failed += sync_in_worktrees(git, checked_prs, project_gl)
+    if failed:
+        raise RuntimeError('Failed to sync PRs: ' + ', '.join('#' + str(pr_num) for pr_num in sorted(failed)))
+
+
+def main():
+    if 'GITHUB_REPOSITORY' not in os.environ:
+        print('Not running in GitHub action context, nothing to do')
+        return
+
+    if not os.environ['GITHUB_REPOSITORY'].startswith('espressif/'):
+        print('Not an Espressif repo!')
+        return
+
+    # Scheduled runs keep the reference repository up to date (the event has no PR or repository details)
+    if os.environ.get('GITHUB_EVENT_NAME') == 'schedule':
+        repo_fullname = os.environ['GITHUB_REPOSITORY']
+        maintain_reference_repo(os.environ.get('GITHUB_SERVER_URL', 'https://github.com') + '/' + repo_fullname + '.git', repo_fullname)
+        print('Done with the workflow!')
+        return
+
+    # The path of the file with the complete webhook event payload. For example, /github/workflow/event.json.
+    with open(os.environ['GITHUB_EVENT_PATH'], 'r') as f:
+        event = json.load(f)
+
+    # Manual runs sync a batch of PRs: the "pr_numbers" input (separated by commas or spaces), or all PRs with a PR-Sync label
+    if os.environ.get('GITHUB_EVENT_NAME') == 'workflow_dispatch':
+        pr_numbers = (event.get('inputs') or {}).get('pr_numbers') or ''
+        sync_batch(event['repository']['full_name'], [int(pr_num) for pr_num in pr_numbers.replace(',', ' ').split()])
+        print('Done with the workflow!')
+        return
+
+    pr = event['pull_request']
+    pr_label = event['label']['name']
+    pr_approve_labeller = event['sender']['login']
+    pr_commit_id = check_pr(pr, pr_label, pr_approve_labeller)
+
+    repo_fullname = event['repository']['full_name']
+    project_html_url = event['repository']['clone_url']
+
+    # Gitlab setup and cloning internal codebase
+    gl = setup_project(project_html_url, repo_fullname, pr['base']['ref'])
+    project_gl = gl.projects.get(repo_fullname)
+
+    sync_checked_pr(pr, pr_label, pr_commit_id, project_gl)
+
     print('Done with the workflow!')
 
 
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2021 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+"""
+Git object cache (a "reference repository") kept between PR sync runs.
+
+The reference repository is a bare repository with the branches of the GitHub and internal remotes,
+for example restored by actions/cache or kept on a self-hosted runner. A run borrows its objects
+(as a git alternate), so that fetches only download the objects which are not in the cache yet.
+
+refresh() and repack() keep the cache up to date, for example in a scheduled workflow:
+
+    python3 reference_repo.py refresh /path/to/cache.git github=https://github.com/... gitlab=https://...
+    python3 reference_repo.py repack /path/to/cache.git
+"""
+import argparse
+import os
+
+from git import Git, GitCommandError
+
+
+def use_reference(git, reference):
+    """
+    Borrow the objects of the reference repository in the repository of 'git'. Returns False if there is no reference repository.
+
+    A shallow checkout (as made by actions/checkout) gets the full history of any commit which the reference repository has.
+    """
+    objects = os.path.abspath(os.path.join(reference, 'objects'))
+    if not os.path.isdir(objects):
+        print(f'No git reference repository at {reference}, fetching everything...')
+        return False
+
+    print(f'Using the objects in the git reference repository {reference}...')
+    alternates = git.rev_parse('--git-path', 'objects/info/alternates')
+    os.makedirs(os.path.dirname(alternates), exist_ok=True)
+    with open(alternates, 'a') as f:
+        f.write(objects + '\n')
+    _unshallow(git, reference)
+    return True
+
+
+def _unshallow(git, reference):
+    shallow = git.rev_parse('--git-path', 'shallow')
+    if not os.path.exists(shallow) or os.path.exists(os.path.join(reference, 'shallow')):
+        return
+
+    ref_git = Git(reference)
+    with open(shallow, 'r') as f:
+        commits = f.read().split()
+    missing = []
+    for commit in commits:
+        try:
+            ref_git.cat_file('-e', commit + '^{commit}')
+        except GitCommandError:
+            missing.append(commit)
+
+    if missing:
+        with open(shallow, 'w') as f:
+            f.write(''.join(commit + '\n' for commit in missing))
+    else:
+        os.remove(shallow)
+
+
+def refresh(reference, remotes):
+    """
+    Fetch the branches of each remote (a dict of name to URL) into the reference repository, creating it if needed.
+
+    The URLs (which may hold access tokens) are not saved in the reference repository.
+    """
+    if not os.path.isdir(reference):
+        print(f'Creating the git reference repository {reference}...')
+        Git().init('--bare', reference)
+        Git(reference).config('gc.auto', '0')  # repack() does this, and never while a run may be using the objects
+
+    ref_git = Git(reference)
+    for name, url in remotes.items():
+        print(f'Fetching {name} into the git reference repository...')
+        ref_git.fetch('--prune', '--no-tags', url, f'+refs/heads/*:refs/remotes/{name}/*')
+
+
+def repack(reference):
+    """
+    Repack the reference repository into one pack, dropping the objects of deleted branches.
+
+    Runs which are using the reference repository at the same time may fail, if they need the dropped objects.
+    """
+    print('Repacking the git reference repository...')
+    ref_git = Git(reference)
+    ref_git.repack('-a', '-d', '--write-bitmap-index')
+    ref_git.prune_packed()
+    ref_git.commit_graph('write', '--reachable')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain the git reference repository used by the PR sync action')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    refresh_parser = subparsers.add_parser('refresh', help='fetch the latest branches of the remotes')
+    refresh_parser.add_argument('reference', help='path of the bare reference repository')
+    refresh_parser.add_argument('remotes', nargs='+', metavar='NAME=URL', help='remotes to fetch')
+    repack_parser = subparsers.add_parser('repack', help='repack the objects into one pack')
+    repack_parser.add_argument('reference', help='path of the bare reference repository')
+    args = parser.parse_args()
+
+    if args.command == 'refresh':
+        refresh(args.reference, dict(remote.split('=', 1) for remote in args.remotes))
+    else:
+        repack(args.reference)
+
+
+if __name__ == '__main__':
+    main()
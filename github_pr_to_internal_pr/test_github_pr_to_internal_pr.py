@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2021 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, call, patch
+
+import github_pr_to_internal_pr
+import reference_repo
+from git import Git, GitCommandError
+
+PR_NUM = 7
+PR_HEAD_BRANCH = 'contrib/github_pr_7'
+OTHER_PR_NUM = 8
+CONFLICT_PR_NUM = 10
+GIT_ENV = {'GIT_CONFIG_NAME': 'Test', 'GIT_CONFIG_EMAIL': 'test@example.com'}
+
+
+def run_git(cwd, *args):
+    return subprocess.run(['git', '-C', cwd] + list(args), check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+
+
+def commit_files(cwd, prefix, count, size=20000, files=10):
+    """
+    Make 'count' commits, each rewriting one of 'files' files with 'size' bytes of random text
+    """
+    for i in range(count):
+        with open(os.path.join(cwd, '%s%d.txt' % (prefix, i % files)), 'w') as f:
+            f.write(os.urandom(size // 2).hex())
+        run_git(cwd, 'add', '-A')
+        run_git(cwd, 'commit', '-q', '-m', '%s %d' % (prefix, i))
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+class BareRepoTestCase(unittest.TestCase):
+    """
+    Local bare repos standing in for GitHub and GitLab. GitLab has the GitHub history plus a few internal
+    commits. GitHub has PRs 7 and 8 branched from older commits of master, and PR 10 which conflicts with the internal commits.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        source = os.path.join(cls.tmp, 'source')
+        run_git(cls.tmp, 'init', '-q', '-b', 'master', source)
+        run_git(source, 'config', 'user.name', 'Test')
+        run_git(source, 'config', 'user.email', 'test@example.com')
+        commit_files(source, 'file', 200)
+
+        run_git(source, 'checkout', '-q', '-b', 'pr', 'master~30')
+        commit_files(source, 'pr', 3, size=200)
+        cls.pr_commit = run_git(source, 'rev-parse', 'HEAD')
+        run_git(source, 'checkout', '-q', '-b', 'other_pr', 'master~10')
+        commit_files(source, 'other', 2, size=200)
+        cls.other_pr_commit = run_git(source, 'rev-parse', 'HEAD')
+        # adds a file which the internal commits add too
+        run_git(source, 'checkout', '-q', '-b', 'conflict_pr', 'master~3')
+        commit_files(source, 'internal', 1, size=200)
+        cls.conflict_pr_commit = run_git(source, 'rev-parse', 'HEAD')
+        cls.github = os.path.join(cls.tmp, 'github.git')
+        run_git(cls.tmp, 'clone', '-q', '--bare', '--branch', 'master', source, cls.github)
+        run_git(cls.github, 'update-ref', 'refs/pull/%d/head' % PR_NUM, cls.pr_commit)
+        run_git(cls.github, 'update-ref', 'refs/pull/%d/head' % OTHER_PR_NUM, cls.other_pr_commit)
+        run_git(cls.github, 'update-ref', 'refs/pull/%d/head' % CONFLICT_PR_NUM, cls.conflict_pr_commit)
+        run_git(cls.github, 'branch', '-D', 'pr', 'other_pr', 'conflict_pr')
+
+        run_git(source, 'checkout', '-q', 'master')
+        commit_files(source, 'internal', 5, size=200)
+        cls.gitlab = os.path.join(cls.tmp, 'gitlab.git')
+        run_git(cls.tmp, 'clone', '-q', '--bare', '--branch', 'master', source, cls.gitlab)
+        run_git(cls.gitlab, 'branch', '-D', 'pr', 'other_pr', 'conflict_pr')
+        for bare in (cls.github, cls.gitlab):
+            run_git(bare, 'config', 'uploadpack.allowFilter', 'true')
+            run_git(bare, 'config', 'uploadpack.allowAnySHA1InWant', 'true')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.run_dir = tempfile.mkdtemp(dir=self.tmp)
+        # each test pushes to its own copy of GitLab
+        self.gitlab_copy = os.path.join(self.run_dir, 'gitlab.git')
+        shutil.copytree(self.gitlab, self.gitlab_copy)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.run_dir)
+
+    def checkout_workspace(self, depth=1):
+        """
+        Clone GitHub master into a workspace like actions/checkout does with 'fetch-depth' (0 for the full history), and change to it
+        """
+        workspace = os.path.join(self.run_dir, 'workspace')
+        run_git(self.run_dir, 'clone', '-q', '--depth=%d' % depth if depth else '--no-local', 'file://' + self.github, workspace)
+        run_git(workspace, 'config', 'user.name', 'Test')
+        run_git(workspace, 'config', 'user.email', 'test@example.com')
+        run_git(workspace, 'config', 'pull.rebase', 'false')
+        # keep fetched objects packed, so that the size of .git/objects grows by the bytes fetched
+        run_git(workspace, 'config', 'transfer.unpackLimit', '1')
+        os.chdir(workspace)
+        return workspace
+
+    def project_gl(self, existing_branch):
+        project_gl = Mock()
+        if not existing_branch:
+            project_gl.branches.get.side_effect = Exception('404 Branch Not Found')
+        return project_gl
+
+    def sync(self, rebase_flag, depth=0, since=None, reference=None):
+        """
+        Sync the PR to the GitLab copy, returning the bytes fetched (including the checkout) and the time taken.
+        The full fetch needs a checkout of the full history to find the merge base, unless the reference repository has it.
+        """
+        start = time.perf_counter()
+        workspace = self.checkout_workspace(depth=1 if depth or since or reference else 0)
+        with patch.object(github_pr_to_internal_pr, 'GIT_FETCH_DEPTH', depth), \
+                patch.object(github_pr_to_internal_pr, 'GIT_SHALLOW_SINCE', since), \
+                patch.object(github_pr_to_internal_pr, 'GIT_REFERENCE_REPO', reference), \
+                patch.dict(os.environ, GIT_ENV):
+            github_pr_to_internal_pr.fetch_internal_base('file://' + self.gitlab_copy, 'master')
+            github_pr_to_internal_pr.sync_pr(PR_NUM, PR_HEAD_BRANCH, self.pr_commit[:7], self.project_gl(False), 'master',
+                                             'https://github.com/espressif/esp-idf/pull/7', rebase_flag)
+        return dir_size(os.path.join(workspace, '.git', 'objects')), time.perf_counter() - start
+
+    def pushed(self, ref=PR_HEAD_BRANCH):
+        return run_git(self.gitlab_copy, 'rev-parse', ref)
+
+
+class TestShallowFetch(BareRepoTestCase):
+
+    def test_merge(self):
+        full_bytes, full_time = self.sync(rebase_flag=False)
+        self.assertEqual(self.pr_commit, self.pushed())
+        self.tearDown()
+        self.setUp()
+        shallow_bytes, shallow_time = self.sync(rebase_flag=False, depth=5)
+        self.assertEqual(self.pr_commit, self.pushed())
+        print('Merge: full fetch %d bytes in %.2fs, shallow fetch %d bytes in %.2fs' % (full_bytes, full_time, shallow_bytes, shallow_time))
+        self.assertLess(shallow_bytes, full_bytes / 4)
+
+    def test_rebase(self):
+        full_bytes, full_time = self.sync(rebase_flag=True)
+        full_tree = self.pushed(PR_HEAD_BRANCH + '^{tree}')
+        self.tearDown()
+        self.setUp()
+        shallow_bytes, shallow_time = self.sync(rebase_flag=True, depth=5)
+        print('Rebase: full fetch %d bytes in %.2fs, shallow fetch %d bytes in %.2fs' % (full_bytes, full_time, shallow_bytes, shallow_time))
+        self.assertLess(shallow_bytes, full_bytes / 4)
+
+        # rebased on the internal master, with the same result as with the full history
+        self.assertEqual(full_tree, self.pushed(PR_HEAD_BRANCH + '^{tree}'))
+        self.assertEqual(self.pushed('master'), self.pushed(PR_HEAD_BRANCH + '~3'))
+        self.assertIn('Merges https://github.com/espressif/esp-idf/pull/7', run_git(self.gitlab_copy, 'log', '-1', '--format=%B', PR_HEAD_BRANCH))
+
+    def test_shallow_since(self):
+        # all commits are recent, so this is the full history of both branches (but without the file contents)
+        self.sync(rebase_flag=True, since='1 year ago')
+        self.assertEqual(self.pushed('master'), self.pushed(PR_HEAD_BRANCH + '~3'))
+
+        self.tearDown()
+        self.setUp()
+        # no commits since then, so only the last commits are fetched and deepened as needed
+        self.sync(rebase_flag=True, since='2100-01-01')
+        self.assertEqual(self.pushed('master'), self.pushed(PR_HEAD_BRANCH + '~3'))
+
+    def test_shallow_since_error(self):
+        # errors other than --shallow-since being rejected are not hidden by a fetch with --depth
+        git = Mock()
+        git.fetch.side_effect = GitCommandError(['git', 'fetch'], 128, stderr="fatal: could not read Username for 'https://github.com'")
+        with patch.object(github_pr_to_internal_pr, 'GIT_SHALLOW_SINCE', '2 weeks ago'):
+            with self.assertRaises(GitCommandError):
+                github_pr_to_internal_pr.fetch_ref(git, 'origin', 'pull/7/head')
+        self.assertEqual(1, git.fetch.call_count)
+
+        git.fetch.side_effect = [GitCommandError(['git', 'fetch'], 128, stderr='fatal: Server does not support --shallow-since'), None]
+        with patch.object(github_pr_to_internal_pr, 'GIT_SHALLOW_SINCE', '2 weeks ago'):
+            github_pr_to_internal_pr.fetch_ref(git, 'origin', 'pull/7/head')
+        self.assertEqual(call('--filter=blob:none', '--depth=1', 'origin', 'pull/7/head'), git.fetch.call_args)
+
+    def test_deepen_to_merge_base(self):
+        self.checkout_workspace()
+        with patch.object(github_pr_to_internal_pr, 'GIT_FETCH_DEPTH', 2):
+            github_pr_to_internal_pr.fetch_internal_base('file://' + self.gitlab_copy, 'master')
+            git = Git('.')
+            github_pr_to_internal_pr.fetch_ref(git, 'origin', 'pull/%d/head' % PR_NUM)
+            git.checkout('FETCH_HEAD', b=PR_HEAD_BRANCH)
+            merge_base = github_pr_to_internal_pr.deepen_to_merge_base(git, 'master', PR_NUM)
+
+        self.assertEqual(run_git(self.github, 'rev-parse', 'master~30'), merge_base)
+        # deepened in steps of 2, 4, 8, ... commits, rather than fetching all 205 commits of the internal master
+        self.assertLess(int(git.rev_list('--count', 'master')), 100)
+
+    def test_unrelated_history(self):
+        self.checkout_workspace()
+        orphan = run_git(self.gitlab_copy, '-c', 'user.name=Test', '-c', 'user.email=test@example.com', 'commit-tree', '-m', 'orphan', 'master^{tree}')
+        run_git(self.gitlab_copy, 'update-ref', 'refs/heads/orphan', orphan)
+        with patch.object(github_pr_to_internal_pr, 'GIT_FETCH_DEPTH', 5):
+            github_pr_to_internal_pr.fetch_internal_base('file://' + self.gitlab_copy, 'orphan')
+            git = Git('.')
+            github_pr_to_internal_pr.fetch_ref(git, 'origin', 'pull/%d/head' % PR_NUM)
+            git.checkout('FETCH_HEAD', b=PR_HEAD_BRANCH)
+            with self.assertRaises(RuntimeError):
+                github_pr_to_internal_pr.deepen_to_merge_base(git, 'orphan', PR_NUM)
+
+
+class TestReferenceRepo(BareRepoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.reference = os.path.join(self.run_dir, 'reference.git')
+
+    def test_sync(self):
+        full_bytes, full_time = self.sync(rebase_flag=True)
+        self.tearDown()
+        self.setUp()
+        # the cache is older than the internal commits and the PR
+        reference_repo.refresh(self.reference, {'origin': 'file://' + self.github})
+        cached_bytes, cached_time = self.sync(rebase_flag=True, reference=self.reference)
+        print('Rebase: full fetch %d bytes in %.2fs, with reference repository %d bytes in %.2fs' % (full_bytes, full_time, cached_bytes, cached_time))
+        self.assertLess(cached_bytes, full_bytes / 4)
+        self.assertEqual(self.pushed('master'), self.pushed(PR_HEAD_BRANCH + '~3'))
+
+    def test_unshallow(self):
+        reference_repo.refresh(self.reference, {'origin': 'file://' + self.github})
+        self.checkout_workspace()
+        git = Git('.')
+        self.assertTrue(reference_repo.use_reference(git, self.reference))
+        self.assertEqual('false', git.rev_parse('--is-shallow-repository'))
+        self.assertEqual('200', git.rev_list('--count', 'HEAD'))
+        git.fsck('--connectivity-only')
+
+    def test_missing_reference(self):
+        self.checkout_workspace()
+        git = Git('.')
+        self.assertFalse(reference_repo.use_reference(git, self.reference))
+        self.assertEqual('true', git.rev_parse('--is-shallow-repository'))
+
+    def test_refresh_and_repack(self):
+        reference_repo.refresh(self.reference, {'origin': 'file://' + self.github})
+        reference_repo.refresh(self.reference, {'origin': 'file://' + self.github, 'gitlab': 'file://' + self.gitlab_copy})
+        ref_git = Git(self.reference)
+        self.assertEqual(self.pushed('master'), ref_git.rev_parse('refs/remotes/gitlab/master'))
+        self.assertEqual(run_git(self.github, 'rev-parse', 'master'), ref_git.rev_parse('refs/remotes/origin/master'))
+        self.assertNotIn('file://', ref_git.config('--list'))
+
+        reference_repo.repack(self.reference)
+        packs = os.listdir(os.path.join(self.reference, 'objects', 'pack'))
+        self.assertEqual(1, len([p for p in packs if p.endswith('.pack')]))
+
+
+class FakeGitHubList(object):
+    """
+    Stands in for the requests Session, serving a GitHub API list at 'url' in pages of 'per_page' items with Link headers
+    """
+    def __init__(self, url, items, per_page=3):
+        self.url = url
+        self.pages = [items[i:i + per_page] for i in range(0, len(items), per_page)] or [[]]
+        self.requested = []
+
+    def page_url(self, page):
+        return '%s?per_page=%d&page=%d' % (self.url, github_pr_to_internal_pr.GITHUB_PER_PAGE, page)
+
+    def get(self, url, headers, params=None):
+        page = int(url.split('page=')[-1]) if 'page=' in url else 1
+        self.requested.append(page)
+        response = Mock()
+        response.json.return_value = self.pages[page - 1]
+        response.links = {}
+        if page > 1:
+            response.links['prev'] = {'url': self.page_url(page - 1)}
+        if page < len(self.pages):
+            response.links['next'] = {'url': self.page_url(page + 1)}
+            response.links['last'] = {'url': self.page_url(len(self.pages))}
+        return response
+
+
+@patch.dict(os.environ, {'GITHUB_TOKEN': 'token'})
+class TestPreChecks(unittest.TestCase):
+    COMMENTS_URL = 'https://api.github.com/repos/espressif/esp-idf/issues/7/comments'
+    FILES_URL = 'https://api.github.com/repos/espressif/esp-idf/pulls/7/files'
+
+    def comments(self, count, **approvals):
+        comments = [{'body': 'comment %d' % i, 'user': {'login': 'someone'}} for i in range(count)]
+        for index, sha in approvals.items():
+            comments[int(index[1:])] = {'body': 'sha=' + sha, 'user': {'login': 'approver'}}
+        return comments
+
+    def test_get_pages(self):
+        fake = FakeGitHubList(self.FILES_URL, list(range(10)))
+        with patch.object(github_pr_to_internal_pr, 'get_session', return_value=fake):
+            self.assertEqual(list(range(10)), list(github_pr_to_internal_pr.get_pages(self.FILES_URL, {})))
+            self.assertEqual([1, 2, 3, 4], fake.requested)
+
+            fake.requested = []
+            self.assertEqual(list(reversed(range(10))), list(github_pr_to_internal_pr.get_pages(self.FILES_URL, {}, reverse=True)))
+            self.assertEqual([1, 4, 3, 2], fake.requested)
+
+    def test_approver_on_later_page(self):
+        fake = FakeGitHubList(self.COMMENTS_URL, self.comments(40, c2='aaaaaaa', c31='bbbbbbb'))
+        with patch.object(github_pr_to_internal_pr, 'get_session', return_value=fake):
+            self.assertEqual('bbbbbbb', github_pr_to_internal_pr.pr_check_approver('creator', self.COMMENTS_URL, 'approver'))
+        # the latest command comment is on page 11 of 14, so pages 2 to 10 are never fetched
+        self.assertEqual([1, 14, 13, 12, 11], fake.requested)
+
+    def test_approver_missing(self):
+        fake = FakeGitHubList(self.COMMENTS_URL, self.comments(10, c4='aaaaaaa'))
+        with patch.object(github_pr_to_internal_pr, 'get_session', return_value=fake):
+            # the creator of the PR can't approve it
+            with self.assertRaises(RuntimeError):
+                github_pr_to_internal_pr.pr_check_approver('approver', self.COMMENTS_URL, 'approver')
+            with self.assertRaises(RuntimeError):
+                github_pr_to_internal_pr.pr_check_approver('creator', self.COMMENTS_URL, 'someone')
+
+    def test_forbidden_file_on_later_page(self):
+        files = [{'filename': 'components/file%d.c' % i} for i in range(40)]
+        files[35] = {'filename': '.github/workflows/build.yml'}
+        fake = FakeGitHubList(self.FILES_URL, files)
+        with patch.object(github_pr_to_internal_pr, 'get_session', return_value=fake):
+            with self.assertRaises(RuntimeError):
+                github_pr_to_internal_pr.pr_check_forbidden_files(self.FILES_URL)
+            # stopped at the forbidden file on page 12 of 14
+            self.assertEqual(list(range(1, 13)), fake.requested)
+
+            fake.pages[11][2] = {'filename': 'components/file35.c'}
+            fake.requested = []
+            github_pr_to_internal_pr.pr_check_forbidden_files(self.FILES_URL)
+            self.assertEqual(list(range(1, 15)), fake.requested)
+
+    def test_run_checks(self):
+        comments = FakeGitHubList(self.COMMENTS_URL, self.comments(5, c3='aaaaaaa'))
+        files = FakeGitHubList(self.FILES_URL, [{'filename': '.gitlab-ci.yml'}])
+
+        def get_session():
+            return Mock(get=lambda url, **kwargs: (comments if url.startswith(self.COMMENTS_URL) else files).get(url, **kwargs))
+
+        with patch.object(github_pr_to_internal_pr, 'get_session', get_session):
+            with self.assertRaises(RuntimeError):
+                github_pr_to_internal_pr.pr_run_checks('creator', self.COMMENTS_URL, 'approver', self.FILES_URL)
+            files.pages = [[{'filename': 'README.md'}]]
+            self.assertEqual('aaaaaaa', github_pr_to_internal_pr.pr_run_checks('creator', self.COMMENTS_URL, 'approver', self.FILES_URL))
+
+
+class FakeGitHubApi(object):
+    """
+    Stands in for the requests Session, serving one page of JSON for each URL in 'responses'
+    """
+    def __init__(self, responses):
+        self.responses = responses
+
+    def get(self, url, headers, params=None):
+        return Mock(links={}, **{'json.return_value': self.responses[url]})
+
+
+class TestBatchSync(BareRepoTestCase):
+    API_URL = 'https://api.github.com/repos/espressif/esp-idf'
+
+    def github_pr(self, pr_num, label, commit_id, other_labels=(), state='open'):
+        pr_url = '%s/pulls/%d' % (self.API_URL, pr_num)
+        issue_url = '%s/issues/%d' % (self.API_URL, pr_num)
+        pr = {
+            'number': pr_num, 'url': pr_url, 'issue_url': issue_url, 'comments_url': issue_url + '/comments',
+            'html_url': 'https://github.com/espressif/esp-idf/pull/%d' % pr_num, 'title': 'Fix something (IDFGH-%d)' % pr_num,
+            'body': 'Description', 'base': {'ref': 'master'}, 'user': {'login': 'creator'}, 'state': state,
+            'labels': [{'name': name} for name in ('Type: Bug',) + tuple(other_labels) + ((label,) if label else ())],
+        }
+        self.api.responses[pr_url] = pr
+        self.api.responses[pr_url + '/files'] = [{'filename': 'components/file.c'}]
+        self.api.responses[issue_url + '/comments'] = [{'body': 'sha=' + commit_id[:7], 'user': {'login': 'approver'}}]
+        self.api.responses[issue_url + '/events'] = [
+            {'event': 'labeled', 'label': {'name': 'Type: Bug'}, 'actor': {'login': 'creator'}},
+            {'event': 'labeled', 'label': {'name': label}, 'actor': {'login': 'approver'}},
+        ]
+        if state == 'open':
+            self.api.responses.setdefault(self.API_URL + '/pulls', []).append(pr)
+
+    def setUp(self):
+        super().setUp()
+        self.api = FakeGitHubApi({})
+        self.github_pr(PR_NUM, 'PR-Sync-Rebase', self.pr_commit)
+        self.github_pr(OTHER_PR_NUM, 'PR-Sync-Merge', self.other_pr_commit)
+        self.github_pr(9, None, self.pr_commit)
+        self.project_gl = self.project_gl(existing_branch=False)
+        gl = Mock()
+        gl.projects.get.return_value = self.project_gl
+
+        env = dict(GIT_ENV, GITHUB_TOKEN='token', JIRA_PROJECT='IDFGH')
+        for patcher in (patch.object(github_pr_to_internal_pr, 'get_session', return_value=self.api),
+                        patch.object(github_pr_to_internal_pr, 'connect_gitlab', return_value=gl),
+                        patch.object(github_pr_to_internal_pr, 'gitlab_project_url', return_value='file://' + self.gitlab_copy),
+                        patch.dict(os.environ, env)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.workspace = self.checkout_workspace(depth=0)
+
+    def test_all_labelled_prs(self):
+        github_pr_to_internal_pr.sync_batch('espressif/esp-idf', [])
+
+        self.assertEqual(self.pushed('master'), self.pushed(PR_HEAD_BRANCH + '~3'))
+        self.assertEqual(self.other_pr_commit, self.pushed('contrib/github_pr_8'))
+        self.assertEqual(['contrib/github_pr_7', 'contrib/github_pr_8'],
+                         sorted(c[0][0]['source_branch'] for c in self.project_gl.mergerequests.create.call_args_list))
+        # the worktrees are removed, leaving the workspace as it was
+        self.assert_cleaned_up()
+        self.assertEqual('', run_git(self.workspace, 'status', '--porcelain', '--untracked-files=no'))
+
+    def test_synced_pr_skipped(self):
+        # PR 8 was synced before and still has its PR-Sync-Merge label
+        def get_branch(name):
+            if name != 'contrib/github_pr_8':
+                raise Exception('404 Branch Not Found')
+        self.project_gl.branches.get.side_effect = get_branch
+
+        github_pr_to_internal_pr.sync_batch('espressif/esp-idf', [])
+        self.assertEqual(self.pushed('master'), self.pushed(PR_HEAD_BRANCH + '~3'))
+        self.assertNotIn('contrib/github_pr_8', run_git(self.gitlab_copy, 'branch'))
+        self.assertEqual(['contrib/github_pr_7'], [c[0][0]['source_branch'] for c in self.project_gl.mergerequests.create.call_args_list])
+        self.assert_cleaned_up()
+
+    def test_pr_numbers(self):
+        github_pr_to_internal_pr.sync_batch('espressif/esp-idf', [OTHER_PR_NUM])
+        self.assertEqual(self.other_pr_commit, self.pushed('contrib/github_pr_8'))
+        self.assertEqual(1, self.project_gl.mergerequests.create.call_count)
+
+    def test_failed_pr(self):
+        # approved commit doesn't match the PR branch
+        self.api.responses['%s/issues/%d/comments' % (self.API_URL, OTHER_PR_NUM)][0]['body'] = 'sha=1234567'
+        with self.assertRaisesRegex(RuntimeError, 'Failed to sync PRs: #8$'):
+            github_pr_to_internal_pr.sync_batch('espressif/esp-idf', [])
+        # the other PR is synced anyway
+        self.assertEqual(self.pushed('master'), self.pushed(PR_HEAD_BRANCH + '~3'))
+        self.assert_cleaned_up()
+
+    def assert_cleaned_up(self):
+        self.assertEqual(1, len(run_git(self.workspace, 'worktree', 'list').splitlines()))
+        self.assertEqual('', run_git(self.workspace, 'for-each-ref', 'refs/pr-sync'))
+
+    def test_rebase_conflict(self):
+        self.github_pr(CONFLICT_PR_NUM, 'PR-Sync-Rebase', self.conflict_pr_commit)
+        with self.assertRaisesRegex(RuntimeError, 'Failed to sync PRs: #10$'):
+            github_pr_to_internal_pr.sync_batch('espressif/esp-idf', [])
+
+        self.assertEqual(self.pushed('master'), self.pushed(PR_HEAD_BRANCH + '~3'))
+        self.assertEqual(self.other_pr_commit, self.pushed('contrib/github_pr_8'))
+        self.assertNotIn('contrib/github_pr_10', run_git(self.gitlab_copy, 'branch'))
+        self.assert_cleaned_up()
+
+    def test_update(self):
+        # PR 8 was synced before, and has new commits since then
+        run_git(self.gitlab_copy, 'update-ref', 'refs/heads/contrib/github_pr_8', self.other_pr_commit + '~1')
+        self.github_pr(OTHER_PR_NUM, 'PR-Sync-Update', self.other_pr_commit, other_labels=['PR-Sync-Merge'])
+
+        def get_branch(name):
+            if name != 'contrib/github_pr_8':
+                raise Exception('404 Branch Not Found')
+        self.project_gl.branches.get.side_effect = get_branch
+
+        github_pr_to_internal_pr.sync_batch('espressif/esp-idf', [OTHER_PR_NUM])
+        self.assertEqual(self.other_pr_commit, self.pushed('contrib/github_pr_8'))
+        self.project_gl.mergerequests.create.assert_not_called()
+        self.assert_cleaned_up()
+
+    def test_shallow_fetch(self):
+        shutil.rmtree(self.workspace)
+        self.workspace = self.checkout_workspace(depth=1)
+        with patch.object(github_pr_to_internal_pr, 'GIT_FETCH_DEPTH', 5):
+            github_pr_to_internal_pr.sync_batch('espressif/esp-idf', [])
+        self.assertEqual(self.pushed('master'), self.pushed(PR_HEAD_BRANCH + '~3'))
+        self.assertEqual(self.other_pr_commit, self.pushed('contrib/github_pr_8'))
+        self.assert_cleaned_up()
+
+    def test_deepen_before_workers(self):
+        # the shared repository is not written to once the workers are running
+        shutil.rmtree(self.workspace)
+        self.workspace = self.checkout_workspace(depth=1)
+        events = []
+        deepen_to_merge_base = github_pr_to_internal_pr.deepen_to_merge_base
+
+        def deepen(git, pr_base_branch, pr_num, pr_ref='HEAD'):
+            events.append('deepen')
+            return deepen_to_merge_base(git, pr_base_branch, pr_num, pr_ref)
+
+        class RecordingExecutor(ThreadPoolExecutor):
+            def submit(self, fn, *args, **kwargs):
+                events.append('submit')
+                return super().submit(fn, *args, **kwargs)
+
+        with patch.object(github_pr_to_internal_pr, 'GIT_FETCH_DEPTH', 5), \
+                patch.object(github_pr_to_internal_pr, 'deepen_to_merge_base', deepen), \
+                patch.object(github_pr_to_internal_pr, 'ProcessPoolExecutor', RecordingExecutor):
+            github_pr_to_internal_pr.sync_batch('espressif/esp-idf', [])
+        self.assertEqual(['deepen', 'deepen', 'submit', 'submit'], events)
+        self.assertEqual(self.other_pr_commit, self.pushed('contrib/github_pr_8'))
+        self.assert_cleaned_up()
+
+    def test_parallel(self):
+        # all PRs at the same time, each one rebased in its own worktree
+        for pr_num in range(11, 15):
+            self.github_pr(pr_num, 'PR-Sync-Rebase', self.other_pr_commit)
+            run_git(self.github, 'update-ref', 'refs/pull/%d/head' % pr_num, self.other_pr_commit)
+            self.addCleanup(run_git, self.github, 'update-ref', '-d', 'refs/pull/%d/head' % pr_num)
+        with patch.object(github_pr_to_internal_pr, 'PR_SYNC_JOBS', 6):
+            github_pr_to_internal_pr.sync_batch('espressif/esp-idf', [])
+
+        self.assertEqual(self.pushed('master'), self.pushed(PR_HEAD_BRANCH + '~3'))
+        for pr_num in range(11, 15):
+            branch = 'contrib/github_pr_%d' % pr_num
+            self.assertEqual(self.pushed('master'), self.pushed(branch + '~2'))
+            self.assertIn('Merges https://github.com/espressif/esp-idf/pull/%d' % pr_num,
+                          run_git(self.gitlab_copy, 'log', '-1', '--format=%B', branch))
+        self.assertEqual(6, self.project_gl.mergerequests.create.call_count)
+        self.assert_cleaned_up()
+
+    def test_get_labelled_prs(self):
+        labelled_prs = github_pr_to_internal_pr.get_labelled_prs('espressif/esp-idf', [])
+        self.assertEqual([(PR_NUM, 'PR-Sync-Rebase', 'approver'), (OTHER_PR_NUM, 'PR-Sync-Merge', 'approver')],
+                         [(pr['number'], label, labeller) for pr, label, labeller in labelled_prs])
+
+    def test_closed_pr(self):
+        # merged PRs are closed too
+        self.github_pr(11, 'PR-Sync-Merge', self.other_pr_commit, state='closed')
+        labelled_prs = github_pr_to_internal_pr.get_labelled_prs('espressif/esp-idf', [11, OTHER_PR_NUM])
+        self.assertEqual([OTHER_PR_NUM], [pr['number'] for pr, _, _ in labelled_prs])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+#
+# Copyright 2019 Espressif Systems (Shanghai) PTE LTD
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+HTTP session settings shared by the API clients.
+
+Requests to the same host reuse kept-alive connections from a pool of HTTP_POOL_SIZE connections,
+and requests which fail with a connection error or a temporary error status are retried with
+exponential backoff. Only idempotent requests are retried, so a POST is never sent twice.
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Maximum number of kept-alive connections per host
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+# Number of times to retry a failed request
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 3))
+# Retries wait 0.5s, 1s, 2s, ... (or as long as a Retry-After header says)
+HTTP_RETRY_BACKOFF = 0.5
+RETRY_STATUSES = (429, 502, 503, 504)
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def make_retry(statuses=RETRY_STATUSES):
+    """
+    Return the urllib3 Retry policy. If retries run out, the last response is returned so that the
+    client can raise its usual error for it.
+    """
+    return Retry(total=HTTP_RETRIES, backoff_factor=HTTP_RETRY_BACKOFF, status_forcelist=statuses,
+                 respect_retry_after_header=True, raise_on_status=False)
+
+
+def mount_adapters(session, statuses=RETRY_STATUSES):
+    """
+    Configure a requests Session to use the connection pool size and retry policy, and return it.
+    """
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=make_retry(statuses))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def new_session():
+    """
+    Return a new configured requests Session, for clients which take a session argument.
+    """
+    return mount_adapters(requests.Session())
+
+
+def get_session():
+    """
+    Return the configured requests Session shared by all plain HTTP requests in this process.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = new_session()
+        return _SESSION
+
+
+def github_options():
+    """
+    Return keyword arguments for PyGithub's Github() with the same pool size and retry policy.
+
+    (PyGithub creates its own Session, which keeps connections alive between requests.)
+    """
+    return {'retry': make_retry(), 'pool_size': HTTP_POOL_SIZE}
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from github import Github, GithubException
+from http_session import github_options
 import os
 import subprocess
 
@@ -19,7 +20,7 @@ def main():
     github_repo = os.environ["GITHUB_REPOSITORY"]
 
     print("Connecting to GitHub...")
-    github = Github(github_token)
+    github = Github(github_token, **github_options())
     repo = github.get_repo(github_repo)
 
     if repo.private:
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+#
+# Copyright 2019 Espressif Systems (Shanghai) PTE LTD
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmarks for the GitHub to JIRA sync.
+
+Usage: benchmark_sync_to_jira.py <benchmark> [options], see --help for the list of benchmarks.
+"""
+from collections import OrderedDict
+import argparse
+import concurrent.futures
+import http.server
+import json
+import os
+import shutil
+import subprocess
+import sys
+import ssl
+import tempfile
+import threading
+import time
+
+from markdown2wiki import markdown2wiki
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_markdown2wiki')
+
+
+def _load_corpus():
+    corpus = {}
+    for name in sorted(os.listdir(CORPUS_DIR)):
+        if name.endswith('.md'):
+            with open(os.path.join(CORPUS_DIR, name), 'r') as f:
+                corpus[name] = f.read()
+    return corpus
+
+
+def _time_per_call(func, inputs, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for markdown in inputs:
+            func(markdown)
+    return (time.perf_counter() - start) / (repeat * len(inputs))
+
+
+def benchmark_markdown(args):
+    """
+    Compare the in-process converter with the markdown2confluence subprocess, over the golden file corpus.
+    """
+    import sync_issue
+
+    corpus = _load_corpus()
+    inputs = list(corpus.values())
+
+    in_process = _time_per_call(markdown2wiki, inputs, args.repeat)
+    print('in-process:          %8.3f ms per body' % (in_process * 1000))
+
+    if shutil.which('markdown2confluence') is None:
+        print('markdown2confluence: not installed, skipping subprocess comparison')
+        return
+
+    subprocess_time = _time_per_call(sync_issue._markdown2confluence, inputs, 1)
+    print('markdown2confluence: %8.3f ms per body (%.0fx slower)' % (subprocess_time * 1000, subprocess_time / in_process))
+
+    mismatches = [name for name, markdown in corpus.items()
+                  if markdown2wiki(markdown) != sync_issue._markdown2confluence(markdown)]
+    for name in mismatches:
+        print('Output differs from markdown2confluence: %s' % name)
+
+
+# Events which sync_to_jira.main() skips without syncing anything
+SKIPPED_EVENTS = {
+    'issue assigned': ('issues', {'action': 'assigned', 'issue': {'number': 1, 'user': {'login': 'someone'}}}),
+    'workflow_dispatch without inputs': ('workflow_dispatch', {}),
+}
+
+
+def benchmark_startup(args):
+    """
+    Measure the time from starting to import sync_to_jira until main() returns, for events which are skipped.
+
+    Each measurement runs in a new Python process, so imports aren't cached. The JIRA connection is
+    replaced by a stub and HTTP requests are counted (and fail), so only local startup cost is measured.
+    """
+    if args.child:
+        _startup_child()
+        return
+
+    for name, (event_name, event) in SKIPPED_EVENTS.items():
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump(event, f)
+        env = dict(os.environ, GITHUB_EVENT_NAME=event_name, GITHUB_EVENT_PATH=f.name, GITHUB_TOKEN='benchmark',
+                   GITHUB_REPOSITORY='espressif/benchmark', JIRA_URL='https://jira.invalid', JIRA_USER='benchmark', JIRA_PASS='benchmark')
+        results = []
+        try:
+            for _ in range(args.repeat):
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__), 'startup', '--child'],
+                                                 env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+                results.append(json.loads(output.decode().splitlines()[-1]))
+        finally:
+            os.unlink(f.name)
+        import_time = sorted(r['import'] for r in results)[len(results) // 2]
+        dispatch_time = sorted(r['dispatch'] for r in results)[len(results) // 2]
+        print('%-34s import %7.1f ms, import to dispatch %7.1f ms, %d HTTP requests (median of %d)' % (
+            name + ':', import_time * 1000, dispatch_time * 1000, max(r['requests'] for r in results), len(results)))
+
+
+def _startup_child():
+    import requests.adapters
+
+    requests_sent = []
+
+    def send(adapter, request, *args, **kwargs):
+        requests_sent.append(request.url)
+        raise requests.exceptions.ConnectionError('HTTP requests are disabled by the benchmark')
+
+    requests.adapters.HTTPAdapter.send = send
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            import sync_to_jira
+            imported = time.perf_counter()
+            sync_to_jira._JIRA = lambda *args, **kwargs: None
+            sync_to_jira.main()
+        finally:
+            sys.stdout = stdout
+    done = time.perf_counter()
+    print(json.dumps({'import': imported - start, 'dispatch': done - start, 'requests': len(requests_sent)}))
+
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep connections alive
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = b'{"key": "TEST-1"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _start_stub_server(ssl_context):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+    server.daemon_threads = True
+    if ssl_context is not None:
+        server.socket = ssl_context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, '%s://127.0.0.1:%d/rest/api/2/issue/TEST-1' % ('https' if ssl_context else 'http', server.server_address[1])
+
+
+def _make_certificate(directory):
+    """
+    Make a self-signed certificate for 127.0.0.1 with openssl, returning the (certificate, key) paths or None
+    """
+    if shutil.which('openssl') is None:
+        return None
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-keyout', key, '-out', cert,
+                           '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1'], stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+def benchmark_http(args):
+    """
+    Compare requests per second to two local stub HTTPS servers (standing in for GitHub and JIRA) with the
+    pooled sessions from http_session, against a new connection for every request.
+    """
+    import requests
+    import http_session
+
+    with tempfile.TemporaryDirectory() as directory:
+        certificate = _make_certificate(directory)
+        if certificate is None:
+            print('openssl not installed, using plain HTTP stub servers')
+            ssl_context, verify = None, True
+        else:
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ssl_context.load_cert_chain(*certificate)
+            verify = certificate[0]
+        servers = [_start_stub_server(ssl_context) for _ in range(2)]
+        urls = [url for _, url in servers] * args.repeat
+
+        def unpooled(url):
+            requests.get(url, verify=verify).raise_for_status()
+
+        session = http_session.new_session()
+
+        def pooled(url):
+            session.get(url, verify=verify).raise_for_status()
+
+        try:
+            for workers in (1, 8):
+                for name, get in (('new connection per request', unpooled), ('pooled session', pooled)):
+                    start = time.perf_counter()
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                        list(executor.map(get, urls))
+                    elapsed = time.perf_counter() - start
+                    print('%d thread(s), %-27s %7.0f requests/s' % (workers, name + ':', len(urls) / elapsed))
+        finally:
+            session.close()
+            for server, _ in servers:
+                server.shutdown()
+                server.server_close()
+
+
+def _with_latency(latency, return_value=None):
+    def call(*args, **kwargs):
+        time.sleep(latency)
+        return return_value
+    return call
+
+
+def _mock_backends(latency):
+    """
+    Return a mock JIRA client and GitHub repo where every request takes 'latency' seconds
+    """
+    from unittest import mock
+
+    jira = mock.Mock()
+    issue = mock.Mock(key='TEST-1', id=1)
+    issue.fields.labels = []
+    issue.fields.components = []
+    issue.update.side_effect = _with_latency(latency)
+    link = mock.Mock(globalId='https://github.com/espressif/benchmark/issues/1', relationship='synced from',
+                     raw={'object': {'title': 'Issue', 'status': {}}})
+    link.update.side_effect = _with_latency(latency)
+    jira.create_issue.side_effect = _with_latency(latency, issue)
+    jira.search_issues.side_effect = _with_latency(latency, [issue])
+    jira.add_remote_link.side_effect = _with_latency(latency)
+    jira.remote_links.side_effect = _with_latency(latency, [link])
+    jira.add_comment.side_effect = _with_latency(latency)
+    jira.issue_types.return_value = []
+
+    repo = mock.Mock()
+    api_gh_issue = mock.Mock(title='Issue', labels=[])
+    api_gh_issue.edit.side_effect = _with_latency(latency)
+    repo.get_issue.side_effect = _with_latency(latency, api_gh_issue)
+    return jira, repo
+
+
+def benchmark_handlers(args):
+    """
+    Measure the latency of the issue handlers against mock JIRA and GitHub backends where every request takes
+    --latency milliseconds, with independent requests made at the same time and one after the other.
+    """
+    from unittest import mock
+    import sync_issue
+
+    def run_sequentially(*calls):
+        for call in calls:
+            call()
+
+    os.environ.setdefault('JIRA_PROJECT', 'TEST')
+    gh_issue = {'html_url': 'https://github.com/espressif/benchmark/issues/1', 'number': 1, 'title': 'Issue', 'body': 'Body',
+                'user': {'login': 'someone'}, 'labels': [], 'state': 'open'}
+    handlers = [
+        ('opened', sync_issue.handle_issue_opened, gh_issue),
+        ('edited', sync_issue.handle_issue_edited, gh_issue),
+        ('closed', sync_issue.handle_issue_closed, dict(gh_issue, state='closed')),
+    ]
+    for action, handler, issue in handlers:
+        event = {'action': action, 'issue': issue, 'sender': {'login': 'someone'}}
+        results = []
+        for in_parallel in (False, True):
+            jira, repo = _mock_backends(args.latency / 1000)
+            with mock.patch('sync_issue._get_repo', return_value=repo), mock.patch('sync_issue._get_jira_issue_index', return_value=None):
+                if not in_parallel:
+                    patcher = mock.patch('sync_issue._run_concurrently', run_sequentially)
+                    patcher.start()
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    handler(jira, event)
+                results.append((time.perf_counter() - start) / args.repeat)
+                if not in_parallel:
+                    patcher.stop()
+        print('%-7s one at a time %6.0f ms, concurrent %6.0f ms' % (action + ':', results[0] * 1000, results[1] * 1000))
+
+
+SCENARIO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_events')
+
+
+def _load_scenarios(names):
+    scenarios = {}
+    for file_name in sorted(os.listdir(SCENARIO_DIR)):
+        name = os.path.splitext(file_name)[0]
+        if file_name.endswith('.json') and (not names or name in names):
+            with open(os.path.join(SCENARIO_DIR, file_name), 'r') as f:
+                scenarios[name] = json.load(f)
+    return scenarios
+
+
+def benchmark_replay(args):
+    """
+    Replay the recorded events in benchmark_events/ through sync_to_jira.main(), against local fake JIRA and GitHub
+    servers which add --latency milliseconds to each response. Reports the time taken by main(), the requests
+    made to each endpoint and the peak memory use.
+
+    Each event runs in a new Python process, as it would in a GitHub Action. The fake servers start empty for each
+    repetition of a scenario.
+    """
+    if args.child:
+        _replay_child()
+        return
+
+    results = OrderedDict()
+    for name, scenario in _load_scenarios(args.scenario).items():
+        runs = [_replay_scenario(scenario, args.latency / 1000) for _ in range(args.repeat)]
+        wall_time = sorted(run['wall_s'] for run in runs)[len(runs) // 2]
+        results[name] = {'wall_s': wall_time, 'max_rss_kb': max(run['max_rss_kb'] for run in runs), 'requests': runs[-1]['requests']}
+        print('%s: %s' % (name, scenario['description']))
+        print('  %d events, %.0f ms in main() (median of %d), peak memory %.1f MB' % (
+            len(scenario['events']), wall_time * 1000, len(runs), results[name]['max_rss_kb'] / 1024))
+        for endpoint, count in sorted(results[name]['requests'].items()):
+            print('  %5d  %s' % (count, endpoint))
+        print('  %5d  requests in total' % sum(results[name]['requests'].values()))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+def _replay_scenario(scenario, latency):
+    from fake_api_server import FakeGitHubServer, FakeJiraServer
+
+    jira_server = FakeJiraServer(latency).start()
+    github_server = FakeGitHubServer('espressif/benchmark', latency).start()
+    try:
+        github_server.collaborators.update(scenario.get('collaborators', []))
+        number = 100
+        for group in scenario.get('open_pull_requests', []):
+            for _ in range(group['count']):
+                number += 1
+                github_server.add_pull_request(number, group['login'], group.get('comments', 0))
+
+        env = dict(os.environ, JIRA_URL=jira_server.url, JIRA_USER='benchmark', JIRA_PASS='benchmark', JIRA_PROJECT=FakeJiraServer.PROJECT,
+                   GITHUB_TOKEN='benchmark', GITHUB_REPOSITORY='espressif/benchmark', GITHUB_API_URL=github_server.url,
+                   GITHUB_GRAPHQL_URL=github_server.url + '/graphql')
+        for variable in ('JIRA_COMPONENT', 'JIRA_SYNC_CACHE_DIR', 'INPUT_CRON_JOB', 'INPUT_EVENT_QUEUE'):
+            env.pop(variable, None)
+        env.update(scenario.get('env', {}))
+
+        wall_time, max_rss = 0, 0
+        for queued in scenario['events']:
+            gh_issue = queued['event'].get('issue') or queued['event'].get('pull_request')
+            if gh_issue is not None:
+                github_server.add_issue(gh_issue)
+            with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+                json.dump(queued['event'], f)
+            try:
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__), 'replay', '--child'],
+                                                 env=dict(env, GITHUB_EVENT_NAME=queued['event_name'], GITHUB_EVENT_PATH=f.name),
+                                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+            finally:
+                os.unlink(f.name)
+            result = json.loads(output.decode().splitlines()[-1])
+            wall_time += result['wall_s']
+            max_rss = max(max_rss, result['max_rss_kb'])
+
+        requests = dict(('JIRA %s' % endpoint, count) for endpoint, count in jira_server.requests.items())
+        requests.update(('GitHub %s' % endpoint, count) for endpoint, count in github_server.requests.items())
+        return {'wall_s': wall_time, 'max_rss_kb': max_rss, 'requests': requests}
+    finally:
+        jira_server.stop()
+        github_server.stop()
+
+
+def _replay_child():
+    import resource
+
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            import sync_to_jira
+            start = time.perf_counter()
+            sync_to_jira.main()
+            done = time.perf_counter()
+        finally:
+            sys.stdout = stdout
+    print(json.dumps({'wall_s': done - start, 'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+BENCHMARKS = {
+    'handlers': benchmark_handlers,
+    'http': benchmark_http,
+    'markdown': benchmark_markdown,
+    'replay': benchmark_replay,
+    'startup': benchmark_startup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, help='Number of times to repeat measurements (default 100, or 3 for replay)')
+    parser.add_argument('--latency', type=float, default=50, help='Latency of each mock request in ms (handlers and replay benchmarks)')
+    parser.add_argument('--scenario', action='append', help='Name of a scenario in benchmark_events/ to replay (default all)')
+    parser.add_argument('--output', help='File to write the replay results to, as JSON')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.repeat is None:
+        args.repeat = 3 if args.benchmark == 'replay' else 100
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
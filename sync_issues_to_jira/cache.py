@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+#
+# Copyright 2019 Espressif Systems (Shanghai) PTE LTD
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Caches shared by the sync handlers.
+
+Persistent caches are only used if the JIRA_SYNC_CACHE_DIR environment variable is set. The
+directory can be kept between workflow runs with actions/cache.
+"""
+from collections import OrderedDict
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+def cache_dir(name):
+    """
+    Return the path of the named persistent cache directory (creating it if needed), or None
+    if persistent caching is not enabled.
+    """
+    base = os.environ.get('JIRA_SYNC_CACHE_DIR')
+    if not base:
+        return None
+    path = os.path.join(base, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cache_file(name):
+    """
+    Return the path of the named persistent cache file, or None if persistent caching is not enabled.
+    """
+    base = os.environ.get('JIRA_SYNC_CACHE_DIR')
+    if not base:
+        return None
+    os.makedirs(base, exist_ok=True)
+    return os.path.join(base, name)
+
+
+def write_file_atomic(path, contents):
+    """
+    Write a text file so that concurrent readers never see a partially written file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+class LRUCache(object):
+    """
+    In-memory cache holding at most 'size' items, discarding the least recently used.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+                return self._items[key]
+            except KeyError:
+                return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class DiskCache(object):
+    """
+    Persistent cache of text values, one file per key. Keys must be safe to use as file names
+    (for example a hex digest).
+
+    At most 'max_entries' files are kept. Reading a value marks its file as recently used, and the
+    least recently used files are deleted when a new value is written.
+    """
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+
+    def get(self, key):
+        path = os.path.join(self.path, key)
+        try:
+            with open(path, 'r') as f:
+                value = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass  # evicted by another run meanwhile
+        return value
+
+    def put(self, key, value):
+        try:
+            write_file_atomic(os.path.join(self.path, key), value)
+            self._evict()
+        except (IOError, OSError) as e:
+            print("WARNING: Failed to write cache file: %s" % e)
+
+    def _evict(self):
+        names = [name for name in os.listdir(self.path) if not name.startswith('.tmp')]
+        if len(names) <= self.max_entries:
+            return
+        used = []
+        for name in names:
+            try:
+                used.append((os.path.getmtime(os.path.join(self.path, name)), name))
+            except OSError:
+                pass
+        for _, name in sorted(used)[:len(used) - self.max_entries]:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+
+class JsonFileCache(object):
+    """
+    Persistent cache of JSON-serializable values, all stored in one file. Values older than 'ttl'
+    seconds are ignored (if ttl is None, values never expire).
+    """
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                self._items = json.load(f)
+        except (IOError, OSError, ValueError):
+            self._items = {}
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None or (self.ttl is not None and time.time() - item['time'] > self.ttl):
+            return None
+        return item['value']
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def put_many(self, items):
+        with self._lock:
+            now = time.time()
+            for key, value in items.items():
+                self._items[key] = {'time': now, 'value': value}
+            self._save()
+
+    def delete(self, key):
+        with self._lock:
+            if self._items.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        try:
+            write_file_atomic(self.path, json.dumps(self._items))
+        except (IOError, OSError) as e:
+            print("WARNING: Failed to write cache file: %s" % e)
+
+
+class JiraMetadata(object):
+    """
+    JIRA metadata which doesn't change during a run (issue types and project components). Each
+    item is fetched from JIRA on first use and then shared by all handlers.
+
+    If persistent caching is enabled, the metadata is also kept for JIRA_METADATA_CACHE_TTL seconds
+    (default 1 day) so that later runs don't fetch it again.
+    """
+    def __init__(self, jira):
+        self.jira = jira
+        self._label_issue_types = None
+        self._components = {}
+        path = cache_file('jira_metadata.json')
+        ttl = int(os.environ.get('JIRA_METADATA_CACHE_TTL', 24 * 60 * 60))
+        self._file_cache = JsonFileCache(path, ttl) if path else None
+
+    def issue_type_for_label(self, label):
+        """
+        Return the (id, name) of the issue type matching the label, or None. The label matches
+        if it is the issue type name or "Type: <issue type name>" (case insensitive).
+        """
+        if self._label_issue_types is None:
+            issue_types = self._cached('issue_types', lambda: [(t.id, t.name) for t in self.jira.issue_types()])
+            self._label_issue_types = {}
+            for type_id, type_name in issue_types:
+                for type_label in (type_name.lower(), 'type: %s' % type_name.lower()):
+                    self._label_issue_types.setdefault(type_label, (type_id, type_name))
+        return self._label_issue_types.get(label.lower())
+
+    def component_names(self, project_key):
+        """
+        Return the names of the components in the JIRA project
+        """
+        if project_key not in self._components:
+            self._components[project_key] = self._cached(
+                'components:%s' % project_key, lambda: [c.name for c in self.jira.project_components(project_key)])
+        return self._components[project_key]
+
+    def _cached(self, key, fetch):
+        value = self._file_cache.get(key) if self._file_cache else None
+        if value is None:
+            value = fetch()
+            if self._file_cache:
+                self._file_cache.put(key, value)
+        return value
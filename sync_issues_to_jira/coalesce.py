@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+#
+# Copyright 2019 Espressif Systems (Shanghai) PTE LTD
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Sync a queue of GitHub events, merging the events for each issue into as few JIRA operations as possible.
+
+GitHub often sends several events for one issue within seconds (for example opened, labeled and
+edited). Handled one at a time, each event looks up the JIRA issue and writes to it. Here all the
+events for an issue are handled together: an issue opened in the queue is created once with its
+final title, description and labels, and an existing issue gets at most one update request.
+"""
+from collections import OrderedDict
+import glob
+import json
+import os
+
+from sync_issue import (
+    _IssueUpdate,
+    _add_jira_comment,
+    _check_issue_label,
+    _create_jira_issue,
+    _find_jira_issue,
+    _get_description,
+    _get_issue_event_comment,
+    _get_jira_label,
+    _get_repo,
+    _get_summary,
+    _is_collaborator,
+    _leave_comment_deleted,
+    _leave_jira_issue_comment,
+    _remove_unchanged_fields,
+    _run_concurrently,
+    _update_components_field,
+    _update_jira_comment,
+    _update_link_resolved,
+    handle_issue_deleted,
+)
+from tracing import traced
+
+ISSUE_ACTIONS = ('opened', 'edited', 'closed', 'deleted', 'reopened', 'labeled', 'unlabeled')
+COMMENT_ACTIONS = ('created', 'edited', 'deleted')
+
+
+def normalize_event(event_name, event):
+    """
+    Return the event name and event to sync. Pull request events are treated just like issues events
+    (the 'pull_request' key in the "issue" tells if this is an issue or a PR).
+    """
+    if event_name == 'pull_request':
+        event_name = 'issues'
+        event["issue"] = event["pull_request"]
+        if "pull_request" not in event["issue"]:
+            event["issue"]["pull_request"] = True  # we don't care about the value
+    return event_name, event
+
+
+@traced
+def sync_event_queue(jira, path):
+    """
+    Sync all the events in the queue directory 'path', then remove them.
+
+    Each file "*.json" in the directory holds one event as {"event_name": ..., "event": ...}. Files are
+    read in order of their names, so they should be named in the order the events were received (for
+    example by timestamp). The files for an issue which fails to sync are kept for the next run.
+    """
+    files = sorted(glob.glob(os.path.join(path, '*.json')))
+    events = []
+    for event_file in files:
+        with open(event_file, 'r') as f:
+            queued = json.load(f)
+        events.append((event_file,) + normalize_event(queued["event_name"], queued["event"]))
+    print('Syncing %d queued events' % len(events))
+
+    groups, skipped = coalesce_events(events)
+    for event_file in skipped:
+        os.remove(event_file)
+
+    failed = []
+    for group in groups:
+        try:
+            sync_coalesced_events(jira, group)
+        except Exception as e:
+            print('Failed to sync events for %s: %s' % (group["issue"]["html_url"], e))
+            failed.append(e)
+            continue
+        for event_file in group["files"]:
+            os.remove(event_file)
+
+    if failed:
+        raise failed[0]
+
+
+def coalesce_events(events):
+    """
+    Group a list of (file, event name, event) by GitHub issue, in the order each issue was first seen.
+
+    Returns a list of groups and a list of the files holding events which aren't synced. Each group is a
+    dict with the latest state of the GitHub issue and the changes to make:
+
+    - "opened", "deleted", "edited": the last event of the kind, or None.
+    - "state": the last closed or reopened event, or None if the issue ends up in the state it started in.
+    - "labels": dict of JIRA label to True (added) or False (removed).
+    - "comments": OrderedDict of GitHub comment ID to (action, last event for the comment), where
+      a comment created and then deleted is left out, and one created then edited is "created".
+    """
+    groups = OrderedDict()
+    skipped = []
+    for event_file, event_name, event in events:
+        action = event.get("action")
+        if (event_name, action) not in [('issues', a) for a in ISSUE_ACTIONS] + [('issue_comment', a) for a in COMMENT_ACTIONS]:
+            print("No handler for event '%s' action '%s'. Skipping." % (event_name, action))
+            skipped.append(event_file)
+            continue
+
+        url = event["issue"]["html_url"]
+        if url not in groups:
+            groups[url] = {"files": [], "issue": None, "opened": None, "deleted": None, "edited": None, "state": None,
+                           "first_state": None, "labels": OrderedDict(), "comments": OrderedDict(), "should_create": False}
+        group = groups[url]
+        group["files"].append(event_file)
+        group["issue"] = event["issue"]  # the last event has the latest state
+
+        if event_name == 'issue_comment':
+            group["should_create"] = True
+            _coalesce_comment(group["comments"], action, event)
+        elif action in ('opened', 'deleted', 'edited'):
+            group[action] = event
+            group["should_create"] = group["should_create"] or action == 'edited'
+        elif action in ('closed', 'reopened'):
+            group["first_state"] = group["first_state"] or action
+            group["state"] = event
+            group["should_create"] = group["should_create"] or action == 'reopened'
+        else:
+            label = _get_jira_label(event["label"])
+            if _check_issue_label(label) is not None:
+                group["labels"][label] = action == 'labeled'
+
+    for group in groups.values():
+        # a closed and reopened issue (or the other way around) is back where it started
+        if group["state"] is not None and group["state"]["action"] != group["first_state"]:
+            group["state"] = None
+        del group["first_state"]
+        group["should_create"] = group["should_create"] or (bool(group["labels"]) and group["issue"]["state"] == "open")
+    return list(groups.values()), skipped
+
+
+def _coalesce_comment(comments, action, event):
+    comment_id = event["comment"]["id"]
+    previous = comments.get(comment_id, (None, None))[0]
+    if previous == 'created' and action == 'deleted':
+        del comments[comment_id]  # never synced, nothing to do
+    elif previous == 'created':
+        comments[comment_id] = ('created', event)
+    elif previous == 'deleted':
+        pass  # nothing can happen to a deleted comment
+    else:
+        comments[comment_id] = (action, event)
+
+
+@traced
+def sync_coalesced_events(jira, group):
+    """
+    Apply the changes for one group of events from coalesce_events() to JIRA
+    """
+    gh_issue = group["issue"]
+    if "pull_request" in gh_issue and _is_collaborator(_get_repo(), gh_issue["user"]["login"]):
+        print("Skipping issue sync for Pull Request from collaborator")
+        return
+
+    if group["deleted"] is not None:
+        handle_issue_deleted(jira, group["deleted"])  # nothing else matters for a deleted issue
+        return
+
+    if group["opened"] is not None:
+        print('Creating new JIRA issue for new GitHub issue (%d events)' % len(group["files"]))
+        jira_issue = _create_jira_issue(jira, gh_issue)  # already has the latest fields, labels and state
+    else:
+        jira_issue = _find_jira_issue(jira, gh_issue, group["should_create"])
+        if jira_issue is None:
+            return
+        _update_jira_issue(jira, group, jira_issue)
+
+    if group["state"] is not None:
+        _leave_jira_issue_comment(jira, group["state"], group["state"]["action"], False, jira_issue=jira_issue)
+
+    for action, event in group["comments"].values():
+        if action == 'created':
+            _add_jira_comment(jira, jira_issue, event["comment"])
+        elif action == 'edited':
+            _update_jira_comment(jira, jira_issue, event["comment"])
+        else:
+            _leave_comment_deleted(jira, jira_issue, event["comment"])
+
+
+def _update_jira_issue(jira, group, jira_issue):
+    """
+    Update an existing JIRA issue with all the edits, label changes and the edited comment in the group, in one request.
+    """
+    gh_issue = group["issue"]
+    update = _IssueUpdate(jira_issue)
+    if group["edited"] is not None:
+        update.fields["description"] = _get_description(gh_issue)
+        update.fields["summary"] = _get_summary(gh_issue)
+        _update_components_field(jira, update.fields, jira_issue)
+        _remove_unchanged_fields(jira_issue, update.fields)
+        if "description" in update.fields or "summary" in update.fields:
+            update.add_comment(_get_issue_event_comment(group["edited"], "edited"))
+
+    for label, added in group["labels"].items():
+        if added:
+            update.add_label(label)
+        else:
+            update.remove_label(label)
+
+    calls = [update.send]
+    if group["edited"] is not None or group["state"] is not None:
+        calls.append(lambda: _update_link_resolved(jira, gh_issue, jira_issue))
+    _run_concurrently(*calls)
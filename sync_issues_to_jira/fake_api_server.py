@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+#
+# Copyright 2019 Espressif Systems (Shanghai) PTE LTD
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Local HTTP stand-ins for the JIRA REST API and the GitHub REST and GraphQL APIs, for benchmarks.
+
+Only the requests made by the sync are implemented, with just enough of each resource for the JIRA
+and GitHub clients. State is kept in memory. Each server counts the requests it receives by
+endpoint (for example "GET /rest/api/2/issue/{key}") and can add a fixed latency to every response.
+"""
+from collections import Counter, OrderedDict
+import http.server
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+
+class _FakeServer(http.server.ThreadingHTTPServer):
+    """
+    Base class for the fake API servers. Subclasses list their ROUTES as (method, path template,
+    handler method name), where "{name}" in a template matches one path segment.
+    """
+    daemon_threads = True
+    ROUTES = []
+
+    def __init__(self, latency=0):
+        super().__init__(('127.0.0.1', 0), _FakeHandler)
+        self.latency = latency
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self._routes = [(method, template, re.compile('^' + re.sub(r'\{\w+\}', '([^/]+)', template) + '$'), handler)
+                        for method, template, handler in self.ROUTES]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def dispatch(self, method, path, query, body):
+        """
+        Return (status, JSON-serializable response or None) for a request
+        """
+        for route_method, template, pattern, handler in self._routes:
+            m = pattern.match(path)
+            if m and route_method == method:
+                with self.lock:
+                    self.requests['%s %s' % (method, template)] += 1
+                    return getattr(self, handler)(query, body, *[urllib.parse.unquote(g) for g in m.groups()])
+        with self.lock:
+            self.requests['%s %s (not found)' % (method, path)] += 1
+        return 404, {'message': 'Not Found', 'errorMessages': ['Not implemented by the fake server']}
+
+
+class _FakeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        url = urllib.parse.urlsplit(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        status, response = self.server.dispatch(self.command, url.path, urllib.parse.parse_qs(url.query), body)
+        data = json.dumps(response).encode() if response is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('X-RateLimit-Limit', '5000')
+        self.send_header('X-RateLimit-Remaining', '4999')
+        self.send_header('X-RateLimit-Reset', str(int(time.time()) + 3600))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeJiraServer(_FakeServer):
+    """
+    Fake JIRA server with one project, PROJECT, and the issue types in ISSUE_TYPES
+    """
+    PROJECT = 'TEST'
+    ISSUE_TYPES = ['Task', 'Bug', 'New Feature']
+    ROUTES = [
+        ('GET', '/rest/api/2/serverInfo', '_server_info'),
+        ('GET', '/rest/api/2/field', '_fields'),
+        ('GET', '/rest/api/2/issuetype', '_issue_types'),
+        ('GET', '/rest/api/2/project/{key}', '_project'),
+        ('GET', '/rest/api/2/project/{key}/components', '_components'),
+        ('GET', '/rest/api/2/search', '_search'),
+        ('POST', '/rest/api/2/issue', '_create_issue'),
+        ('POST', '/rest/api/2/issue/bulk', '_create_issues'),
+        ('GET', '/rest/api/2/issue/{key}', '_get_issue'),
+        ('PUT', '/rest/api/2/issue/{key}', '_update_issue'),
+        ('GET', '/rest/api/2/issue/{key}/remotelink', '_remote_links'),
+        ('POST', '/rest/api/2/issue/{key}/remotelink', '_add_remote_link'),
+        ('GET', '/rest/api/2/issue/{key}/remotelink/{link_id}', '_remote_link'),
+        ('PUT', '/rest/api/2/issue/{key}/remotelink/{link_id}', '_update_remote_link'),
+        ('GET', '/rest/api/2/issue/{key}/comment', '_comments'),
+        ('POST', '/rest/api/2/issue/{key}/comment', '_add_comment'),
+        ('GET', '/rest/api/2/issue/{key}/comment/{comment_id}', '_comment'),
+        ('PUT', '/rest/api/2/issue/{key}/comment/{comment_id}', '_update_comment'),
+    ]
+
+    def __init__(self, latency=0):
+        super().__init__(latency)
+        self.issues = OrderedDict()  # key to issue, each with "links" and "comments" lists
+        self._next_id = 10000
+
+    def _new_id(self):
+        self._next_id += 1
+        return str(self._next_id)
+
+    def _find(self, key):
+        for issue in self.issues.values():
+            if key in (issue['key'], issue['id']):
+                return issue
+        return None
+
+    def _issue_json(self, issue):
+        return {'id': issue['id'], 'key': issue['key'], 'self': '%s/rest/api/2/issue/%s' % (self.url, issue['id']),
+                'fields': issue['fields']}
+
+    def _server_info(self, query, body):
+        return 200, {'baseUrl': self.url, 'version': '8.20.0', 'versionNumbers': [8, 20, 0], 'deploymentType': 'Server'}
+
+    def _fields(self, query, body):
+        return 200, []
+
+    def _issue_types(self, query, body):
+        return 200, [{'id': str(i + 1), 'name': name, 'self': '%s/rest/api/2/issuetype/%d' % (self.url, i + 1)}
+                     for i, name in enumerate(self.ISSUE_TYPES)]
+
+    def _project(self, query, body, key):
+        if key != self.PROJECT:
+            return 404, {'errorMessages': ['No project could be found with key \'%s\'.' % key]}
+        return 200, {'id': '1', 'key': key, 'name': key, 'self': '%s/rest/api/2/project/1' % self.url}
+
+    def _components(self, query, body, key):
+        return 200, []
+
+    def _search(self, query, body):
+        jql = query.get('jql', [''])[0]
+        urls = re.findall(r'"([^"]+)"', jql) if 'issuesWithRemoteLinksByGlobalId' in jql else []
+        found = [self._issue_json(issue) for issue in reversed(list(self.issues.values()))
+                 if any(link['globalId'] in urls for link in issue['links'])]
+        return 200, {'startAt': 0, 'maxResults': len(found), 'total': len(found), 'issues': found}
+
+    def _new_issue(self, fields):
+        issue_id = self._new_id()
+        key = '%s-%d' % (self.PROJECT, len(self.issues) + 1)
+        issue_type = fields.get('issuetype') or {'id': '1'}
+        stored = {'summary': fields.get('summary'), 'description': fields.get('description'), 'labels': list(fields.get('labels', [])),
+                  'components': list(fields.get('components', [])), 'project': {'id': '1', 'key': self.PROJECT},
+                  'issuetype': {'id': issue_type.get('id', '1'), 'name': issue_type.get('name', self.ISSUE_TYPES[0])},
+                  'status': {'name': 'Open'}}
+        self.issues[key] = {'id': issue_id, 'key': key, 'fields': stored, 'links': [], 'comments': []}
+        return {'id': issue_id, 'key': key, 'self': '%s/rest/api/2/issue/%s' % (self.url, issue_id)}
+
+    def _create_issue(self, query, body):
+        return 201, self._new_issue(body['fields'])
+
+    def _create_issues(self, query, body):
+        return 201, {'issues': [self._new_issue(update['fields']) for update in body['issueUpdates']], 'errors': []}
+
+    def _get_issue(self, query, body, key):
+        issue = self._find(key)
+        if issue is None:
+            return 404, {'errorMessages': ['Issue Does Not Exist']}
+        return 200, self._issue_json(issue)
+
+    def _update_issue(self, query, body, key):
+        issue = self._find(key)
+        if issue is None:
+            return 404, {'errorMessages': ['Issue Does Not Exist']}
+        issue['fields'].update(body.get('fields') or {})
+        for name, verbs in (body.get('update') or {}).items():
+            for verb in verbs:
+                if name == 'comment':
+                    self._new_comment(issue, verb['add']['body'])
+                elif 'add' in verb and verb['add'] not in issue['fields'][name]:
+                    issue['fields'][name].append(verb['add'])
+                elif 'remove' in verb and verb['remove'] in issue['fields'][name]:
+                    issue['fields'][name].remove(verb['remove'])
+        return 204, None
+
+    def _link_json(self, issue, link):
+        return dict(link, self='%s/rest/api/2/issue/%s/remotelink/%s' % (self.url, issue['key'], link['id']))
+
+    def _remote_links(self, query, body, key):
+        issue = self._find(key)
+        return 200, [self._link_json(issue, link) for link in issue['links']]
+
+    def _add_remote_link(self, query, body, key):
+        issue = self._find(key)
+        link = {'id': int(self._new_id()), 'globalId': body.get('globalId'), 'relationship': body.get('relationship'), 'object': body['object']}
+        issue['links'].append(link)
+        return 201, {'id': link['id'], 'self': self._link_json(issue, link)['self']}
+
+    def _find_link(self, key, link_id):
+        issue = self._find(key)
+        return issue, next(link for link in issue['links'] if str(link['id']) == link_id)
+
+    def _remote_link(self, query, body, key, link_id):
+        issue, link = self._find_link(key, link_id)
+        return 200, self._link_json(issue, link)
+
+    def _update_remote_link(self, query, body, key, link_id):
+        issue, link = self._find_link(key, link_id)
+        link.update(body)
+        return 204, None
+
+    def _comment_json(self, issue, comment):
+        return dict(comment, self='%s/rest/api/2/issue/%s/comment/%s' % (self.url, issue['id'], comment['id']))
+
+    def _new_comment(self, issue, body):
+        comment = {'id': self._new_id(), 'body': body}
+        issue['comments'].append(comment)
+        return comment
+
+    def _comments(self, query, body, key):
+        issue = self._find(key)
+        comments = [self._comment_json(issue, comment) for comment in issue['comments']]
+        return 200, {'startAt': 0, 'maxResults': len(comments), 'total': len(comments), 'comments': comments}
+
+    def _add_comment(self, query, body, key):
+        issue = self._find(key)
+        return 201, self._comment_json(issue, self._new_comment(issue, body['body']))
+
+    def _find_comment(self, key, comment_id):
+        issue = self._find(key)
+        return issue, next((comment for comment in issue['comments'] if comment['id'] == comment_id), None)
+
+    def _comment(self, query, body, key, comment_id):
+        issue, comment = self._find_comment(key, comment_id)
+        if comment is None:
+            return 404, {'errorMessages': ['Can not find a comment for the id: %s.' % comment_id]}
+        return 200, self._comment_json(issue, comment)
+
+    def _update_comment(self, query, body, key, comment_id):
+        issue, comment = self._find_comment(key, comment_id)
+        comment['body'] = body['body']
+        return 200, self._comment_json(issue, comment)
+
+
+class FakeGitHubServer(_FakeServer):
+    """
+    Fake GitHub server for one repository. Its issues and pull requests are added with add_issue() and
+    add_pull_request(), and its collaborators are listed in 'collaborators'.
+    """
+    ROUTES = [
+        ('GET', '/rate_limit', '_rate_limit'),
+        ('POST', '/graphql', '_graphql'),
+        ('GET', '/repos/{owner}/{repo}', '_repo'),
+        ('GET', '/repos/{owner}/{repo}/collaborators', '_collaborators'),
+        ('GET', '/repos/{owner}/{repo}/collaborators/{login}', '_is_collaborator'),
+        ('GET', '/repos/{owner}/{repo}/issues', '_issues'),
+        ('GET', '/repos/{owner}/{repo}/issues/{number}', '_get_issue'),
+        ('PATCH', '/repos/{owner}/{repo}/issues/{number}', '_edit_issue'),
+        ('POST', '/repos/{owner}/{repo}/issues/{number}/labels', '_add_labels'),
+        ('DELETE', '/repos/{owner}/{repo}/issues/{number}/labels/{name}', '_remove_label'),
+    ]
+
+    def __init__(self, repository, latency=0):
+        super().__init__(latency)
+        self.repository = repository
+        self.issues = OrderedDict()  # number to issue (or pull request), in the format of the REST API
+        self.pull_requests = []  # GraphQL PullRequest nodes, newest first
+        self.collaborators = set()
+
+    def add_issue(self, gh_issue):
+        """
+        Add an issue (or PR) in the format of a webhook event payload, if there isn't one with its number yet
+        """
+        with self.lock:
+            if gh_issue['number'] not in self.issues:
+                issue = json.loads(json.dumps(gh_issue))
+                issue['url'] = '%s/repos/%s/issues/%d' % (self.url, self.repository, gh_issue['number'])
+                self.issues[gh_issue['number']] = issue
+
+    def add_pull_request(self, number, login, comments=0, labels=()):
+        """
+        Add an open pull request, which is returned by the GraphQL open PRs query
+        """
+        with self.lock:
+            self.pull_requests.insert(0, {
+                'number': number, 'title': 'Pull request %d' % number, 'body': 'Changes',
+                'url': 'https://github.com/%s/pull/%d' % (self.repository, number), 'state': 'OPEN',
+                'updatedAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'authorAssociation': 'CONTRIBUTOR',
+                'author': {'__typename': 'User', 'login': login}, 'labels': {'nodes': [{'name': name} for name in labels]},
+                'comments': {'totalCount': comments}})
+        self.add_issue({'number': number, 'title': 'Pull request %d' % number, 'body': 'Changes', 'labels': [], 'state': 'open',
+                        'user': {'login': login}, 'pull_request': {}, 'html_url': 'https://github.com/%s/pull/%d' % (self.repository, number)})
+
+    def _rate_limit(self, query, body):
+        limit = {'limit': 5000, 'remaining': 4999, 'reset': int(time.time()) + 3600, 'used': 1}
+        return 200, {'resources': {'core': limit, 'search': limit, 'graphql': limit}, 'rate': limit}
+
+    def _graphql(self, query, body):
+        variables = body['variables']
+        start = int(variables.get('after') or 0)
+        nodes = self.pull_requests[start:start + variables['first']]
+        end = start + len(nodes)
+        page_info = {'hasNextPage': end < len(self.pull_requests), 'endCursor': str(end)}
+        return 200, {'data': {'repository': {'pullRequests': {'pageInfo': page_info, 'nodes': nodes}}}}
+
+    def _repo(self, query, body, owner, repo):
+        return 200, {'id': 1, 'name': repo, 'full_name': '%s/%s' % (owner, repo), 'url': '%s/repos/%s/%s' % (self.url, owner, repo)}
+
+    def _collaborators(self, query, body, owner, repo):
+        return 200, [{'login': login, 'id': i + 1} for i, login in enumerate(sorted(self.collaborators))]
+
+    def _is_collaborator(self, query, body, owner, repo, login):
+        return (204 if login in self.collaborators else 404), None
+
+    def _issues(self, query, body, owner, repo):
+        return 200, sorted(self.issues.values(), key=lambda issue: -issue['number'])
+
+    def _get_issue(self, query, body, owner, repo, number):
+        issue = self.issues.get(int(number))
+        if issue is None:
+            return 404, {'message': 'Not Found'}
+        return 200, issue
+
+    def _edit_issue(self, query, body, owner, repo, number):
+        issue = self.issues[int(number)]
+        issue.update(body)
+        return 200, issue
+
+    def _add_labels(self, query, body, owner, repo, number):
+        issue = self.issues[int(number)]
+        for name in body:
+            if name not in [label['name'] for label in issue['labels']]:
+                issue['labels'].append({'name': name})
+        return 200, issue['labels']
+
+    def _remove_label(self, query, body, owner, repo, number, name):
+        issue = self.issues[int(number)]
+        issue['labels'] = [label for label in issue['labels'] if label['name'] != name]
+        return 200, issue['labels']
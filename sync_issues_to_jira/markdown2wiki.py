@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+#
+# Copyright 2019 Espressif Systems (Shanghai) PTE LTD
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+In-process conversion of GitHub flavoured Markdown to JIRA wiki format.
+
+This follows the rendering rules of markdown2confluence (https://github.com/Shogobg/markdown2confluence),
+which renders the token stream of the "marked" Markdown parser, so that issues synced with either
+converter look the same in JIRA.
+"""
+import re
+import sys
+
+# Bump this whenever the output changes, so that cached conversions are not reused
+VERSION = 1
+
+# Code blocks longer than this are collapsed by default in JIRA
+MAX_CODE_LINES = 20
+
+# Languages supported by the JIRA {code} macro, anything else is rendered as 'none'
+CODE_LANGUAGES = dict((lang, lang) for lang in (
+    'actionscript3 bash csharp coldfusion cpp css delphi diff erlang groovy java javafx javascript '
+    'perl php none powershell python ruby scala sql vb html/xml').split())
+CODE_LANGUAGES.update({'shell': 'bash', 'html': 'html', 'xml': 'xml'})
+
+_BULLET = r'(?:[*+-]|\d+\.)'
+
+_BLANK_RE = re.compile(r'^\s*$')
+_FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})[ .]*(\S+)? *$')
+_INDENTED_CODE_RE = re.compile(r'^ {4}')
+_HEADING_RE = re.compile(r'^ *(#{1,6}) +(.+?) *#* *$')
+_LHEADING_RE = re.compile(r'^ *(=|-){2,} *$')
+_HR_RE = re.compile(r'^( *[-*_]){3,} *$')
+_BLOCKQUOTE_RE = re.compile(r'^ *> ?')
+_LIST_ITEM_RE = re.compile(r'^( *)(' + _BULLET + r') +(.*)$')
+_EMPTY_LIST_ITEM_RE = re.compile(r'^( *)(' + _BULLET + r')$')
+_TABLE_DELIMITER_RE = re.compile(r'^ *\|? *:?-+:? *(\| *:?-+:? *)*\|? *$')
+_DEF_RE = re.compile(r'^ *\[([^\]]+)\]: *<?([^\s>]+)>?(?: +["(]([^\n]+)[")])? *$')
+_HTML_COMMENT_RE = re.compile(r'^ *<!--')
+_HTML_BLOCK_RE = re.compile(
+    r'^ *</?(?!(?:a|em|strong|small|s|cite|q|dfn|abbr|data|time|code|var|samp|kbd|sub|sup|i|b|u|mark|ruby|rt|rp|'
+    r'bdi|bdo|span|br|wbr|ins|del|img)\b)[a-zA-Z][\w-]*(?:\s[^>]*)?/?>')
+
+# Rules without a regex are matched by _InlineScanner, as their regex takes quadratic time on some input
+_INLINE_RULES = [
+    ('escape', re.compile(r'\\([\\`*{}\[\]()#+\-.!_>~|])')),
+    ('autolink', None),
+    ('url', re.compile(r'(https?://[^\s<]+[^<.,:;"\')\]\s])')),
+    ('tag', None),
+    ('link', None),
+    ('reflink', None),
+    ('nolink', None),
+    ('strong', re.compile(r'__([\s\S]+?)__(?!_)|\*\*([\s\S]+?)\*\*(?!\*)')),
+    ('em', re.compile(r'\b_((?:[^_]|__)+?)_\b|\*((?:\*\*|[\s\S])+?)\*(?!\*)')),
+    ('code', re.compile(r'(`+)\s*([\s\S]*?[^`])\s*\1(?!`)')),
+    ('br', re.compile(r' {2,}\n(?!\s*\Z)')),
+    ('del', re.compile(r'~~(?=\S)([\s\S]*?\S)~~')),
+    ('text', re.compile(r'[\s\S]+?(?=[\\<!\[_*`~]|https?://| {2,}\n|\Z)')),
+]
+
+
+def markdown2wiki(markdown):
+    """
+    Convert a Markdown string to JIRA wiki format.
+    """
+    # same normalisation as the marked lexer
+    markdown = markdown.replace('\r\n', '\n').replace('\r', '\n').replace('\t', '    ').replace(' ', ' ')
+    if not markdown.endswith('\n'):
+        markdown += '\n'
+    lines = [('' if _BLANK_RE.match(line) else line) for line in markdown.split('\n')]
+
+    links = {}
+    tokens = _lex_blocks(lines, True, links)
+    return _render_blocks(tokens, links)
+
+
+def _lex_blocks(lines, top, links):
+    """
+    Split lines of Markdown into a list of block tokens. Link definitions found at the
+    top level are collected into the 'links' dict.
+    """
+    tokens = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        next_line = lines[i + 1] if i + 1 < len(lines) else ''
+
+        if not line:
+            i += 1
+            continue
+
+        if _INDENTED_CODE_RE.match(line):
+            code = []
+            while i < len(lines) and (not lines[i] or _INDENTED_CODE_RE.match(lines[i])):
+                code.append(lines[i][4:])
+                i += 1
+            tokens.append(('code', None, '\n'.join(code).rstrip('\n')))
+            continue
+
+        m = _FENCE_RE.match(line)
+        if m:
+            fence, lang = m.group(1), m.group(2)
+            closing = re.compile(r'^ {0,3}' + re.escape(fence[0]) + '{%d,} *$' % len(fence))
+            code = []
+            i += 1
+            while i < len(lines) and not closing.match(lines[i]):
+                code.append(lines[i])
+                i += 1
+            i += 1  # skip the closing fence
+            tokens.append(('code', lang, '\n'.join(code).rstrip()))
+            continue
+
+        m = _HEADING_RE.match(line)
+        if m:
+            tokens.append(('heading', len(m.group(1)), m.group(2)))
+            i += 1
+            continue
+
+        m = _LHEADING_RE.match(next_line)
+        if m and not _starts_block(line):
+            tokens.append(('heading', 1 if m.group(1) == '=' else 2, line.strip()))
+            i += 2
+            continue
+
+        if _HR_RE.match(line):
+            tokens.append(('hr',))
+            i += 1
+            continue
+
+        if _BLOCKQUOTE_RE.match(line):
+            quote = []
+            while i < len(lines) and lines[i] and not (quote and _starts_block(lines[i], quote=False)):
+                quote.append(_BLOCKQUOTE_RE.sub('', lines[i], count=1))
+                i += 1
+            tokens.append(('blockquote', _lex_blocks(quote, top, links)))
+            continue
+
+        if _LIST_ITEM_RE.match(line) or _EMPTY_LIST_ITEM_RE.match(line):
+            i = _lex_list(lines, i, tokens, links)
+            continue
+
+        if '|' in line and _TABLE_DELIMITER_RE.match(next_line) and '-' in next_line:
+            header = _split_table_row(line)
+            rows = []
+            i += 2
+            while i < len(lines) and '|' in lines[i]:
+                rows.append(_split_table_row(lines[i]))
+                i += 1
+            tokens.append(('table', header, rows))
+            continue
+
+        if _HTML_COMMENT_RE.match(line) or _HTML_BLOCK_RE.match(line):
+            html = []
+            in_comment = _HTML_COMMENT_RE.match(line) is not None
+            while i < len(lines) and (lines[i] or in_comment):
+                html.append(lines[i])
+                if '-->' in lines[i]:
+                    in_comment = False
+                i += 1
+            tokens.append(('html', '\n'.join(html)))
+            continue
+
+        m = _DEF_RE.match(line)
+        if m and top:
+            key = re.sub(r'\s+', ' ', m.group(1).lower())
+            links.setdefault(key, (m.group(2), m.group(3)))
+            i += 1
+            continue
+
+        # Anything else is a paragraph (or a text block inside a list item), which continues
+        # until a blank line or the start of another block
+        text = [line]
+        i += 1
+        while i < len(lines) and lines[i] and not _starts_block(lines[i]):
+            if i + 1 < len(lines) and _LHEADING_RE.match(lines[i + 1]):
+                break
+            text.append(lines[i])
+            i += 1
+        tokens.append(('paragraph' if top else 'text', '\n'.join(text)))
+
+    return tokens
+
+
+def _starts_block(line, quote=True):
+    """
+    Return True if the line would interrupt a paragraph
+    """
+    rules = [_FENCE_RE, _HEADING_RE, _HR_RE, _LIST_ITEM_RE, _HTML_COMMENT_RE, _HTML_BLOCK_RE]
+    if quote:
+        rules.append(_BLOCKQUOTE_RE)
+    return any(rule.match(line) for rule in rules)
+
+
+def _lex_list(lines, i, tokens, links):
+    """
+    Lex the list starting at lines[i], append a 'list' token and return the index of the next line.
+    """
+    m = _LIST_ITEM_RE.match(lines[i]) or _EMPTY_LIST_ITEM_RE.match(lines[i])
+    indent = len(m.group(1))
+    ordered = m.group(2)[-1] == '.'
+    items = []
+    while i < len(lines):
+        m = _LIST_ITEM_RE.match(lines[i]) or _EMPTY_LIST_ITEM_RE.match(lines[i])
+        if not m or len(m.group(1)) > indent + 1 or (m.group(2)[-1] == '.') != ordered:
+            break
+        content_indent = len(m.group(1)) + len(m.group(2)) + 1
+        item = [m.group(3) if m.lastindex >= 3 else '']
+        i += 1
+        while i < len(lines):
+            line = lines[i]
+            line_indent = len(line) - len(line.lstrip(' '))
+            if not line:
+                # a blank line ends the list unless the next content line is still part of it
+                following = next((ln for ln in lines[i:] if ln), None)
+                if following is None:
+                    break
+                following_indent = len(following) - len(following.lstrip(' '))
+                if following_indent <= indent and not _LIST_ITEM_RE.match(following):
+                    break
+                item.append('')
+            elif line_indent <= indent + 1 and (_LIST_ITEM_RE.match(line) or _EMPTY_LIST_ITEM_RE.match(line)):
+                break  # next item of this list, or the start of a different list
+            elif line_indent <= indent and (not item[-1] or _starts_block(line)):
+                break  # end of the list
+            else:
+                item.append(line[min(line_indent, content_indent):])
+            i += 1
+        while item and not item[-1]:
+            item.pop()
+        items.append(_lex_blocks(item, False, links))
+
+    tokens.append(('list', ordered, items))
+    return i
+
+
+def _split_table_row(line):
+    return re.split(r' *\| *', re.sub(r'^ *\|? *| *\|? *$', '', line))
+
+
+def _render_blocks(tokens, links):
+    out = []
+    for token in tokens:
+        kind = token[0]
+        if kind == 'paragraph':
+            out.append(_render_inline(token[1], links) + '\n\n')
+        elif kind == 'text':
+            out.append(_render_inline(token[1], links) + '\n')
+        elif kind == 'heading':
+            out.append('h%d. %s\n\n' % (token[1], _render_inline(token[2], links)))
+        elif kind == 'code':
+            out.append(_render_code(token[2], token[1]))
+        elif kind == 'hr':
+            out.append('----\n\n')
+        elif kind == 'blockquote':
+            out.append('{quote}%s{quote}\n\n' % _render_blocks(token[1], links))
+        elif kind == 'list':
+            out.append(_render_list(token[1], [_render_blocks(item, links) for item in token[2]]))
+        elif kind == 'table':
+            rows = [''.join('||' + _render_inline(cell, links) for cell in token[1])]
+            for row in token[2]:
+                rows.append(''.join('|' + _render_inline(cell, links) for cell in row))
+            out.append('\n'.join(rows) + '\n\n')
+        elif kind == 'html':
+            out.append(token[1] + '\n\n')
+    return ''.join(out)
+
+
+def _render_code(code, lang):
+    lang = CODE_LANGUAGES.get(lang.lower() if lang else None, 'none')
+    collapse = len(code.split('\n')) > MAX_CODE_LINES
+    return '{code:language=%s|borderStyle=solid|theme=RDark|linenumbers=true|collapse=%s}\n%s\n{code}\n\n' % (
+        lang, 'true' if collapse else 'false', code)
+
+
+def _render_list(ordered, items):
+    """
+    Every non-empty line of every item is prefixed with the list type. Lines which are
+    already list items (from a nested list) get one more level of nesting.
+    """
+    list_type = '#' if ordered else '*'
+    result = []
+    for item in items:
+        for line in item.split('\n'):
+            if not line.strip():
+                continue
+            if re.match(r'^[*#]+ ', line):
+                result.append(list_type + line)
+            else:
+                result.append(list_type + ' ' + line)
+    return '\n'.join(result) + '\n\n'
+
+
+def _escape(text, encode=False):
+    text = re.sub(r'&' if encode else r'&(?!#?\w+;)', '&amp;', text)
+    return text.replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace("'", '&#39;')
+
+
+def _render_link(href, title, text):
+    return '[%s|%s]' % (text, href) if text else '[%s]' % href
+
+
+def _render_inline(src, links, in_link=False):
+    out = []
+    scanner = _InlineScanner(src)
+    while src:
+        for name, rule in _INLINE_RULES:
+            m = rule.match(src) if rule else scanner.match(name, len(scanner.text) - len(src))
+            if m is None or (name in ('url', 'autolink') and in_link):
+                continue
+            if name == 'escape':
+                out.append(m.group(1))
+            elif name == 'autolink':
+                if m.group(2) == '@':
+                    text = _escape(m.group(1)[7:] if m.group(1).startswith('mailto:') else m.group(1))
+                    out.append(_render_link('mailto:' + text, None, text))
+                else:
+                    out.append(_render_link(_escape(m.group(1)), None, _escape(m.group(1))))
+            elif name == 'url':
+                out.append(_render_link(_escape(m.group(1)), None, _escape(m.group(1))))
+            elif name == 'tag':
+                out.append(m.group(0))
+            elif name == 'link':
+                out.append(_render_link_or_image(m.group(0), m.group(1), m.group(2), m.group(3), links))
+            elif name in ('reflink', 'nolink'):
+                key = m.group(2) if name == 'reflink' and m.group(2) else m.group(1)
+                link = links.get(re.sub(r'\s+', ' ', key.lower()))
+                if link is None:
+                    # not a link after all, output the first character as text and continue
+                    out.append(m.group(0)[0])
+                    src = src[1:]
+                    break
+                out.append(_render_link_or_image(m.group(0), m.group(1), link[0], link[1], links))
+            elif name == 'strong':
+                out.append('*%s*' % _render_inline(m.group(2) or m.group(1), links, in_link))
+            elif name == 'em':
+                out.append('_%s_' % _render_inline(m.group(2) or m.group(1), links, in_link))
+            elif name == 'code':
+                out.append('{{%s}}' % _escape(m.group(2).strip(), True))
+            elif name == 'br':
+                out.append('\n')
+            elif name == 'del':
+                out.append('-%s-' % _render_inline(m.group(1), links, in_link))
+            elif name == 'text':
+                out.append(_escape(m.group(0)))
+            src = src[m.end():]
+            break
+    return ''.join(out)
+
+
+class _Match(object):
+    """
+    An inline token found by _InlineScanner, with the methods of a regex match which _render_inline() uses
+    """
+    def __init__(self, length, *groups):
+        self._length = length
+        self._groups = groups
+
+    def group(self, index=0):
+        return self._groups[index]
+
+    def end(self):
+        return self._length
+
+
+class _InlineScanner(object):
+    """
+    Matches the links, autolinks and HTML tags of marked's inline grammar at increasing positions of one text,
+    in linear time overall. Searches for closing characters are remembered, so that a failed match (for
+    example an unclosed '[a](' or '<a ') doesn't search the rest of the text again from the next '[' or '<'.
+
+    Like later versions of marked, the text of a link ends at the matching ']' (counting nested brackets),
+    and its destination at the first ')'.
+    """
+    _TAG_NAME_RE = re.compile(r'</?\w+')
+    _AUTOLINK_END_RE = re.compile(r'[ >]')
+    _QUOTES = '"\''
+
+    def __init__(self, text):
+        self.text = text
+        self._found = {}
+        self._found_last = {}
+        self._closing_brackets = None
+        self._tag_ends = {}
+
+    def match(self, name, pos):
+        return getattr(self, '_' + name)(pos)
+
+    def _find(self, needle, pos):
+        """
+        Return text.find(needle, pos), or with a regex the start of its next match (-1 if there is none)
+        """
+        start, found = self._found.get(needle, (None, None))
+        if start is None or start > pos or (found != -1 and found < pos):
+            if isinstance(needle, str):
+                found = self.text.find(needle, pos)
+            else:
+                m = needle.search(self.text, pos)
+                found = m.start() if m else -1
+            self._found[needle] = (pos, found)
+        return found
+
+    def _find_last(self, needle, start, end):
+        """
+        Return text.rfind(needle, start, end), for the same 'end' and increasing 'start'
+        """
+        found = self._found_last.get((needle, end))
+        if found is None:
+            found = self._found_last[(needle, end)] = self.text.rfind(needle, start, end)
+        return found if found >= start else -1
+
+    def _closing_bracket(self, pos):
+        """
+        Return the index of the ']' matching the '[' at pos, or -1
+        """
+        if self._closing_brackets is None:
+            self._closing_brackets = {}
+            opening = []
+            for i, c in enumerate(self.text):
+                if c == '[':
+                    opening.append(i)
+                elif c == ']' and opening:
+                    self._closing_brackets[opening.pop()] = i
+        return self._closing_brackets.get(pos, -1)
+
+    def _autolink(self, pos):
+        text = self.text
+        if text[pos] != '<':
+            return None
+        end = self._find(self._AUTOLINK_END_RE, pos + 1)
+        if end == -1 or text[end] != '>':
+            return None
+        # as the greedy regex <([^ >]+(@|:/)[^ >]+)>, the last '@' or ':/' with something before and after it
+        at = self._find_last('@', pos + 2, end - 1)
+        scheme = self._find_last(':/', pos + 2, end - 1)
+        if at == -1 and scheme == -1:
+            return None
+        return _Match(end + 1 - pos, text[pos:end + 1], text[pos + 1:end], '@' if at > scheme else ':/')
+
+    def _tag(self, pos):
+        text = self.text
+        if text.startswith('<!--', pos):
+            end = self._find('-->', pos + 4)
+            return _Match(end + 3 - pos, text[pos:end + 3]) if end != -1 else None
+        m = self._TAG_NAME_RE.match(text, pos)
+        if m is None:
+            return None
+        # The rest of the tag is (?:"[^"]*"|'[^']*'|[^'">])*?> which only has one way to match, so where it
+        # ends only depends on where it starts (outside quotes).
+        i = m.end()
+        visited = []
+        while True:
+            if i in self._tag_ends:
+                end = self._tag_ends[i]
+                break
+            if i >= len(text):
+                end = -1
+                break
+            visited.append(i)
+            if text[i] == '>':
+                end = i + 1
+                break
+            if text[i] in self._QUOTES:
+                i = self._find(text[i], i + 1)
+                if i == -1:
+                    end = -1
+                    break
+            i += 1
+        for i in visited:
+            self._tag_ends[i] = end
+        return _Match(end - pos, text[pos:end]) if end != -1 else None
+
+    def _bracket(self, pos):
+        """
+        Return the index of the '[' and ']' around the text of a link or image at pos, or None
+        """
+        start = pos + 1 if self.text.startswith('![', pos) else pos
+        if self.text[start] != '[':
+            return None
+        end = self._closing_bracket(start)
+        return (start, end) if end != -1 else None
+
+    def _link(self, pos):
+        brackets = self._bracket(pos)
+        if brackets is None or not self.text.startswith('(', brackets[1] + 1):
+            return None
+        start, end = brackets
+        close = self._find(')', end + 2)
+        if close == -1:
+            return None
+        href, title = _split_link_destination(self.text[end + 2:close])
+        return _Match(close + 1 - pos, self.text[pos:close + 1], self.text[start + 1:end], href, title)
+
+    def _reflink(self, pos):
+        brackets = self._bracket(pos)
+        if brackets is None:
+            return None
+        start, end = brackets
+        key_start = end + 1
+        while key_start < len(self.text) and self.text[key_start].isspace():
+            key_start += 1
+        if not self.text.startswith('[', key_start):
+            return None
+        key_end = self._find(']', key_start + 1)
+        if key_end == -1:
+            return None
+        return _Match(key_end + 1 - pos, self.text[pos:key_end + 1], self.text[start + 1:end], self.text[key_start + 1:key_end])
+
+    def _nolink(self, pos):
+        brackets = self._bracket(pos)
+        if brackets is None:
+            return None
+        start, end = brackets
+        return _Match(end + 1 - pos, self.text[pos:end + 1], self.text[start + 1:end])
+
+
+def _split_link_destination(destination):
+    """
+    Split the part of an inline link between the parentheses into the href and the title (or None),
+    as the regex \\s*<?([\\s\\S]*?)>?(?:\\s+['"]([\\s\\S]*?)['"])?\\s* would
+    """
+    destination = destination.strip()
+    if destination.startswith('<'):
+        destination = destination[1:]
+    if destination[-1:] in ('"', "'"):
+        for space in re.finditer(r'\s+', destination):
+            if space.end() < len(destination) - 1 and destination[space.end()] in '"\'':
+                href_end = space.start() - 1 if destination[space.start() - 1:space.start()] == '>' else space.start()
+                return destination[:href_end], destination[space.end() + 1:-1]
+    return destination[:-1] if destination.endswith('>') else destination, None
+
+
+def _render_link_or_image(source, text, href, title, links):
+    href = _escape(href)
+    if source.startswith('!'):
+        return '!%s!' % href
+    return _render_link(href, title, _render_inline(text, links, in_link=True))
+
+
+if __name__ == '__main__':
+    sys.stdout.write(markdown2wiki(sys.stdin.read()))
@@ -14,9 +14,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-from jira import JIRA
+from jira import JIRA, JIRAError
 from github import Github
-from github.GithubException import GithubException
+from github.GithubException import GithubException, RateLimitExceededException, UnknownObjectException
+from markdown2wiki import markdown2wiki, VERSION as MARKDOWN2WIKI_VERSION
+from cache import LRUCache, DiskCache, JiraMetadata, JsonFileCache, cache_dir, cache_file
+from http_session import github_options
+from tracing import traced
+import concurrent.futures
+import contextvars
+import datetime
+import hashlib
 import json
 import os
 import random
@@ -24,149 +32,324 @@ import re
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 # 10101 is ID for New Feature issue type in Jira.
 JIRA_NEW_FEATURE_TYPE_ID = 10101
 # 10004 is ID for Bug issue type in Jira.
 JIRA_BUG_TYPE_ID = 10004
-# Initialize GitHub instance
-GITHUB = Github(os.environ["GITHUB_TOKEN"])
-# Initialize GitHub repository
-REPO = GITHUB.get_repo(os.environ['GITHUB_REPOSITORY'])
-
-
+# GitHub labels which always map to a particular JIRA issue type
+LABEL_ISSUE_TYPE_IDS = {
+    # Type: Feature Request label should match New Feature issue type in Jira
+    'Type: Feature Request': JIRA_NEW_FEATURE_TYPE_ID,
+    # Some projects use Label with bug icon represented by ":bug:" in label name.
+    # This matches those to Bug Jira issue type
+    'Type: Bug :bug:': JIRA_BUG_TYPE_ID,
+}
+# When an event needs a JIRA issue which doesn't exist yet, this is how long (in seconds) to
+# wait for another Action to create it. Time between lookups starts at SYNC_WAIT_FIRST_DELAY
+# and doubles up to SYNC_WAIT_MAX_DELAY.
+SYNC_WAIT_TIMEOUT = 300
+SYNC_WAIT_FIRST_DELAY = 2
+SYNC_WAIT_MAX_DELAY = 30
+# Maximum number of JIRA issues created by one bulk create request
+JIRA_BULK_CREATE_SIZE = 50
+# Maximum number of GitHub issues looked up by one JQL query
+JQL_BATCH_SIZE = 50
+# Number of threads linking new JIRA issues and GitHub issues when mirroring in bulk
+BULK_SYNC_WORKERS = 8
+# Number of side effects of one handler which can run at the same time, see _run_concurrently()
+SIDE_EFFECT_WORKERS = 4
+# Number of converted markdown bodies to keep in memory
+MARKDOWN_CACHE_SIZE = 256
+# Converted markdown bodies, keyed by a hash of the markdown input
+_MARKDOWN_CACHE = LRUCache(MARKDOWN_CACHE_SIZE)
+# Number of converted markdown bodies to keep in JIRA_SYNC_CACHE_DIR
+MARKDOWN_DISK_CACHE_SIZE = 2000
+# Number of JIRA issues to keep the synced comment IDs of in memory
+JIRA_COMMENT_IDS_CACHE_SIZE = 256
+# For each JIRA issue key, the IDs of its synced comments keyed by GitHub comment ID, see _find_jira_comment()
+_JIRA_COMMENT_IDS = LRUCache(JIRA_COMMENT_IDS_CACHE_SIZE)
+# Threads for _run_concurrently()
+_SIDE_EFFECT_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=SIDE_EFFECT_WORKERS)
+# (time created, JiraMetadata) for the JIRA client in use, see _get_jira_metadata()
+_JIRA_METADATA = None
+# Persistent JsonFileCaches by file path, see _get_json_file_cache()
+_JSON_FILE_CACHES = {}
+# ((token, API URL), Github client) shared by all modules, see _get_github()
+_GITHUB_CLIENT = None
+# Lazy repos of the Github client by repository name, see _get_repo()
+_GITHUB_REPOS = {}
+_GITHUB_CLIENT_LOCK = threading.Lock()
+# Repository of the event being handled by this thread, if not GITHUB_REPOSITORY, see _use_repository()
+_EVENT_REPOSITORY = contextvars.ContextVar('event_repository', default=None)
+# Repo URL to (time fetched, set of lower case collaborator logins), see _is_collaborator()
+_COLLABORATORS = {}
+# Set by long-lived processes (the webhook server), which can reuse the collaborators listed for one event
+_LIST_COLLABORATORS = False
+_COLLABORATORS_LOCK = threading.Lock()
+
+
+@traced
 def handle_issue_opened(jira, event):
     print('Creating new JIRA issue for new GitHub issue')
     _create_jira_issue(jira, event["issue"])
 
 
+@traced
 def handle_issue_edited(jira, event):
     gh_issue = event["issue"]
     issue = _find_jira_issue(jira, gh_issue, True)
 
-    fields = {
-        "description": _get_description(gh_issue),
-        "summary": _get_summary(gh_issue),
-    }
-
-    _update_components_field(jira, fields, issue)
-
-    issue.update(fields=fields)
-
-    _update_link_resolved(jira, gh_issue, issue)
+    update = _IssueUpdate(issue)
+    update.fields["description"] = _get_description(gh_issue)
+    update.fields["summary"] = _get_summary(gh_issue)
+    _update_components_field(jira, update.fields, issue)
+    _remove_unchanged_fields(issue, update.fields)
+    if "description" in update.fields or "summary" in update.fields:
+        update.add_comment(_get_issue_event_comment(event, "edited"))
+    else:
+        print("GitHub issue edit doesn't change the synced fields, not updating JIRA issue")
 
-    _leave_jira_issue_comment(jira, event, "edited", True, jira_issue=issue)
+    _run_concurrently(update.send, lambda: _update_link_resolved(jira, gh_issue, issue))
 
 
+@traced
 def handle_issue_closed(jira, event):
     # note: Not auto-closing the synced JIRA issue because GitHub
     # issues often get closed for the wrong reasons - ie the user
     # found a workaround but the root cause still exists.
-    issue = _leave_jira_issue_comment(jira, event, "closed", False)
+    issue = _find_jira_issue(jira, event["issue"], False)
     if issue is not None:
-        _update_link_resolved(jira, event["issue"], issue)
+        _run_concurrently(lambda: _leave_jira_issue_comment(jira, event, "closed", False, jira_issue=issue),
+                          lambda: _update_link_resolved(jira, event["issue"], issue))
 
 
+@traced
 def handle_issue_labeled(jira, event):
-    gh_issue = event["issue"]
-    jira_issue = _find_jira_issue(jira, gh_issue, gh_issue["state"] == "open")
-    if jira_issue is None:
-        return
-
-    labels = list(jira_issue.fields.labels)
     new_label = _get_jira_label(event["label"])
 
     if _check_issue_label(new_label) is None:
         return
 
-    if new_label not in labels:
-        labels.append(new_label)
-        jira_issue.update(fields={"labels": labels})
-
-
-def handle_issue_unlabeled(jira, event):
     gh_issue = event["issue"]
     jira_issue = _find_jira_issue(jira, gh_issue, gh_issue["state"] == "open")
     if jira_issue is None:
         return
 
-    labels = list(jira_issue.fields.labels)
+    update = _IssueUpdate(jira_issue)
+    update.add_label(new_label)
+    update.send()
+
+
+@traced
+def handle_issue_unlabeled(jira, event):
     removed_label = _get_jira_label(event["label"])
 
     if _check_issue_label(removed_label) is None:
         return
 
-    try:
-        labels.remove(removed_label)
-        jira_issue.update(fields={"labels": labels})
-    except ValueError:
-        pass  # not in labels list
+    gh_issue = event["issue"]
+    jira_issue = _find_jira_issue(jira, gh_issue, gh_issue["state"] == "open")
+    if jira_issue is None:
+        return
+
+    update = _IssueUpdate(jira_issue)
+    update.remove_label(removed_label)
+    update.send()
 
 
+@traced
 def handle_issue_deleted(jira, event):
     _leave_jira_issue_comment(jira, event, "deleted", False)
 
 
+@traced
 def handle_issue_reopened(jira, event):
-    issue = _leave_jira_issue_comment(jira, event, "reopened", True)
-    _update_link_resolved(jira, event["issue"], issue)
+    issue = _find_jira_issue(jira, event["issue"], True)
+    _run_concurrently(lambda: _leave_jira_issue_comment(jira, event, "reopened", True, jira_issue=issue),
+                      lambda: _update_link_resolved(jira, event["issue"], issue))
 
 
+@traced
 def handle_comment_created(jira, event):
-    gh_comment = event["comment"]
-
     jira_issue = _find_jira_issue(jira, event["issue"], True)
-    jira.add_comment(jira_issue.id, _get_jira_comment_body(gh_comment))
+    _add_jira_comment(jira, jira_issue, event["comment"])
 
 
+@traced
 def handle_comment_edited(jira, event):
-    gh_comment = event["comment"]
-    old_gh_body = _markdown2wiki(event["changes"]["body"]["from"])
-
     jira_issue = _find_jira_issue(jira, event["issue"], True)
-
-    # Look for the old comment and update it if we find it
-    old_jira_body = _get_jira_comment_body(gh_comment, old_gh_body)
-    found = False
-    for comment in jira.comments(jira_issue.key):
-        if comment.body == old_jira_body:
-            comment.update(body=_get_jira_comment_body(gh_comment))
-            found = True
-            break
-
-    if not found:  # if we didn't find the old comment, make a new comment about the edit
-        jira.add_comment(jira_issue.id, _get_jira_comment_body(gh_comment))
+    _update_jira_comment(jira, jira_issue, event["comment"])
 
 
+@traced
 def handle_comment_deleted(jira, event):
-    gh_comment = event["comment"]
     jira_issue = _find_jira_issue(jira, event["issue"], True)
-    jira.add_comment(
-        jira_issue.id, "@%s deleted [GitHub issue comment|%s]" % (gh_comment["user"]["login"], gh_comment["html_url"])
-    )
+    _leave_comment_deleted(jira, jira_issue, event["comment"])
 
 
 # Works both for issues and pull requests
+@traced
 def sync_issues_manually(jira, event):
     # Get issue numbers that were entered manually when triggering workflow
-    issue_numbers = event['inputs']['issue-numbers']
-    issues = re.split('\W+', issue_numbers)
+    issue_numbers = _get_issue_numbers(event)
     # Process every issue
-    for issue_number in issues:
-        if not issue_number.isnumeric():
-            print(f'Wrong issue number entered: {issue_number} Skipping...')
-            continue
-        gh_issue = REPO.get_issue(number=int(issue_number))
+    for issue_number in issue_numbers:
+        gh_issue = _get_repo().get_issue(number=issue_number)
         event['issue'] = gh_issue.raw_data
         print(f'Mirroring issue: #{issue_number} to Jira')
         handle_issue_opened(jira, event)
 
 
+# Works both for issues and pull requests
+@traced
+def sync_issues_in_bulk(jira, event):
+    """
+    Mirror many issues to Jira at once, for backfilling. Issues which are already synced are skipped.
+
+    Instead of handling each issue like a new issue event, the GitHub issues are fetched concurrently,
+    existing Jira issues are looked up with batched JQL queries, missing Jira issues are created with
+    bulk create requests and then the remote links and GitHub titles are updated concurrently.
+    """
+    issue_numbers = _get_issue_numbers(event)
+    created, skipped, failed = [], [], []
+
+    print(f'Fetching {len(issue_numbers)} issues from GitHub...')
+    api_gh_issues = _get_github_issues(issue_numbers)
+    for issue_number in issue_numbers:
+        if issue_number not in api_gh_issues:
+            print(f'Issue #{issue_number} not found on GitHub')
+            failed.append(issue_number)
+    gh_issues = [api_gh_issues[n].raw_data for n in issue_numbers if n in api_gh_issues]
+
+    print(f'Looking for {len(gh_issues)} issues in Jira...')
+    existing = _find_jira_issues_bulk(jira, gh_issues)
+    missing = []
+    for gh_issue in gh_issues:
+        if gh_issue["html_url"] in existing:
+            print(f'Issue #{gh_issue["number"]} is already synced to {existing[gh_issue["html_url"]].key}. Skipping...')
+            skipped.append(gh_issue["number"])
+        else:
+            missing.append(gh_issue)
+
+    new_issues = []
+    for chunk in _chunks(missing, JIRA_BULK_CREATE_SIZE):
+        print(f'Creating {len(chunk)} Jira issues ({len(new_issues) + len(chunk)}/{len(missing)})...')
+        field_list = []
+        for gh_issue in chunk:
+            fields = _get_new_issue_fields(jira, gh_issue)
+            _update_components_field(jira, fields, None)
+            if isinstance(fields["issuetype"], str):
+                fields["issuetype"] = {"name": fields["issuetype"]}  # avoids a lookup by name for each issue
+            fields["project"] = {"key": fields["project"]}  # avoids a project lookup for each issue
+            field_list.append(fields)
+        for gh_issue, result in zip(chunk, jira.create_issues(field_list, prefetch=False)):
+            if result["status"] == "Success":
+                new_issues.append((gh_issue, result["issue"]))
+            else:
+                print(f'Failed to create Jira issue for #{gh_issue["number"]}: {result["error"]}')
+                failed.append(gh_issue["number"])
+
+    print(f'Linking {len(new_issues)} new Jira issues...')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=BULK_SYNC_WORKERS) as executor:
+        futures = {}
+        for gh_issue, issue in new_issues:
+            future = executor.submit(contextvars.copy_context().run, _link_new_jira_issue,
+                                     jira, gh_issue, issue, api_gh_issues[gh_issue["number"]])
+            futures[future] = (gh_issue, issue)
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            gh_issue, issue = futures[future]
+            try:
+                future.result()
+                print(f'[{done}/{len(futures)}] Mirrored issue #{gh_issue["number"]} to {issue.key}')
+                created.append(gh_issue["number"])
+            except Exception as e:
+                print(f'[{done}/{len(futures)}] Failed to link {issue.key} to issue #{gh_issue["number"]}: {e}')
+                failed.append(gh_issue["number"])
+
+    print(f'Created: {len(created)}, skipped: {len(skipped)}, failed: {len(failed)}')
+    if failed:
+        print('Failed issues: ' + ', '.join(f'#{n}' for n in sorted(failed)))
+    return created, skipped, failed
+
+
+def _get_issue_numbers(event):
+    """
+    Return the list of issue numbers that were entered manually when triggering the workflow
+    """
+    issue_numbers = []
+    for issue_number in re.split(r'\W+', event['inputs']['issue-numbers']):
+        if not issue_number.isnumeric():
+            print(f'Wrong issue number entered: {issue_number} Skipping...')
+            continue
+        issue_numbers.append(int(issue_number))
+    return issue_numbers
+
+
+def _get_github_issues(issue_numbers):
+    """
+    Fetch the GitHub issues (or pull requests) with the given numbers, BULK_SYNC_WORKERS at a time.
+    Returns a dict of issue number to PyGithub Issue, without the issues which don't exist.
+    """
+    repo = _get_repo()
+
+    def get_issue(number):
+        try:
+            return repo.get_issue(number)
+        except UnknownObjectException:
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=BULK_SYNC_WORKERS) as executor:
+        futures = {number: executor.submit(contextvars.copy_context().run, get_issue, number) for number in set(issue_numbers)}
+    found = {number: future.result() for number, future in futures.items()}
+    return {number: api_gh_issue for number, api_gh_issue in found.items() if api_gh_issue is not None}
+
+
+def _find_jira_issues_bulk(jira, gh_issues):
+    """
+    Return a dict of GitHub issue URL to JIRA issue for the GitHub issues which are already synced,
+    using one JQL query for each batch of issues.
+
+    Falls back to _find_jira_issue() for issues which may have been synced manually (see README).
+    """
+    found = {}
+    for chunk in _chunks(gh_issues, JQL_BATCH_SIZE):
+        urls = [gh_issue["html_url"] for gh_issue in chunk]
+        by_summary = dict((_get_summary(gh_issue).split(":")[0], gh_issue["html_url"]) for gh_issue in chunk)
+        jql_query = 'issue in issuesWithRemoteLinksByGlobalId(%s) order by updated desc' % ", ".join('"%s"' % url for url in urls)
+        print("JQL query: %s" % jql_query)
+        for issue in jira.search_issues(jql_query, maxResults=False, fields="summary"):
+            url = by_summary.get(issue.fields.summary.split(":")[0])
+            if url is not None:
+                found.setdefault(url, issue)
+                continue
+            # summary was changed in JIRA, so check which GitHub issue the links point to
+            for link in jira.remote_links(issue):
+                if getattr(link, "globalId", None) in urls:
+                    found.setdefault(link.globalId, issue)
+
+    for gh_issue in gh_issues:
+        if gh_issue["html_url"] not in found and re.search(r"\(([A-Z]+-\d+)\)\s*$", gh_issue["title"]):
+            issue = _find_jira_issue(jira, gh_issue)
+            if issue is not None:
+                found[gh_issue["html_url"]] = issue
+
+    index = _get_jira_issue_index()
+    if index is not None:
+        index.put_many(dict((url, issue.key) for url, issue in found.items()))
+    return found
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
 def _check_issue_label(label):
     """
     Ignore labels that start with "Status:" and "Resolution:". These labels are
-    mirrored from Jira issue and should not be mirrored back as labels
+    mirrored from Jira issue and should not be mirrored back as labels.
     """
     ignore_prefix = ("status:", "resolution:")
     if label.lower().startswith(ignore_prefix):
@@ -189,16 +372,76 @@ def _update_link_resolved(jira, gh_issue, jira_issue):
         if hasattr(link, "globalId") and link.globalId == gh_issue["html_url"]:
             new_link = dict(link.raw["object"])  # RemoteLink update() requires all fields as a JSON object, it seems
             new_link["title"] = gh_issue["title"]
-            new_link["status"]["resolved"] = resolved
+            new_link["status"] = dict(new_link.get("status") or {}, resolved=resolved)
+            if new_link == link.raw["object"]:
+                continue  # already up to date
             link.update(new_link, globalId=link.globalId, relationship=link.relationship)
 
 
+def _remove_unchanged_fields(jira_issue, fields):
+    """
+    Remove the entries of an issue fields dictionary which are the same as the current fields of the JIRA issue,
+    so that edits to parts of the GitHub issue which aren't synced don't write to JIRA.
+    """
+    current = getattr(jira_issue, "fields", None)
+    for name in list(fields):
+        value = getattr(current, name, None)
+        if name == "components":
+            unchanged = isinstance(value, list) and set(c.name for c in value) == set(c["name"] for c in fields[name])
+        else:
+            unchanged = isinstance(value, str) and _normalize_text(value) == _normalize_text(fields[name])
+        if unchanged:
+            del fields[name]
+    return fields
+
+
+def _normalize_text(text):
+    # JIRA may return text with different line endings and trailing whitespace than it was sent with
+    return "\n".join(line.rstrip() for line in text.replace("\r\n", "\n").split("\n")).strip()
+
+
+@traced
 def _markdown2wiki(markdown):
     """
-    Convert markdown to JIRA wiki format. Uses https://github.com/Shogobg/markdown2confluence
+    Convert markdown to JIRA wiki format. Uses markdown2confluence, unless the MARKDOWN_CONVERTER
+    environment variable is set to 'markdown2wiki' for the in-process converter in markdown2wiki.py.
+
+    Results are cached in memory and, if JIRA_SYNC_CACHE_DIR is set, on disk (so the same text
+    is only converted once even when it is seen by several workflow runs).
     """
     if markdown is None:
         return "\n"  # Allow empty/blank input
+
+    converter = os.environ.get('MARKDOWN_CONVERTER', 'markdown2confluence')
+    key = hashlib.sha256(("%s-%d\n%s" % (converter, MARKDOWN2WIKI_VERSION, markdown)).encode("utf-8")).hexdigest()
+    result = _MARKDOWN_CACHE.get(key)
+    if result is None:
+        path = cache_dir("markdown")
+        disk_cache = DiskCache(path, MARKDOWN_DISK_CACHE_SIZE) if path else None
+        if disk_cache:
+            result = disk_cache.get(key)
+        if result is None:
+            if converter == 'markdown2wiki':
+                result = markdown2wiki(markdown)
+            else:
+                result = _markdown2confluence(markdown)
+                if result is None:
+                    return markdown
+            if disk_cache:
+                disk_cache.put(key, result)
+        _MARKDOWN_CACHE.put(key, result)
+
+    if len(result) > 16384:  # limit any single body of text to 16KB (JIRA API limits total text to 32KB)
+        result = result[:16376] + "\n\n[...]"  # add newlines to encourage end of any formatting blocks
+    return result
+
+
+def _markdown2confluence(markdown):
+    """
+    Convert markdown to JIRA wiki format using https://github.com/Shogobg/markdown2confluence
+
+    Returns None if the conversion fails.
+    """
     with tempfile.TemporaryDirectory() as tmp_dir:
         md_path = os.path.join(tmp_dir, 'markdown.md')
         conf_path = os.path.join(tmp_dir, 'confluence.txt')
@@ -210,13 +453,10 @@ def _markdown2wiki(markdown):
         try:
             subprocess.check_call(['markdown2confluence', md_path, conf_path])
             with open(conf_path, 'r') as f:
-                result = f.read()
-            if len(result) > 16384:  # limit any single body of text to 16KB (JIRA API limits total text to 32KB)
-                result = result[:16376] + "\n\n[...]"  # add newlines to encourage end of any formatting blocks
-            return result
-        except subprocess.CalledProcessError as e:
+                return f.read()
+        except (subprocess.CalledProcessError, OSError) as e:
             print("Failed to run markdown2confluence: %s. JIRA issue will have raw Markdown contents." % e)
-            return markdown
+            return None
 
 
 def _get_description(gh_issue):
@@ -273,37 +513,108 @@ def _get_summary(gh_issue):
     return result
 
 
+@traced
 def _create_jira_issue(jira, gh_issue):
     """
     Create a new JIRA issue from the provided GitHub issue, then return the JIRA issue.
     """
+    fields = _get_new_issue_fields(jira, gh_issue)
+    _update_components_field(jira, fields, None)
+
+    issue = jira.create_issue(fields)
+
+    _link_new_jira_issue(jira, gh_issue, issue)
+
+    return issue
+
+
+def _get_new_issue_fields(jira, gh_issue):
+    """
+    Return the fields for a new JIRA issue created from the provided GitHub issue (apart from components).
+    """
     issuetype = _get_jira_issue_type(jira, gh_issue)
     if issuetype is None:
         issuetype = os.environ.get('JIRA_ISSUE_TYPE', 'Task')
 
-    fields = {
+    return {
         "summary": _get_summary(gh_issue),
         "project": os.environ['JIRA_PROJECT'],
         "description": _get_description(gh_issue),
         "issuetype": issuetype,
         "labels": [_get_jira_label(l) for l in gh_issue["labels"]],
     }
-    _update_components_field(jira, fields, None)
 
-    issue = jira.create_issue(fields)
 
-    _add_remote_link(jira, issue, gh_issue)
-    _update_github_with_jira_key(gh_issue, issue)
-    if gh_issue["state"] != "open":
-        # mark the link to GitHub as resolved
-        _update_link_resolved(jira, gh_issue, issue)
+@traced
+def _link_new_jira_issue(jira, gh_issue, issue, api_gh_issue=None):
+    """
+    Link a newly created JIRA issue and the GitHub issue it was created from.
+
+    The JIRA remote link and the GitHub title don't depend on each other, so they are updated at the same time.
+    """
+    index = _get_jira_issue_index()
+    if index is not None:
+        index.put(gh_issue["html_url"], issue.key)
+    _run_concurrently(lambda: _add_remote_link(jira, issue, gh_issue),
+                      lambda: _update_github_with_jira_key(gh_issue, issue, api_gh_issue))
 
-    return issue
+
+def _run_concurrently(*calls):
+    """
+    Call functions which don't depend on each other at the same time, and wait for all of them to finish.
+
+    The first call runs in the calling thread and the others in the side effect thread pool. If any of them
+    fail, the first exception is raised once they have all finished.
+    """
+    futures = [_SIDE_EFFECT_EXECUTOR.submit(contextvars.copy_context().run, call) for call in calls[1:]]
+    errors = []
+    try:
+        calls[0]()
+    except Exception as e:
+        errors.append(e)
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+class _IssueUpdate(object):
+    """
+    Changes to one JIRA issue, collected while an event is handled and then sent in a single request.
+
+    Labels and comments use the JIRA "update" verbs, so a label is added or removed without first reading
+    the issue's labels (and without overwriting a label change made by another event at the same time).
+    """
+    def __init__(self, jira_issue):
+        self.jira_issue = jira_issue
+        self.fields = {}
+        self.verbs = {}
+
+    def add_label(self, label):
+        self.verbs.setdefault("labels", []).append({"add": label})
+
+    def remove_label(self, label):
+        self.verbs.setdefault("labels", []).append({"remove": label})
+
+    def add_comment(self, body):
+        self.verbs.setdefault("comment", []).append({"add": {"body": body}})
+
+    def send(self):
+        """
+        Send the changes, if there are any. Returns True if a request was made.
+        """
+        if not self.fields and not self.verbs:
+            return False
+        self.jira_issue.update(fields=self.fields, update=self.verbs)
+        return True
 
 
 def _add_remote_link(jira, issue, gh_issue):
     """
-    Add the JIRA "remote link" field that points to the issue
+    Add the JIRA "remote link" field that points to the issue (marked resolved if the GitHub issue isn't open)
     """
     gh_url = gh_issue["html_url"]
     jira.add_remote_link(
@@ -311,18 +622,23 @@ def _add_remote_link(jira, issue, gh_issue):
         destination={
             "url": gh_url,
             "title": gh_issue["title"],
+            "status": {"resolved": gh_issue["state"] != "open"},
         },
         globalId=gh_url,  # globalId is always the GitHub URL
         relationship="synced from",
     )
 
 
-def _update_github_with_jira_key(gh_issue, jira_issue):
+@traced
+def _update_github_with_jira_key(gh_issue, jira_issue, api_gh_issue=None):
     """Append the new JIRA issue key to the GitHub issue
     (updates made by github actions don't trigger new actions)
+
+    api_gh_issue is the PyGithub Issue, if the caller already has it.
     """
 
-    api_gh_issue = REPO.get_issue(gh_issue["number"])
+    if api_gh_issue is None:
+        api_gh_issue = _get_repo().get_issue(gh_issue["number"])
 
     retries = 5
     while True:
@@ -356,12 +672,11 @@ def _update_components_field(jira, fields, existing_issue=None):
 
     if existing_issue:
         # may be a different project if the issue was moved
-        project = jira.project(existing_issue.fields.project.key)
+        project_key = existing_issue.fields.project.key
     else:
-        project = jira.project(os.environ['JIRA_PROJECT'])
-    project_components = jira.project_components(project)
+        project_key = os.environ['JIRA_PROJECT']
 
-    if component not in [c.name for c in project_components]:
+    if component not in _get_jira_metadata(jira).component_names(project_key):
         print("JIRA project doesn't contain the configured component, not updating components field")
         return
 
@@ -370,9 +685,9 @@ def _update_components_field(jira, fields, existing_issue=None):
     fields["components"] = [{"name": component}]
     # keep any existing components as well
     if existing_issue:
-        for component in existing_issue.fields.components:
-            if component.name != component:
-                fields["components"].append({"name": component.name})
+        for existing_component in existing_issue.fields.components:
+            if existing_component.name != component:
+                fields["components"].append({"name": existing_component.name})
 
 
 def _get_jira_issue_type(jira, gh_issue):
@@ -385,41 +700,164 @@ def _get_jira_issue_type(jira, gh_issue):
     """
     gh_labels = [l["name"] for l in gh_issue["labels"]]
 
-    issue_types = jira.issue_types()
-
     for gh_label in gh_labels:
-        # Type: Feature Request label should match New Feature issue type in Jira
-        if gh_label == 'Type: Feature Request':
-            print('GitHub label is \'Type: Feature Request\'. Mapping to New Feature Jira issue type')
-            return {"id": JIRA_NEW_FEATURE_TYPE_ID}  # JIRA API needs JSON here
-        # Some projects use Label with bug icon represented by ":bug:" in label name.
-        # This if mathes those to Bug Jira issue type
-        if gh_label == 'Type: Bug :bug:':
-            print('GitHub label is \'Type: Bug :bug:\'. Mapping to Bug Jira issue type')
-            return {"id": JIRA_BUG_TYPE_ID}  # JIRA API needs JSON here
-        for issue_type in issue_types:
-            type_name = issue_type.name.lower()
-            if gh_label.lower() in [type_name, "type: %s" % (type_name,)]:
-                # a match!
-                print("Mapping GitHub label '%s' to JIRA issue type '%s'" % (gh_label, issue_type.name))
-                return {"id": issue_type.id}  # JIRA API needs JSON here
+        if gh_label in LABEL_ISSUE_TYPE_IDS:
+            print('GitHub label is \'%s\'. Mapping to issue type ID %d' % (gh_label, LABEL_ISSUE_TYPE_IDS[gh_label]))
+            return {"id": LABEL_ISSUE_TYPE_IDS[gh_label]}  # JIRA API needs JSON here
+        issue_type = _get_jira_metadata(jira).issue_type_for_label(gh_label)
+        if issue_type is not None:
+            # a match!
+            print("Mapping GitHub label '%s' to JIRA issue type '%s'" % (gh_label, issue_type[1]))
+            return {"id": issue_type[0]}  # JIRA API needs JSON here
 
     return None  # updating a field to None seems to cause 'no change' for JIRA
 
 
-def _find_jira_issue(jira, gh_issue, make_new=False, retries=5):
+def _get_jira_metadata(jira):
+    """
+    Return the JiraMetadata for this JIRA client, so metadata is only fetched once per run.
+
+    A long-running process (the webhook server) fetches it again after JIRA_METADATA_CACHE_TTL seconds.
+    """
+    global _JIRA_METADATA
+    ttl = int(os.environ.get('JIRA_METADATA_CACHE_TTL', 24 * 60 * 60))
+    if _JIRA_METADATA is None or _JIRA_METADATA[1].jira is not jira or time.time() - _JIRA_METADATA[0] > ttl:
+        _JIRA_METADATA = (time.time(), JiraMetadata(jira))
+    return _JIRA_METADATA[1]
+
+
+def _get_github():
+    """
+    Return the GitHub client, which is created on first use and then shared by all handlers.
+    """
+    global _GITHUB_CLIENT
+    token = os.environ['GITHUB_TOKEN']
+    base_url = os.environ.get('GITHUB_API_URL', 'https://api.github.com')  # set by GitHub Actions
+    with _GITHUB_CLIENT_LOCK:
+        if _GITHUB_CLIENT is None or _GITHUB_CLIENT[0] != (token, base_url):
+            _GITHUB_CLIENT = ((token, base_url), Github(token, base_url=base_url, **github_options()))
+            _GITHUB_REPOS.clear()
+        return _GITHUB_CLIENT[1]
+
+
+def _get_repo():
+    """
+    Return the GitHub repository of the event being handled (GITHUB_REPOSITORY, unless set by _use_repository()).
+
+    The repository is lazy, i.e. it's only fetched from GitHub if one of its attributes is read. Getting
+    issues, PRs, labels, etc. only needs the repository name.
+    """
+    repo_name = _EVENT_REPOSITORY.get() or os.environ['GITHUB_REPOSITORY']
+    github = _get_github()
+    with _GITHUB_CLIENT_LOCK:
+        if repo_name not in _GITHUB_REPOS:
+            _GITHUB_REPOS[repo_name] = github.get_repo(repo_name, lazy=True)
+        return _GITHUB_REPOS[repo_name]
+
+
+def _use_repository(repo_name):
+    """
+    Make _get_repo() return this repository in the current thread (and in the side effects it runs, which get
+    a copy of its context), for handling events from more than one repository in one process. If repo_name
+    is None, GITHUB_REPOSITORY is used again.
+    """
+    _EVENT_REPOSITORY.set(repo_name)
+
+
+def _is_collaborator(repo, login, list_all=False):
+    """
+    Return True if the GitHub user is a collaborator of the repo.
+
+    Listing the collaborators takes a request per 100 of them, so they are only listed if the list can be
+    reused: when checking many PR authors (list_all), in the webhook server, or between runs if persistent
+    caching is enabled. They are then fetched at most once every JIRA_COLLABORATORS_CACHE_TTL seconds.
+    Otherwise GitHub is only asked about this user.
+    """
+    collaborators = _get_collaborators(repo, list_all or _LIST_COLLABORATORS)
+    if collaborators is None:
+        return repo.has_in_collaborators(login)
+    return login.lower() in collaborators
+
+
+def _get_collaborators(repo, list_all):
+    """
+    Return the set of lower case collaborator logins of the repo, or None if they can't be listed
+    (or aren't listed, as list_all is False and there is no persistent cache).
+    """
+    ttl = int(os.environ.get('JIRA_COLLABORATORS_CACHE_TTL', 60 * 60))
+    with _COLLABORATORS_LOCK:
+        fetched = _COLLABORATORS.get(repo.url)
+        if fetched is None or time.time() - fetched[0] > ttl:
+            cache = _get_json_file_cache("github_collaborators.json", ttl)
+            if not list_all and not cache:
+                return None
+            logins = cache.get(repo.url) if cache else None
+            if logins is None:
+                try:
+                    logins = [user.login.lower() for user in repo.get_collaborators()]
+                except RateLimitExceededException:
+                    raise
+                except GithubException as e:
+                    # listing collaborators needs push access to the repo, checking a single user doesn't
+                    print("WARNING: Failed to list collaborators, checking PR authors one at a time: %s" % e)
+                    logins = None
+                if logins is not None and cache:
+                    cache.put(repo.url, logins)
+            fetched = _COLLABORATORS[repo.url] = (time.time(), set(logins) if logins is not None else None)
+        return fetched[1]
+
+
+@traced
+def _find_jira_issue(jira, gh_issue, make_new=False):
     """Look for a JIRA issue which has a remote link to the provided GitHub issue.
 
     Will also find "manually synced" issues that point to each other by name
     (see README), and create the remote link.
 
-    If make_new is True, a new issue will be created if one is not found.
+    If make_new is True, a new issue will be created if one is not found. Events on a GitHub
+    issue often come in a flurry (for example if someone creates and then edits or labels an
+    issue), and they're not always processed in order. So before creating an issue, wait for
+    any other GitHub Action which may be creating it already (see _wait_for_jira_issue()).
+    """
+    issue = _search_jira_issue(jira, gh_issue)
+    if issue is None and make_new:
+        issue = _wait_for_jira_issue(jira, gh_issue)
+        if issue is None:
+            print('Creating missing issue in JIRA')
+            issue = _create_jira_issue(jira, gh_issue)
+    return issue
+
+
+def _search_jira_issue(jira, gh_issue):
+    """
+    Return the JIRA issue synced with the provided GitHub issue, or None if there isn't one.
 
-    retries is an internal parameter used when make_new is set, to try and
-    avoid races when creating issues (wait a random amount of time and then look
-    again). This is useful because often events on a GitHub issue come in a
-    flurry (for example if someone creates and then edits or labels an issue),
-    # and they're not always processed in order.
+    The JIRA issue index is checked first, as the JQL search for remote links is slow.
+    """
+    url = gh_issue["html_url"]
+    index = _get_jira_issue_index()
+    if index is not None and index.get(url) is not None:
+        key = index.get(url)
+        try:
+            issue = jira.issue(key)
+            print("Found JIRA issue %s for '%s' in the issue index" % (issue.key, url))
+            if issue.key != key:
+                index.put(url, issue.key)  # the issue was moved to another project
+            return issue
+        except JIRAError:
+            print("JIRA issue %s from the issue index no longer exists" % key)
+            index.delete(url)
+
+    issue = _search_jira_issue_jql(jira, gh_issue)
+    if issue is not None and index is not None:
+        index.put(url, issue.key)
+    return issue
+
+
+def _search_jira_issue_jql(jira, gh_issue):
+    """
+    Return the JIRA issue with a remote link to the provided GitHub issue, or a manually synced
+    JIRA issue (see README), or None.
     """
     url = gh_issue["html_url"]
     jql_query = 'issue in issuesWithRemoteLinksByGlobalId("%s") order by updated desc' % url
@@ -441,35 +879,81 @@ def _find_jira_issue(jira, gh_issue, make_new=False, retries=5):
                     )
                     _add_remote_link(jira, issue, gh_issue)
                     return issue
-            except jira.exceptions.JIRAError:
+            except JIRAError:
                 pass  # issue doesn't exist or unauthorized
 
             # note: not logging anything on failure to avoid
             # potential information leak about other JIRA IDs
 
-        if not make_new:
-            return None
-        elif retries > 0:
-            # Wait a random amount of time to see if this JIRA issue is still being created by another
-            # GitHub Action. This is a hacky way to try and avoid the case where a GitHub issue is created
-            # and edited in a short window of time, and the two GitHub Actions race each other and produce
-            # two JIRA issues.
-            #
-            # The 'create' event will always create the issue, so it should be processed first unless it's
-            # delayed by more than (retries * min(range)) seconds. This does mean that it can take up to 5
-            # minutes for an old issue (created before the sync was installed), or an issue where the created
-            # event sync failed, to sync in.
-            print('Waiting to see if issue is created by another Action... (retries={})'.format(retries))
-            time.sleep(random.randrange(30, 60))
-            return _find_jira_issue(jira, gh_issue, True, retries - 1)
-        else:
-            print('Creating missing issue in JIRA')
-            return _create_jira_issue(jira, gh_issue)
+        return None
     if len(r) > 1:
         print("WARNING: Remote Link globalID '%s' returns multiple JIRA issues. Using last-updated only." % url)
     return r[0]
 
 
+@traced
+def _wait_for_jira_issue(jira, gh_issue):
+    """
+    Wait for a JIRA issue which another GitHub Action may be creating for the provided GitHub issue.
+    Returns the JIRA issue, or None if it wasn't created in time.
+
+    Until SYNC_WAIT_TIMEOUT seconds after the GitHub issue was opened, its 'opened' event may still
+    be running (or waiting to run), so look for the JIRA issue again with exponential backoff. An
+    old issue (created before the sync was installed, or where the 'opened' event sync failed) is
+    created straight away.
+    """
+    age = _get_issue_age(gh_issue)
+    if age is None or age >= SYNC_WAIT_TIMEOUT:
+        return None
+    deadline = time.time() + SYNC_WAIT_TIMEOUT - age
+    delay = SYNC_WAIT_FIRST_DELAY
+    while time.time() + delay <= deadline:
+        print('Waiting %.1fs to see if issue is created by another Action...' % delay)
+        time.sleep(delay)
+        issue = _search_jira_issue(jira, gh_issue)
+        if issue is not None:
+            return issue
+        delay = min(delay * 2, SYNC_WAIT_MAX_DELAY)
+    print('Timed out waiting for the issue to be created by another Action')
+    return None
+
+
+def _get_jira_issue_index():
+    """
+    Return the persistent index of GitHub issue URL to JIRA issue key, or None if persistent caching
+    is not enabled. Entries expire after JIRA_ISSUE_INDEX_TTL seconds (default 7 days), so that a
+    deleted remote link is noticed eventually.
+    """
+    return _get_json_file_cache("jira_issue_index.json", int(os.environ.get('JIRA_ISSUE_INDEX_TTL', 7 * 24 * 60 * 60)))
+
+
+def _get_jira_comment_index():
+    """
+    Return the persistent index of GitHub comment ID to JIRA comment ID, or None if persistent caching
+    is not enabled.
+    """
+    return _get_json_file_cache("jira_comment_index.json")
+
+
+def _get_json_file_cache(name, ttl=None):
+    path = cache_file(name)
+    if path is None:
+        return None
+    if path not in _JSON_FILE_CACHES:
+        _JSON_FILE_CACHES[path] = JsonFileCache(path, ttl)
+    return _JSON_FILE_CACHES[path]
+
+
+def _get_issue_age(gh_issue):
+    """
+    Return the number of seconds since the GitHub issue was opened, or None if the event doesn't say
+    """
+    if "created_at" not in gh_issue:
+        return None
+    created_at = datetime.datetime.strptime(gh_issue["created_at"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc)
+    return (datetime.datetime.now(datetime.timezone.utc) - created_at).total_seconds()
+
+
 def _leave_jira_issue_comment(jira, event, verb, should_create, jira_issue=None):
     """
     Leave a simple comment that the GitHub issue corresponding to this event was 'verb' by the GitHub user in question.
@@ -478,23 +962,100 @@ def _leave_jira_issue_comment(jira, event, verb, should_create, jira_issue=None)
 
     If should_create is set then a new JIRA issue will be opened if one can't be found.
     """
-    gh_issue = event["issue"]
-    is_pr = "pull_request" in gh_issue
-
     if jira_issue is None:
         jira_issue = _find_jira_issue(jira, event["issue"], should_create)
         if jira_issue is None:
             return None
+    jira.add_comment(jira_issue.id, _get_issue_event_comment(event, verb))
+    return jira_issue
+
+
+def _get_issue_event_comment(event, verb):
+    """
+    Return the body of the comment that the GitHub issue corresponding to this event was 'verb' by the GitHub user in question.
+    """
+    gh_issue = event["issue"]
+    is_pr = "pull_request" in gh_issue
     try:
         user = event["sender"]["login"]
     except KeyError:
         user = gh_issue["user"]["login"]
+    return "The [GitHub %s|%s] has been %s by @%s" % ("PR" if is_pr else "issue", gh_issue["html_url"], verb, user)
+
+
+def _add_jira_comment(jira, jira_issue, gh_comment):
+    comment = jira.add_comment(jira_issue.id, _get_jira_comment_body(gh_comment))
+    _index_jira_comment(jira_issue, gh_comment, comment)
+
+
+def _update_jira_comment(jira, jira_issue, gh_comment):
+    # Look for the old comment and update it if we find it
+    comment = _find_jira_comment(jira, jira_issue, gh_comment)
+    if comment is not None:
+        comment.update(body=_get_jira_comment_body(gh_comment))
+    else:  # if we didn't find the old comment, make a new comment about the edit
+        _add_jira_comment(jira, jira_issue, gh_comment)
 
+
+def _leave_comment_deleted(jira, jira_issue, gh_comment):
     jira.add_comment(
-        jira_issue.id,
-        "The [GitHub %s|%s] has been %s by @%s" % ("PR" if is_pr else "issue", gh_issue["html_url"], verb, user),
+        jira_issue.id, "@%s deleted [GitHub issue comment|%s]" % (gh_comment["user"]["login"], gh_comment["html_url"])
     )
-    return jira_issue
+
+
+def _find_jira_comment(jira, jira_issue, gh_comment):
+    """
+    Return the JIRA comment which was synced from the provided GitHub comment, or None.
+
+    Comments are looked up by ID in the comment index, or else in the IDs of the synced comments of
+    the JIRA issue kept in memory. These are found by the link to the GitHub comment at the start of
+    each comment body, the first time a comment of the JIRA issue is looked up (and again if the
+    comment isn't found, as another run may have synced it).
+    """
+    gh_comment_id = str(gh_comment["id"])
+    index = _get_jira_comment_index()
+    comment_id = index.get(gh_comment_id) if index else None
+    if comment_id is None:
+        comment_id = (_JIRA_COMMENT_IDS.get(jira_issue.key) or {}).get(gh_comment_id)
+    if comment_id is not None:
+        try:
+            return jira.comment(jira_issue.key, comment_id)
+        except JIRAError:
+            print("Synced JIRA comment %s no longer exists" % comment_id)
+            if index:
+                index.delete(gh_comment_id)
+
+    comment_ids = {}
+    found = None
+    for comment in jira.comments(jira_issue.key):
+        m = re.match(r"\[GitHub issue comment\|[^\]]*#issuecomment-(\d+)\]", comment.body)
+        if m is not None:
+            comment_ids[m.group(1)] = comment.id  # if there are several use the newest one
+            if m.group(1) == gh_comment_id:
+                found = comment
+    _JIRA_COMMENT_IDS.put(jira_issue.key, comment_ids)
+    if found is not None and index:
+        index.put(gh_comment_id, found.id)
+    return found
+
+
+def _index_jira_comment(jira_issue, gh_comment, comment):
+    """
+    Add a JIRA comment synced from a GitHub comment to the comment index, and to the synced comment IDs in memory
+    """
+    index = _get_jira_comment_index()
+    if index is not None:
+        index.put(str(gh_comment["id"]), comment.id)
+    comment_ids = _JIRA_COMMENT_IDS.get(jira_issue.key)
+    if comment_ids is not None:
+        comment_ids[str(gh_comment["id"])] = comment.id
+
+
+def _get_jira_comment_link(gh_comment):
+    """
+    Return the link to the GitHub comment which starts the body of a synced JIRA comment
+    """
+    return "[GitHub issue comment|%s]" % gh_comment["html_url"]
 
 
 def _get_jira_comment_body(gh_comment, body=None):
@@ -504,7 +1065,7 @@ def _get_jira_comment_body(gh_comment, body=None):
     """
     if body is None:
         body = _markdown2wiki(gh_comment["body"])
-    return "[GitHub issue comment|%s] by @%s:\n\n%s" % (gh_comment["html_url"], gh_comment["user"]["login"], body)
+    return "%s by @%s:\n\n%s" % (_get_jira_comment_link(gh_comment), gh_comment["user"]["login"], body)
 
 
 def _get_jira_label(gh_label):
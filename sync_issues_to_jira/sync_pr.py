@@ -14,30 +14,226 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import concurrent.futures
+import contextvars
+import datetime
 import os
-from jira import JIRA
-from github import Github
-from sync_issue import _find_jira_issue, _create_jira_issue
+import threading
+import time
+from jira import JIRA, JIRAError
+from github.GithubException import GithubException, RateLimitExceededException
+from http_session import get_session
+from sync_issue import _find_jira_issue, _create_jira_issue, _get_json_file_cache, _get_github, _get_repo, _is_collaborator
+from tracing import traced
 
+# Number of PRs checked at the same time
+SYNC_PR_WORKERS = int(os.environ.get('JIRA_SYNC_WORKERS', 4))
+# Stop making GitHub requests when fewer than this many are left before the rate limit resets,
+# to leave some for other workflows
+GITHUB_RATE_LIMIT_RESERVE = 100
+# Number of times to retry a PR after being rate limited
+RATE_LIMIT_RETRIES = 3
 
+GITHUB_GRAPHQL_URL = os.environ.get('GITHUB_GRAPHQL_URL', 'https://api.github.com/graphql')
+# Number of PRs fetched per GraphQL request (100 is the maximum)
+GRAPHQL_PAGE_SIZE = 100
+
+OPEN_PRS_QUERY = """
+query($owner: String!, $name: String!, $first: Int!, $after: String, $orderBy: IssueOrderField!) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, first: $first, after: $after, orderBy: {field: $orderBy, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        title
+        body
+        url
+        state
+        updatedAt
+        authorAssociation
+        author { __typename login }
+        labels(first: 100) { nodes { name } }
+        comments { totalCount }
+      }
+    }
+  }
+}
+"""
+
+
+class _Throttle(object):
+    """
+    Shared by the workers syncing PRs, so that they all pause when GitHub or JIRA rate limits are close.
+
+    GitHub's X-RateLimit-Remaining and X-RateLimit-Reset headers from the latest response are
+    tracked by PyGithub. JIRA sends a Retry-After header with a 429 response.
+    """
+    def __init__(self, github):
+        self.github = github
+        self._lock = threading.Lock()
+        self._resume_at = 0
+
+    def wait(self):
+        """
+        Sleep until it's OK to make more API requests
+        """
+        remaining, _ = self.github.rate_limiting
+        if remaining < GITHUB_RATE_LIMIT_RESERVE:
+            self.pause_until(self.github.rate_limiting_resettime, 'GitHub rate limit (%d requests left)' % remaining)
+        with self._lock:
+            delay = self._resume_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause_until(self, resume_at, reason):
+        with self._lock:
+            if resume_at > self._resume_at:
+                print('Pausing for %ds: %s' % (resume_at - time.time(), reason))
+                self._resume_at = resume_at
+
+    def pause_for_error(self, e):
+        """
+        If the exception is a rate limit error, pause all workers and return True
+        """
+        if isinstance(e, RateLimitExceededException):
+            # GraphQL requests have their own rate limit, which isn't tracked by PyGithub
+            resume_at = int((e.headers or {}).get('x-ratelimit-reset', self.github.rate_limiting_resettime))
+            self.pause_until(resume_at, 'GitHub rate limit exceeded')
+            return True
+        if isinstance(e, JIRAError) and e.status_code == 429:
+            retry_after = e.response.headers.get('Retry-After', '60') if e.response is not None else '60'
+            self.pause_until(time.time() + int(retry_after), 'JIRA rate limit exceeded')
+            return True
+        return False
+
+
+@traced
 def sync_remain_prs(jira):
     """
     Sync remain PRs (i.e. PRs without any comments) to Jira
+
+    PRs are checked by SYNC_PR_WORKERS threads. If the INPUT_CRON_SINCE_LAST_RUN environment variable is set
+    (and persistent caching is enabled), only PRs updated since the last successful run are checked.
+    """
+    repo = _get_repo()
+    throttle = _Throttle(_get_github())
+
+    state = _get_json_file_cache("sync_remain_prs.json")
+    since = None
+    if os.environ.get('INPUT_CRON_SINCE_LAST_RUN') and state is not None and state.get("last_run"):
+        since = datetime.datetime.strptime(state.get("last_run"), "%Y-%m-%dT%H:%M:%S")
+        print('Checking PRs updated since %s' % since)
+        prs = _get_open_prs(throttle, "UPDATED_AT")
+    else:
+        prs = _get_open_prs(throttle, "CREATED_AT")
+    started = datetime.datetime.utcnow()
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SYNC_PR_WORKERS) as executor:
+        futures = {}
+        for gh_issue in prs:
+            if since is not None and datetime.datetime.strptime(gh_issue["updated_at"], "%Y-%m-%dT%H:%M:%SZ") < since:
+                break
+            futures[executor.submit(contextvars.copy_context().run, _sync_remain_pr, jira, repo, gh_issue, throttle)] = gh_issue
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print('Failed to sync PR #%d: %s' % (futures[future]["number"], e))
+                failed.append(e)
+
+    print('Checked %d PRs' % len(futures))
+    if failed:
+        raise failed[0]
+    if state is not None:
+        state.put("last_run", started.strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+def _get_open_prs(throttle, order_by):
+    """
+    Yield a mock github issue for each open PR, newest first by 'order_by' ("CREATED_AT" or "UPDATED_AT").
+
+    The PRs are fetched with one GraphQL request per GRAPHQL_PAGE_SIZE PRs. Pages are only fetched
+    as they're needed, so the caller can stop early.
     """
-    github = Github(os.environ['GITHUB_TOKEN'])
-    repo = github.get_repo(os.environ['GITHUB_REPOSITORY'])
-    prs = repo.get_pulls(state="open", sort="created", direction="desc")
-    for pr in prs:
-        if not repo.has_in_collaborators(pr.user.login) and not pr.comments:
-            # mock a github issue using current PR
-            gh_issue = {"pull_request": True,
-                        "labels": [{"name": l.name} for l in pr.labels],
-                        "number": pr.number,
-                        "title": pr.title,
-                        "html_url": pr.html_url,
-                        "user": {"login": pr.user.login},
-                        "state": pr.state,
-                        "body": pr.body}
+    owner, name = os.environ['GITHUB_REPOSITORY'].split('/')
+    variables = {"owner": owner, "name": name, "first": GRAPHQL_PAGE_SIZE, "after": None, "orderBy": order_by}
+    while True:
+        for retry in range(RATE_LIMIT_RETRIES + 1):
+            throttle.wait()
+            try:
+                pull_requests = _graphql(OPEN_PRS_QUERY, variables)["repository"]["pullRequests"]
+                break
+            except RateLimitExceededException as e:
+                if retry == RATE_LIMIT_RETRIES or not throttle.pause_for_error(e):
+                    raise
+        for pr in pull_requests["nodes"]:
+            yield _get_pr_gh_issue(pr)
+        if not pull_requests["pageInfo"]["hasNextPage"]:
+            return
+        variables["after"] = pull_requests["pageInfo"]["endCursor"]
+
+
+def _get_pr_gh_issue(pr):
+    """
+    Return a mock github issue (in the format of the webhook event payload) for a PR from a GraphQL response
+    """
+    author = pr["author"] or {"__typename": "User", "login": "ghost"}  # author is null for deleted accounts
+    login = author["login"]
+    if author["__typename"] == "Bot":
+        login += "[bot]"  # as in the REST API
+    return {"pull_request": True,
+            "labels": [{"name": label["name"]} for label in pr["labels"]["nodes"]],
+            "number": pr["number"],
+            "title": pr["title"],
+            "html_url": pr["url"],
+            "user": {"login": login},
+            "author_association": pr["authorAssociation"],
+            "comments": pr["comments"]["totalCount"],
+            "updated_at": pr["updatedAt"],
+            "state": pr["state"].lower(),
+            "body": pr["body"]}
+
+
+def _graphql(query, variables):
+    """
+    Run a GitHub GraphQL query and return its data, raising GithubException on errors
+    """
+    response = get_session().post(GITHUB_GRAPHQL_URL, json={"query": query, "variables": variables},
+                                  headers={"Authorization": "bearer %s" % os.environ['GITHUB_TOKEN']}, timeout=60)
+    headers = {k.lower(): v for k, v in response.headers.items()}
+    try:
+        output = response.json()
+    except ValueError:
+        output = {"message": response.text}
+    errors = output.get("errors") or []
+    if response.status_code in (403, 429) and headers.get("x-ratelimit-remaining") == "0":
+        raise RateLimitExceededException(response.status_code, output, headers)
+    if any(error.get("type") == "RATE_LIMITED" for error in errors):
+        raise RateLimitExceededException(response.status_code, output, headers)
+    if response.status_code != 200 or errors:
+        raise GithubException(response.status_code, output, headers)
+    return output["data"]
+
+
+@traced
+def _sync_remain_pr(jira, repo, gh_issue, throttle):
+    """
+    Create a JIRA issue for the PR, if it needs one and doesn't have one yet.
+
+    The checks are retried after rate limit errors. Creating the issue isn't, as a retry could
+    create a second JIRA issue.
+    """
+    for retry in range(RATE_LIMIT_RETRIES + 1):
+        throttle.wait()
+        try:
+            if _is_collaborator(repo, gh_issue["user"]["login"], list_all=True) or gh_issue["comments"]:
+                return
             issue = _find_jira_issue(jira, gh_issue)
-            if issue is None:
-                _create_jira_issue(jira, gh_issue)
+            break
+        except (RateLimitExceededException, JIRAError) as e:
+            if retry == RATE_LIMIT_RETRIES or not throttle.pause_for_error(e):
+                raise
+
+    if issue is None:
+        _create_jira_issue(jira, gh_issue)
@@ -15,20 +15,58 @@
 # limitations under the License.
 #
 from jira import JIRA
-from github import Github
 import os
 import sys
 import json
+from coalesce import normalize_event, sync_event_queue
+from http_session import mount_adapters
 from sync_pr import sync_remain_prs
 from sync_issue import *
+from sync_issue import _get_repo, _is_collaborator
+import tracing
+
+
+ACTION_HANDLERS = {
+    'issues': {
+        'opened': handle_issue_opened,
+        'edited': handle_issue_edited,
+        'closed': handle_issue_closed,
+        'deleted': handle_issue_deleted,
+        'reopened': handle_issue_reopened,
+        'labeled': handle_issue_labeled,
+        'unlabeled': handle_issue_unlabeled,
+    },
+    'issue_comment': {
+        'created': handle_comment_created,
+        'edited': handle_comment_edited,
+        'deleted': handle_comment_deleted,
+    },
+}
 
 
 class _JIRA(JIRA):
     def applicationlinks(self):
         return []  # disable this function as we don't need it and it makes add_remote_links() slow
 
+    def _create_http_basic_session(self, *args, **kwargs):
+        super()._create_http_basic_session(*args, **kwargs)
+        mount_adapters(self._session)
+
+
+@tracing.traced
+def connect_jira():
+    return _JIRA(os.environ['JIRA_URL'], basic_auth=(os.environ['JIRA_USER'], os.environ['JIRA_PASS']))
+
 
 def main():
+    try:
+        with tracing.span('main'):
+            _main()
+    finally:
+        tracing.write_results()
+
+
+def _main():
     if 'GITHUB_REPOSITORY' not in os.environ:
         print('Not running in GitHub action context, nothing to do')
         return
@@ -39,19 +77,25 @@ def main():
 
     # Connect to Jira server
     print('Connecting to Jira Server...')
-    jira = _JIRA(os.environ['JIRA_URL'], basic_auth=(os.environ['JIRA_USER'], os.environ['JIRA_PASS']))
+    jira = connect_jira()
 
     # Check if it's a cron job
     if os.environ.get('INPUT_CRON_JOB'):
         sync_remain_prs(jira)
         return
 
+    # Check if it's syncing a queue of events
+    if os.environ.get('INPUT_EVENT_QUEUE'):
+        sync_event_queue(jira, os.environ['INPUT_EVENT_QUEUE'])
+        return
+
     # The path of the file with the complete webhook event payload. For example, /github/workflow/event.json.
     with open(os.environ['GITHUB_EVENT_PATH'], 'r') as f:
         event = json.load(f)
         print(json.dumps(event, indent=4))
 
     event_name = os.environ['GITHUB_EVENT_NAME']
+    tracing.annotate(event=event_name, action=event.get('action'))
 
     # Check if event is workflow_dispatch and action is mirror issues. If so, run manual mirroring and skip rest of the script. Works both for issues and pull requests.
     if event_name == 'workflow_dispatch':
@@ -63,60 +107,49 @@ def main():
 
         input_action = inputs.get('action')
         issue_numbers = inputs.get('issue-numbers')
-        if input_action != 'mirror-issues':
-            print('This action needs input "mirror-issues". Exiting...')
+        if input_action not in ('mirror-issues', 'mirror-issues-bulk'):
+            print('This action needs input "mirror-issues" or "mirror-issues-bulk". Exiting...')
             return
         if not issue_numbers:
             print('This action needs inputs "issue-numbers". Exiting...')
             return
 
         print(f'Starting manual sync of issues: {issue_numbers}')
-        sync_issues_manually(jira, event)
+        if input_action == 'mirror-issues-bulk':
+            sync_issues_in_bulk(jira, event)
+        else:
+            sync_issues_manually(jira, event)
         return
 
-    # The name of the webhook event that triggered the workflow.
-    action = event["action"]
+    handle_event(jira, event_name, event)
+
 
-    if event_name == 'pull_request':
-        # Treat pull request events just like issues events for syncing purposes
-        # (we can check the 'pull_request' key in the "issue" later to know if this is an issue or a PR)
-        event_name = 'issues'
-        event["issue"] = event["pull_request"]
-        if "pull_request" not in event["issue"]:
-            event["issue"]["pull_request"] = True  # we don't care about the value
+@tracing.traced
+def handle_event(jira, event_name, event):
+    """
+    Sync one webhook event (apart from workflow_dispatch) to JIRA
+    """
+    # Treat pull request events just like issues events for syncing purposes
+    event_name, event = normalize_event(event_name, event)
+
+    # The action of the webhook event, e.g. 'opened'
+    action = event.get("action")
+
+    if event_name not in ACTION_HANDLERS:
+        print("No handler for event '%s'. Skipping." % event_name)
+        return
+    if action not in ACTION_HANDLERS[event_name]:
+        print("No handler '%s' action '%s'. Skipping." % (event_name, action))
+        return
 
     # don't sync if user is our collaborator
-    github = Github(os.environ['GITHUB_TOKEN'])
-    repo = github.get_repo(os.environ['GITHUB_REPOSITORY'])
     gh_issue = event["issue"]
     is_pr = "pull_request" in gh_issue
-    if is_pr and repo.has_in_collaborators(gh_issue["user"]["login"]):
+    if is_pr and _is_collaborator(_get_repo(), gh_issue["user"]["login"]):
         print("Skipping issue sync for Pull Request from collaborator")
         return
 
-    action_handlers = {
-        'issues': {
-            'opened': handle_issue_opened,
-            'edited': handle_issue_edited,
-            'closed': handle_issue_closed,
-            'deleted': handle_issue_deleted,
-            'reopened': handle_issue_reopened,
-            'labeled': handle_issue_labeled,
-            'unlabeled': handle_issue_unlabeled,
-        },
-        'issue_comment': {
-            'created': handle_comment_created,
-            'edited': handle_comment_edited,
-            'deleted': handle_comment_deleted,
-        },
-    }
-
-    if event_name not in action_handlers:
-        print("No handler for event '%s'. Skipping." % event_name)
-    elif action not in action_handlers[event_name]:
-        print("No handler '%s' action '%s'. Skipping." % (event_name, action))
-    else:
-        action_handlers[event_name][action](jira, event)
+    ACTION_HANDLERS[event_name][action](jira, event)
 
 
 if __name__ == "__main__":
@@ -16,24 +16,52 @@
 #
 import jira
 import github
+import collections
 import json
 import sync_to_jira
 import sync_issue
+import sync_pr
+import cache
+import coalesce
+import webhook_server
 import os
 import unittest
 import unittest.mock
 from unittest.mock import create_autospec
 import tempfile
+import threading
+import time
+import datetime
+import hashlib
+import hmac
+import http.client
+import http.server
+import re
+import shutil
+import http_session
+import tracing
+from fake_api_server import FakeGitHubServer, FakeJiraServer
+from markdown2wiki import markdown2wiki
 
 MOCK_GITHUB_TOKEN = "iamagithubtoken"
+# run_sync_issue() replaces these with mocks
+REAL_JIRA_CLASS = sync_to_jira._JIRA
+REAL_GITHUB_CLASS = sync_issue.Github
+MARKDOWN2WIKI_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_markdown2wiki")
+BENCHMARK_EVENTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_events")
 
+if not shutil.which("markdown2confluence"):
+    os.environ.setdefault("MARKDOWN_CONVERTER", "markdown2wiki")  # outside the Docker image
 
-def run_sync_issue(event_name, event, jira_issue=None):
+
+def run_sync_issue(event_name, event, jira_issue=None, setup_jira=None):
     """
     Run the 'sync_issue' main() function with supplied event (as Python dict), event name, and mocked JIRA PAI.
 
     If jira_issue is not None, this JIRA issue object will be
     returned as the only result of a call to JIRA.search_issues().
+
+    If setup_jira is not None, it is called with the mock JIRA object before main() runs.
     """
     try:
         # dump the event data to a JSON file
@@ -68,8 +96,8 @@ def run_sync_issue(event_name, event, jira_issue=None):
         issue_type_task.name = "Task"
         issue_type_task.id = 5002
         issue_type_new_feature = create_autospec(jira.resources.IssueType)
-        issue_type_task.name = "New Feature"
-        issue_type_task.id = 5003
+        issue_type_new_feature.name = "New Feature"
+        issue_type_new_feature.id = 5003
 
         jira_class.return_value.issue_types.return_value = [
             issue_type_bug,
@@ -90,9 +118,12 @@ def run_sync_issue(event_name, event, jira_issue=None):
         else:
             jira_class.return_value.search_issues.return_value = []
 
+        if setup_jira is not None:
+            setup_jira(jira_class.return_value)
+
         sync_to_jira._JIRA = jira_class
-        sync_to_jira.Github = github_class
         sync_issue.Github = github_class
+        sync_issue._GITHUB_CLIENT = None
         sync_to_jira.main()
 
         return jira_class.return_value  # mock JIRA object
@@ -101,6 +132,32 @@ def run_sync_issue(event_name, event, jira_issue=None):
         os.unlink(event_file.name)
 
 
+def count_api_calls(m_jira, jira_issue=None):
+    """
+    Return a Counter of the JIRA and GitHub API methods called by the last run_sync_issue(), for example
+    {"jira.search_issues": 1, "jira_issue.update": 1, "github.get_issue": 1, "github.get_issue().edit": 1}.
+
+    Each call of a JIRA or GitHub client method stands for one API request. Creating the clients and
+    the (lazy) GitHub repository object don't make requests, so they aren't counted.
+    """
+    counts = collections.Counter()
+
+    def add(prefix, mock_calls):
+        for name, _, _ in mock_calls:
+            if name and not re.search(r"\.__\w+__$", name):
+                counts[prefix + name] += 1
+
+    add("jira.", m_jira.mock_calls)
+    for link in m_jira.remote_links.return_value or []:
+        add("jira.remote_link.", link.mock_calls)
+    if jira_issue is not None:
+        add("jira_issue.", jira_issue.mock_calls)
+    repo_calls = [(name[len("().get_repo()."):], args, kwargs) for name, args, kwargs in sync_issue.Github.mock_calls
+                  if name.startswith("().get_repo().")]
+    add("github.", repo_calls)
+    return counts
+
+
 class TestIssuesEvents(unittest.TestCase):
 
     def test_issue_opened(self):
@@ -136,9 +193,10 @@ class TestIssuesEvents(unittest.TestCase):
         self.assertEqual(issue["html_url"], rl_args["globalId"])
 
         # check that the github repo was updated via expected sequence of API calls
-        sync_issue.Github.assert_called_with(MOCK_GITHUB_TOKEN)
+        sync_issue.Github.assert_called_with(MOCK_GITHUB_TOKEN, base_url=unittest.mock.ANY, retry=unittest.mock.ANY, pool_size=unittest.mock.ANY,
+                                             per_page=100)
         github_obj = sync_issue.Github.return_value
-        github_obj.get_repo.assert_called_with("espressif/fake")
+        github_obj.get_repo.assert_called_with("espressif/fake", lazy=True)
         repo_obj = github_obj.get_repo.return_value
         repo_obj.get_issue.assert_called_with(issue["number"])
         issue_obj = repo_obj.get_issue.return_value
@@ -175,15 +233,41 @@ class TestIssuesEvents(unittest.TestCase):
                  "labels": [],
                  }
 
-        m_jira = self._test_issue_simple_comment("edited", issue)
-
-        # check the update resembles the edited issue
-        m_issue = m_jira.search_issues.return_value[0]
+        m_issue = create_autospec(jira.Issue)(None, None)
+        m_jira = run_sync_issue('issues', {"action": "edited", "issue": issue}, m_issue)
 
+        # check the update resembles the edited issue, and leaves the comment in the same request
+        m_issue.update.assert_called_once()
         update_args = m_issue.update.call_args[1]
         self.assertIn("description", update_args["fields"])
         self.assertIn("summary", update_args["fields"])
         self.assertIn(issue["title"], update_args["fields"]["summary"])
+        comment = update_args["update"]["comment"][0]["add"]["body"]
+        self.assertIn("edituser", comment)
+        self.assertIn("edited", comment)
+        m_jira.add_comment.assert_not_called()
+
+    def test_issue_labeled(self):
+        self._test_issue_label("labeled", {"labels": [{"add": "bug"}]})
+
+    def test_issue_unlabeled(self):
+        self._test_issue_label("unlabeled", {"labels": [{"remove": "bug"}]})
+
+    def _test_issue_label(self, action, expected_update):
+        issue = {"html_url": "https://github.com/espressif/fake/issues/12",
+                 "number": 12,
+                 "title": "Labeled issue",
+                 "body": "Labeled issue content",
+                 "user": {"login": "labeluser"},
+                 "state": "open",
+                 "labels": [{"name": "bug"}] if action == "labeled" else [],
+                 }
+        m_issue = create_autospec(jira.Issue)(None, None)
+
+        run_sync_issue('issues', {"action": action, "issue": issue, "label": {"name": "bug"}}, m_issue)
+
+        # labels are changed without sending (or reading) the whole list of labels
+        m_issue.update.assert_called_once_with(fields={}, update=expected_update)
 
     def _test_issue_simple_comment(self, action, gh_issue=None):
         """
@@ -297,5 +381,1401 @@ class TestIssueCommentEvents(unittest.TestCase):
         return m_jira
 
 
+class TestRequestBudgets(unittest.TestCase):
+    """
+    Upper bounds on the JIRA and GitHub API calls made for each event, so a change which adds requests
+    has to update the budget here.
+    """
+    # Calls of these methods are only allowed where a budget lists them
+    WATCHED = ["jira.search_issues", "jira.remote_links", "jira.comments", "jira.issue_types", "jira.project_components",
+               "github.get_collaborators", "github.has_in_collaborators"]
+    # (event name, action, budget): the budget has the maximum number of calls to "jira" and "github" in total, and to
+    # each watched method
+    BUDGETS = [
+        ("issues", "opened", {"jira": 3, "github": 4, "jira.issue_types": 1}),
+        ("issues", "edited", {"jira": 4, "github": 0, "jira.search_issues": 1, "jira.remote_links": 1}),
+        ("issues", "closed", {"jira": 4, "github": 0, "jira.search_issues": 1, "jira.remote_links": 1}),
+        ("issues", "reopened", {"jira": 4, "github": 0, "jira.search_issues": 1, "jira.remote_links": 1}),
+        ("issues", "deleted", {"jira": 2, "github": 0, "jira.search_issues": 1}),
+        ("issues", "labeled", {"jira": 2, "github": 0, "jira.search_issues": 1}),
+        ("issues", "unlabeled", {"jira": 2, "github": 0, "jira.search_issues": 1}),
+        ("issue_comment", "created", {"jira": 2, "github": 0, "jira.search_issues": 1}),
+        ("issue_comment", "edited", {"jira": 3, "github": 0, "jira.search_issues": 1, "jira.comments": 1}),
+        ("issue_comment", "deleted", {"jira": 2, "github": 0, "jira.search_issues": 1}),
+        ("pull_request", "opened", {"jira": 3, "github": 5, "jira.issue_types": 1, "github.has_in_collaborators": 1}),
+    ]
+
+    def setUp(self):
+        os.environ.pop('JIRA_COMPONENT', None)
+        os.environ.pop('JIRA_SYNC_CACHE_DIR', None)
+        patcher = unittest.mock.patch("sync_issue._COLLABORATORS", {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _event(self, event_name, action):
+        gh_issue = {"html_url": "https://github.com/espressif/fake/issues/20",
+                    "number": 20,
+                    "title": "Budget issue",
+                    "body": "Body",
+                    "user": {"login": "budgetuser"},
+                    "labels": [{"name": "Type: Bug"}],
+                    "state": "closed" if action == "closed" else "open",
+                    }
+        event = {"action": action, "issue": gh_issue, "label": {"name": "bug"}}
+        if event_name == "issue_comment":
+            event["comment"] = {"html_url": gh_issue["html_url"] + "#1", "id": 1, "user": {"login": "commentuser"}, "body": "Comment"}
+        if event_name == "pull_request":
+            event["pull_request"] = dict(gh_issue, html_url="https://github.com/espressif/fake/pull/20")
+            del event["issue"]
+        return event
+
+    def _check_budget(self, event_name, action, budget):
+        jira_issue = None
+        if action != "opened":
+            jira_issue = create_autospec(jira.Issue)(None, None)
+            jira_issue.id = 1
+            jira_issue.key = "TEST-1"
+            jira_issue.fields = unittest.mock.Mock(labels=[], components=[])
+            jira_issue.fields.project.key = "TEST"
+
+        m_jira = run_sync_issue(event_name, self._event(event_name, action), jira_issue)
+
+        counts = count_api_calls(m_jira, jira_issue)
+        totals = {"jira": sum(n for name, n in counts.items() if name.startswith("jira")),
+                  "github": sum(n for name, n in counts.items() if name.startswith("github"))}
+        for name in ["jira", "github"] + self.WATCHED:
+            used = totals.get(name, counts[name])
+            self.assertLessEqual(used, budget.get(name, 0), "%s %s made %d %s calls: %s" % (event_name, action, used, name, dict(counts)))
+        return counts
+
+    def test_event_budgets(self):
+        for event_name, action, budget in self.BUDGETS:
+            with self.subTest(event=event_name, action=action):
+                self._check_budget(event_name, action, budget)
+
+    def test_component_budget(self):
+        with unittest.mock.patch.dict(os.environ, {"JIRA_COMPONENT": "Component"}):
+            self._check_budget("issues", "edited", {"jira": 5, "github": 0, "jira.search_issues": 1, "jira.remote_links": 1,
+                                                    "jira.project_components": 1})
+
+    def test_collaborators_listed_when_reused(self):
+        # in the webhook server, the collaborators listed for one PR are reused for the next
+        with unittest.mock.patch("sync_issue._LIST_COLLABORATORS", True):
+            counts = self._check_budget("pull_request", "opened", {"jira": 3, "github": 5, "jira.issue_types": 1,
+                                                                   "github.get_collaborators": 1})
+        self.assertEqual(1, counts["github.get_collaborators"])
+
+        # and so are the collaborators kept in the persistent cache
+        m_repo = create_autospec(github.Repository.Repository)
+        m_repo.url = "https://api.github.com/repos/espressif/fake"
+        m_repo.get_collaborators.return_value = [unittest.mock.Mock(login="Collaborator")]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with unittest.mock.patch.dict(os.environ, {"JIRA_SYNC_CACHE_DIR": cache_dir}), \
+                    unittest.mock.patch("sync_issue._JSON_FILE_CACHES", {}):
+                sync_issue._COLLABORATORS.clear()
+                self.assertTrue(sync_issue._is_collaborator(m_repo, "collaborator"))
+                sync_issue._COLLABORATORS.clear()  # as if this was a new run
+                self.assertFalse(sync_issue._is_collaborator(m_repo, "contributor"))
+        m_repo.get_collaborators.assert_called_once_with()
+        m_repo.has_in_collaborators.assert_not_called()
+
+
+class FakeJira(object):
+    """
+    A minimal in-memory JIRA server, for tests where the order of concurrent calls matters.
+
+    create_delay is the time create_issue() takes, to widen race windows.
+    """
+    def __init__(self, create_delay=0):
+        self.create_delay = create_delay
+        self.issues = []
+        self.comment_count = 0
+        self.lock = threading.Lock()
+
+    def search_issues(self, jql_str, **kwargs):
+        urls = re.findall(r'"([^"]+)"', jql_str)
+        with self.lock:
+            return [i for i in self.issues if any(getattr(link, "globalId", None) in urls for link in i.links)]
+
+    def create_issue(self, fields):
+        if self.create_delay:
+            time.sleep(self.create_delay)
+        with self.lock:
+            issue = unittest.mock.Mock(key="TEST-%d" % (len(self.issues) + 1), id=len(self.issues) + 1, links=[], comments=[])
+            issue.fields = unittest.mock.Mock(summary=fields["summary"], description=fields["description"], labels=list(fields["labels"]))
+            issue.update.side_effect = lambda fields=None, update=None: self._update_issue(issue, fields or {}, update or {})
+            self.issues.append(issue)
+            return issue
+
+    def _update_issue(self, issue, fields, update):
+        with self.lock:
+            for name, value in fields.items():
+                setattr(issue.fields, name, value)
+            for verb in update.get("labels", []):
+                if "add" in verb and verb["add"] not in issue.fields.labels:
+                    issue.fields.labels = issue.fields.labels + [verb["add"]]
+                elif "remove" in verb:
+                    issue.fields.labels = [label for label in issue.fields.labels if label != verb["remove"]]
+            for verb in update.get("comment", []):
+                self._new_comment(issue, verb["add"]["body"])
+
+    def add_remote_link(self, issue, destination, globalId, relationship):
+        link = unittest.mock.Mock(globalId=globalId, relationship=relationship,
+                                  raw={"object": {"url": destination["url"], "title": destination["title"],
+                                                  "status": dict(destination.get("status", {}))}})
+        with self.lock:
+            issue.links.append(link)
+
+    def remote_links(self, issue):
+        return list(issue.links)
+
+    def issue(self, key):
+        with self.lock:
+            for issue in self.issues:
+                if issue.key == key:
+                    return issue
+        raise jira.JIRAError(status_code=404, text="Issue Does Not Exist")
+
+    def add_comment(self, issue_id, body):
+        with self.lock:
+            return self._new_comment(next(i for i in self.issues if i.id == issue_id), body)
+
+    def _new_comment(self, issue, body):
+        self.comment_count += 1
+        comment = unittest.mock.Mock(id=str(10000 + self.comment_count), body=body)
+        comment.update.side_effect = lambda body: setattr(comment, "body", body)
+        issue.comments.append(comment)
+        return comment
+
+    def comments(self, issue_key):
+        return list(self.issue(issue_key).comments)
+
+    def comment(self, issue_key, comment_id):
+        for comment in self.issue(issue_key).comments:
+            if comment.id == comment_id:
+                return comment
+        raise jira.JIRAError(status_code=404, text="Comment Does Not Exist")
+
+    def issue_types(self):
+        return []
+
+
+class FakeGitHubRepo(object):
+    """
+    A minimal GitHub repository holding one issue, with labels and title that can be edited.
+    """
+    def __init__(self, gh_issue):
+        self.issue = unittest.mock.Mock(number=gh_issue["number"], title=gh_issue["title"], labels=[])
+        self.issue.add_to_labels.side_effect = self._add_label
+        self.issue.remove_from_labels.side_effect = self._remove_label
+        self.issue.edit.side_effect = self._edit
+
+    def _add_label(self, name):
+        label = unittest.mock.Mock()
+        label.name = name
+        self.issue.labels = self.issue.labels + [label]
+
+    def _remove_label(self, name):
+        self.issue.labels = [label for label in self.issue.labels if label.name != name]
+
+    def _edit(self, title):
+        self.issue.title = title
+
+    def get_issue(self, number):
+        return self.issue
+
+
+class TestCreateRace(unittest.TestCase):
+    """
+    Events which arrive at nearly the same time for a new GitHub issue should only create one JIRA issue
+    """
+
+    def setUp(self):
+        os.environ['JIRA_PROJECT'] = 'TEST'
+        os.environ.pop('JIRA_COMPONENT', None)
+        patcher = unittest.mock.patch.multiple("sync_issue", SYNC_WAIT_FIRST_DELAY=0.05, SYNC_WAIT_MAX_DELAY=0.2, SYNC_WAIT_TIMEOUT=5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _make_gh_issue(self, age=0):
+        created_at = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=age)
+        return {"html_url": "https://github.com/espressif/fake/issues/7",
+                "number": 7,
+                "title": "Racy issue",
+                "body": "Created and then quickly edited",
+                "user": {"login": "testuser"},
+                "labels": [],
+                "state": "open",
+                "created_at": created_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                }
+
+    def _run_concurrently(self, fake_jira, fake_repo, events, start_delays):
+        errors = []
+
+        def run(handler, event, start_delay):
+            time.sleep(start_delay)
+            try:
+                handler(fake_jira, event)
+            except Exception as e:
+                errors.append(e)
+
+        with unittest.mock.patch("sync_issue._get_repo", return_value=fake_repo):
+            threads = [threading.Thread(target=run, args=(handler, event, delay))
+                       for (handler, event), delay in zip(events, start_delays)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual([], errors)
+        return time.time() - start
+
+    def test_edit_while_creating(self):
+        gh_issue = self._make_gh_issue()
+        fake_jira = FakeJira(create_delay=0.5)
+        fake_repo = FakeGitHubRepo(gh_issue)
+        edited_gh_issue = dict(gh_issue, body="Edited while creating")
+        events = [(sync_issue.handle_issue_opened, {"action": "opened", "issue": gh_issue}),
+                  (sync_issue.handle_issue_edited, {"action": "edited", "issue": edited_gh_issue, "sender": {"login": "testuser"}})]
+
+        elapsed = self._run_concurrently(fake_jira, fake_repo, events, [0, 0.1])
+
+        self.assertEqual(1, len(fake_jira.issues))
+        self.assertEqual(1, len(fake_jira.issues[0].links))
+        self.assertIn("edited", fake_jira.issues[0].comments[0].body)
+        self.assertEqual("Racy issue (TEST-1)", fake_repo.issue.title)
+        fake_repo.issue.add_to_labels.assert_not_called()
+        self.assertLess(elapsed, 2)
+
+    def test_edit_before_opened_event(self):
+        gh_issue = self._make_gh_issue()
+        fake_jira = FakeJira(create_delay=0.1)
+        fake_repo = FakeGitHubRepo(gh_issue)
+        events = [(sync_issue.handle_issue_edited, {"action": "edited", "issue": dict(gh_issue), "sender": {"login": "testuser"}}),
+                  (sync_issue.handle_issue_opened, {"action": "opened", "issue": gh_issue})]
+
+        self._run_concurrently(fake_jira, fake_repo, events, [0, 0.2])
+
+        self.assertEqual(1, len(fake_jira.issues))
+        self.assertEqual("Racy issue (TEST-1)", fake_repo.issue.title)
+
+    def test_old_issue_created_without_waiting(self):
+        gh_issue = self._make_gh_issue(age=3600)
+        fake_jira = FakeJira()
+        fake_repo = FakeGitHubRepo(gh_issue)
+        event = {"action": "edited", "issue": gh_issue, "sender": {"login": "testuser"}}
+
+        with unittest.mock.patch("sync_issue._get_repo", return_value=fake_repo), unittest.mock.patch("sync_issue.time.sleep") as m_sleep:
+            sync_issue.handle_issue_edited(fake_jira, event)
+
+        m_sleep.assert_not_called()
+        self.assertEqual(1, len(fake_jira.issues))
+
+    def test_wait_ends_with_issue_age(self):
+        # the 'opened' event sync failed, so only wait out the rest of SYNC_WAIT_TIMEOUT after the issue was opened
+        gh_issue = self._make_gh_issue(age=4)
+        fake_jira = FakeJira()
+        fake_repo = FakeGitHubRepo(gh_issue)
+        event = {"action": "edited", "issue": gh_issue, "sender": {"login": "testuser"}}
+
+        with unittest.mock.patch("sync_issue._get_repo", return_value=fake_repo):
+            start = time.time()
+            sync_issue.handle_issue_edited(fake_jira, event)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(1, len(fake_jira.issues))
+
+    def test_ignored_label_not_looked_up(self):
+        gh_issue = self._make_gh_issue()
+        fake_jira = unittest.mock.Mock()
+        for handler, action in ((sync_issue.handle_issue_labeled, "labeled"), (sync_issue.handle_issue_unlabeled, "unlabeled")):
+            handler(fake_jira, {"action": action, "issue": gh_issue, "label": {"name": "Status: Opened"}})
+        fake_jira.search_issues.assert_not_called()
+        fake_jira.create_issue.assert_not_called()
+
+
+class TestSideEffects(unittest.TestCase):
+    """
+    Independent JIRA and GitHub requests made by one handler run at the same time
+    """
+
+    def setUp(self):
+        os.environ['JIRA_PROJECT'] = 'TEST'
+        os.environ.pop('JIRA_COMPONENT', None)
+        self.gh_issue = {"html_url": "https://github.com/espressif/fake/issues/10",
+                         "number": 10,
+                         "title": "Issue with side effects",
+                         "body": "Body",
+                         "user": {"login": "testuser"},
+                         "labels": [],
+                         "state": "open",
+                         }
+        self.fake_jira = FakeJira()
+        self.fake_repo = FakeGitHubRepo(self.gh_issue)
+        patcher = unittest.mock.patch("sync_issue._get_repo", return_value=self.fake_repo)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_link_and_title_concurrent(self):
+        # each call waits for the other one, so this only finishes if they run at the same time
+        barrier = threading.Barrier(2, timeout=5)
+        add_remote_link = self.fake_jira.add_remote_link
+        edit = self.fake_repo.issue.edit.side_effect
+
+        def wait_then(call):
+            def wrapper(*args, **kwargs):
+                barrier.wait()
+                return call(*args, **kwargs)
+            return wrapper
+
+        with unittest.mock.patch.object(self.fake_jira, "add_remote_link", side_effect=wait_then(add_remote_link)):
+            self.fake_repo.issue.edit.side_effect = wait_then(edit)
+            sync_issue.handle_issue_opened(self.fake_jira, {"action": "opened", "issue": self.gh_issue})
+
+        self.assertEqual(1, len(self.fake_jira.issues[0].links))
+        self.assertEqual("Issue with side effects (TEST-1)", self.fake_repo.issue.title)
+
+    def test_closed_issue_link_resolved(self):
+        gh_issue = dict(self.gh_issue, state="closed")
+        with unittest.mock.patch.object(self.fake_jira, "add_remote_link", wraps=self.fake_jira.add_remote_link) as m_add_link:
+            sync_issue._create_jira_issue(self.fake_jira, gh_issue)
+
+        self.assertTrue(m_add_link.call_args[1]["destination"]["status"]["resolved"])
+
+    def test_error_raised_after_all_calls(self):
+        finished = []
+
+        def fail():
+            raise RuntimeError("failed")
+
+        def slow():
+            time.sleep(0.2)
+            finished.append(True)
+
+        with self.assertRaises(RuntimeError):
+            sync_issue._run_concurrently(fail, slow)
+        self.assertEqual([True], finished)
+
+
+class TestUnchangedEdits(unittest.TestCase):
+    """
+    GitHub issue edits which don't change the synced fields shouldn't write to JIRA
+    """
+
+    def setUp(self):
+        os.environ['JIRA_PROJECT'] = 'TEST'
+        os.environ.pop('JIRA_COMPONENT', None)
+        self.gh_issue = {"html_url": "https://github.com/espressif/fake/issues/13",
+                         "number": 13,
+                         "title": "Issue to edit",
+                         "body": "Body\n",
+                         "user": {"login": "testuser"},
+                         "labels": [],
+                         "state": "open",
+                         }
+        self.fake_jira = FakeJira()
+        self.fake_repo = FakeGitHubRepo(self.gh_issue)
+        patcher = unittest.mock.patch("sync_issue._get_repo", return_value=self.fake_repo)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        sync_issue.handle_issue_opened(self.fake_jira, {"action": "opened", "issue": self.gh_issue})
+        self.issue = self.fake_jira.issues[0]
+
+    def _edit(self, **changes):
+        gh_issue = dict(self.gh_issue, **changes)
+        sync_issue.handle_issue_edited(self.fake_jira, {"action": "edited", "issue": gh_issue, "sender": {"login": "edituser"}})
+
+    def test_unsynced_edit_skipped(self):
+        # for example, only the milestone changed
+        self._edit(milestone={"title": "v1.0"})
+
+        self.issue.update.assert_not_called()
+        self.issue.links[0].update.assert_not_called()
+        self.assertEqual([], self.issue.comments)
+
+    def test_line_endings_ignored(self):
+        self.issue.fields.description = self.issue.fields.description.replace("\n", "\r\n")
+
+        self._edit()
+
+        self.issue.update.assert_not_called()
+
+    def test_body_edit(self):
+        self._edit(body="New body")
+
+        self.issue.update.assert_called_once()
+        self.assertEqual(["description"], list(self.issue.update.call_args[1]["fields"]))
+        self.assertEqual(1, len(self.issue.comments))
+        self.issue.links[0].update.assert_not_called()
+
+    def test_title_edit(self):
+        self._edit(title="New title")
+
+        self.assertEqual(["summary"], list(self.issue.update.call_args[1]["fields"]))
+        self.assertEqual("New title", self.issue.links[0].update.call_args[0][0]["title"])
+
+
+class TestJiraIssueIndex(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['JIRA_PROJECT'] = 'TEST'
+        os.environ.pop('JIRA_COMPONENT', None)
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        patcher = unittest.mock.patch.dict(os.environ, {"JIRA_SYNC_CACHE_DIR": cache_dir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.gh_issue = {"html_url": "https://github.com/espressif/fake/issues/8",
+                         "number": 8,
+                         "title": "Indexed issue",
+                         "body": "Body",
+                         "user": {"login": "testuser"},
+                         "labels": [],
+                         "state": "open",
+                         }
+        self.fake_jira = FakeJira()
+        self.fake_repo = FakeGitHubRepo(self.gh_issue)
+
+    def _comment_event(self):
+        return {"action": "created",
+                "issue": self.gh_issue,
+                "comment": {"html_url": self.gh_issue["html_url"] + "#1", "id": 1, "user": {"login": "commentuser"}, "body": "A comment"},
+                }
+
+    def test_index_skips_jql_search(self):
+        with unittest.mock.patch("sync_issue._get_repo", return_value=self.fake_repo):
+            sync_issue.handle_issue_opened(self.fake_jira, {"action": "opened", "issue": self.gh_issue})
+            with unittest.mock.patch.object(self.fake_jira, "search_issues", wraps=self.fake_jira.search_issues) as m_search:
+                sync_issue.handle_comment_created(self.fake_jira, self._comment_event())
+
+        m_search.assert_not_called()
+        self.assertEqual(["A comment"], [c.body.split("\n\n")[1].strip() for c in self.fake_jira.issues[0].comments])
+
+    def test_index_filled_by_jql_search(self):
+        issue = self.fake_jira.create_issue({"summary": "GH #8: Indexed issue", "description": "", "labels": []})
+        self.fake_jira.add_remote_link(issue, {"url": self.gh_issue["html_url"], "title": ""}, self.gh_issue["html_url"], "synced from")
+
+        with unittest.mock.patch.object(self.fake_jira, "search_issues", wraps=self.fake_jira.search_issues) as m_search:
+            sync_issue.handle_comment_created(self.fake_jira, self._comment_event())
+            sync_issue.handle_comment_created(self.fake_jira, self._comment_event())
+
+        self.assertEqual(1, m_search.call_count)
+        self.assertEqual(2, len(issue.comments))
+
+    def test_stale_index_entry(self):
+        issue = self.fake_jira.create_issue({"summary": "GH #8: Indexed issue", "description": "", "labels": []})
+        self.fake_jira.add_remote_link(issue, {"url": self.gh_issue["html_url"], "title": ""}, self.gh_issue["html_url"], "synced from")
+        sync_issue._get_jira_issue_index().put(self.gh_issue["html_url"], "TEST-99")
+
+        sync_issue.handle_comment_created(self.fake_jira, self._comment_event())
+
+        self.assertEqual(1, len(issue.comments))
+        self.assertEqual(issue.key, sync_issue._get_jira_issue_index().get(self.gh_issue["html_url"]))
+
+
+class TestCommentEdits(unittest.TestCase):
+
+    def setUp(self):
+        self.gh_issue = {"html_url": "https://github.com/espressif/fake/issues/9",
+                         "number": 9,
+                         "title": "Issue with comments",
+                         "body": "Body",
+                         "user": {"login": "testuser"},
+                         "labels": [],
+                         "state": "open",
+                         }
+        self.fake_jira = FakeJira()
+        self.issue = self.fake_jira.create_issue({"summary": "GH #9: Issue with comments", "description": "", "labels": []})
+        sync_issue._JIRA_COMMENT_IDS.clear()
+        self.fake_jira.add_remote_link(self.issue, {"url": self.gh_issue["html_url"], "title": ""}, self.gh_issue["html_url"], "synced from")
+
+    def _comment_event(self, action, comment_id, body):
+        return {"action": action,
+                "issue": self.gh_issue,
+                "comment": {"html_url": self.gh_issue["html_url"] + "#issuecomment-%d" % comment_id,
+                            "id": comment_id,
+                            "user": {"login": "commentuser"},
+                            "body": body},
+                }
+
+    def test_edit_without_index(self):
+        # other comments, including one from before the conversion rules changed
+        sync_issue.handle_comment_created(self.fake_jira, self._comment_event("created", 1, "First"))
+        self.fake_jira.add_comment(self.issue.id, "[GitHub issue comment|%s#issuecomment-2] by @commentuser:\n\nOld format" %
+                                   self.gh_issue["html_url"])
+        sync_issue.handle_comment_created(self.fake_jira, self._comment_event("created", 3, "Third"))
+
+        sync_issue.handle_comment_edited(self.fake_jira, self._comment_event("edited", 2, "Second, edited"))
+
+        self.assertEqual(3, len(self.issue.comments))
+        self.assertIn("Second, edited", self.issue.comments[1].body)
+        self.assertIn("First", self.issue.comments[0].body)
+
+    def test_edit_without_cache_dir(self):
+        with unittest.mock.patch.dict(os.environ):
+            os.environ.pop("JIRA_SYNC_CACHE_DIR", None)
+            # comment synced by another run
+            self.fake_jira.add_comment(self.issue.id, "[GitHub issue comment|%s#issuecomment-1] by @commentuser:\n\nOld" %
+                                       self.gh_issue["html_url"])
+            with unittest.mock.patch.object(self.fake_jira, "comments", wraps=self.fake_jira.comments) as m_comments:
+                # the comments of the issue are scanned once, then looked up by ID
+                sync_issue.handle_comment_edited(self.fake_jira, self._comment_event("edited", 1, "First, edited"))
+                sync_issue.handle_comment_created(self.fake_jira, self._comment_event("created", 2, "Second"))
+                sync_issue.handle_comment_edited(self.fake_jira, self._comment_event("edited", 2, "Second, edited"))
+                sync_issue.handle_comment_edited(self.fake_jira, self._comment_event("edited", 1, "First, edited again"))
+                self.assertEqual(1, m_comments.call_count)
+
+                # a comment which another run deleted is found by scanning again
+                self.issue.comments.pop(0)
+                sync_issue.handle_comment_edited(self.fake_jira, self._comment_event("edited", 1, "First, edited once more"))
+                self.assertEqual(2, m_comments.call_count)
+
+        self.assertEqual(2, len(self.issue.comments))
+        self.assertIn("Second, edited", self.issue.comments[0].body)
+        self.assertIn("First, edited once more", self.issue.comments[1].body)
+
+    def test_edit_with_index(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with unittest.mock.patch.dict(os.environ, {"JIRA_SYNC_CACHE_DIR": cache_dir}):
+                # comment synced before the index existed
+                self.fake_jira.add_comment(self.issue.id, "[GitHub issue comment|%s#issuecomment-1] by @commentuser:\n\nOld" %
+                                           self.gh_issue["html_url"])
+                sync_issue.handle_comment_created(self.fake_jira, self._comment_event("created", 2, "Second"))
+
+                with unittest.mock.patch.object(self.fake_jira, "comments", wraps=self.fake_jira.comments) as m_comments:
+                    sync_issue.handle_comment_edited(self.fake_jira, self._comment_event("edited", 2, "Second, edited"))
+                    m_comments.assert_not_called()
+
+                    # the old comment is found by scanning once, then it's in the index
+                    sync_issue.handle_comment_edited(self.fake_jira, self._comment_event("edited", 1, "First, edited"))
+                    sync_issue.handle_comment_edited(self.fake_jira, self._comment_event("edited", 1, "First, edited again"))
+                    self.assertEqual(1, m_comments.call_count)
+
+        self.assertEqual(2, len(self.issue.comments))
+        self.assertIn("First, edited again", self.issue.comments[0].body)
+        self.assertIn("Second, edited", self.issue.comments[1].body)
+
+
+class TestCronSync(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['JIRA_PROJECT'] = 'TEST'
+        os.environ['GITHUB_TOKEN'] = MOCK_GITHUB_TOKEN
+        os.environ['GITHUB_REPOSITORY'] = 'espressif/fake'
+        os.environ.pop('JIRA_COMPONENT', None)
+        self.fake_jira = FakeJira()
+        self.now = datetime.datetime.utcnow()
+        patcher = unittest.mock.patch("sync_issue._COLLABORATORS", {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _make_pr(self, number, login="contributor", comments=0, age=0):
+        """ Return a PR as in a GraphQL response """
+        updated_at = self.now - datetime.timedelta(seconds=age)
+        return {"number": number, "title": "PR %d" % number, "body": "PR body", "state": "OPEN",
+                "url": "https://github.com/espressif/fake/pull/%d" % number,
+                "updatedAt": updated_at.strftime("%Y-%m-%dT%H:%M:%SZ"), "authorAssociation": "CONTRIBUTOR",
+                "author": {"__typename": "User", "login": login},
+                "labels": {"nodes": []}, "comments": {"totalCount": comments}}
+
+    def _fake_graphql(self, prs):
+        """ Return a fake sync_pr._graphql() which pages through the PRs, and the list of variables it was called with """
+        calls = []
+
+        def graphql(query, variables):
+            calls.append(dict(variables))
+            start = int(variables["after"] or 0)
+            end = start + variables["first"]
+            return {"repository": {"pullRequests": {
+                "nodes": prs[start:end],
+                "pageInfo": {"hasNextPage": end < len(prs), "endCursor": str(end)},
+            }}}
+        return graphql, calls
+
+    def _run(self, prs, env={}, github_class=None):
+        if github_class is None:
+            github_class = create_autospec(github.Github)
+            m_repo = github_class.return_value.get_repo.return_value
+            m_repo.url = "/repos/espressif/fake"
+            m_repo.get_collaborators.return_value = [unittest.mock.Mock(login="Collaborator")]
+        github_class.return_value.rate_limiting = (5000, 5000)
+        graphql, calls = self._fake_graphql(prs)
+        with unittest.mock.patch("sync_issue.Github", github_class), unittest.mock.patch("sync_issue._GITHUB_CLIENT", None), \
+                unittest.mock.patch("sync_pr._graphql", graphql), unittest.mock.patch("sync_pr.GRAPHQL_PAGE_SIZE", 5), \
+                unittest.mock.patch.dict(os.environ, env):
+            sync_pr.sync_remain_prs(self.fake_jira)
+        return github_class.return_value.get_repo.return_value, calls
+
+    def test_sync_remain_prs(self):
+        prs = [self._make_pr(n) for n in range(1, 11)]
+        prs.append(self._make_pr(11, login="collaborator"))
+        prs.append(self._make_pr(12, comments=2))
+
+        m_repo, graphql_calls = self._run(prs)
+
+        # PRs are fetched a page at a time, newest first
+        self.assertEqual([None, "5", "10"], [c["after"] for c in graphql_calls])
+        self.assertEqual({"CREATED_AT"}, set(c["orderBy"] for c in graphql_calls))
+        # collaborators are listed once, not checked for every PR author
+        m_repo.get_collaborators.assert_called_once_with()
+        m_repo.has_in_collaborators.assert_not_called()
+        self.assertEqual(["PR #%d: PR %d" % (n, n) for n in range(1, 11)], sorted(
+            (i.fields.summary for i in self.fake_jira.issues), key=lambda summary: int(summary.split()[1][1:-1])))
+
+        # running again creates nothing new
+        self._run(prs)
+        self.assertEqual(10, len(self.fake_jira.issues))
+
+    def test_collaborators_not_listable(self):
+        prs = [self._make_pr(1), self._make_pr(2, login="collaborator")]
+        github_class = create_autospec(github.Github)
+        m_repo = github_class.return_value.get_repo.return_value
+        m_repo.get_collaborators.side_effect = github.GithubException(403, {"message": "Must have push access"}, None)
+        m_repo.has_in_collaborators.side_effect = lambda login: login == "collaborator"
+        self._run(prs, github_class=github_class)
+
+        self.assertEqual(["PR #1: PR 1"], [i.fields.summary for i in self.fake_jira.issues])
+        self.assertEqual(2, m_repo.has_in_collaborators.call_count)
+
+    def test_pr_gh_issue(self):
+        pr = self._make_pr(7, comments=3)
+        pr["author"] = {"__typename": "Bot", "login": "dependabot"}
+        pr["labels"] = {"nodes": [{"name": "Type: Bug"}]}
+
+        gh_issue = sync_pr._get_pr_gh_issue(pr)
+
+        self.assertEqual({"pull_request": True,
+                          "labels": [{"name": "Type: Bug"}],
+                          "number": 7,
+                          "title": "PR 7",
+                          "html_url": "https://github.com/espressif/fake/pull/7",
+                          "user": {"login": "dependabot[bot]"},
+                          "author_association": "CONTRIBUTOR",
+                          "comments": 3,
+                          "updated_at": pr["updatedAt"],
+                          "state": "open",
+                          "body": "PR body"}, gh_issue)
+
+    def test_graphql_errors(self):
+        response = unittest.mock.Mock(status_code=200, headers={"X-RateLimit-Reset": "1000"})
+        response.json.return_value = {"errors": [{"type": "RATE_LIMITED", "message": "API rate limit exceeded"}]}
+        with unittest.mock.patch("sync_pr.get_session") as m_get_session:
+            m_get_session.return_value.post.return_value = response
+            with self.assertRaises(github.RateLimitExceededException) as cm:
+                sync_pr._graphql(sync_pr.OPEN_PRS_QUERY, {})
+        self.assertEqual("1000", cm.exception.headers["x-ratelimit-reset"])
+
+        response.json.return_value = {"errors": [{"type": "NOT_FOUND", "message": "Could not resolve to a Repository"}]}
+        with unittest.mock.patch("sync_pr.get_session") as m_get_session:
+            m_get_session.return_value.post.return_value = response
+            self.assertRaises(github.GithubException, sync_pr._graphql, sync_pr.OPEN_PRS_QUERY, {})
+
+    def test_jira_retry_after(self):
+        search_issues = self.fake_jira.search_issues
+        response = unittest.mock.Mock(headers={"Retry-After": "7"})
+        calls = []
+
+        def rate_limited_search(jql_str, **kwargs):
+            calls.append(jql_str)
+            if len(calls) == 1:
+                raise jira.JIRAError(status_code=429, response=response)
+            return search_issues(jql_str, **kwargs)
+
+        self.fake_jira.search_issues = rate_limited_search
+        with unittest.mock.patch("sync_pr.time.sleep") as m_sleep:
+            self._run([self._make_pr(1)])
+
+        self.assertEqual(1, len(self.fake_jira.issues))
+        self.assertAlmostEqual(7, m_sleep.call_args[0][0], delta=1)
+
+    def test_since_last_run(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            env = {"JIRA_SYNC_CACHE_DIR": cache_dir, "INPUT_CRON_SINCE_LAST_RUN": "true"}
+            self._run([self._make_pr(1, age=7200)], env)
+            self.assertEqual(1, len(self.fake_jira.issues))
+
+            # pretend the last run was an hour ago
+            with unittest.mock.patch.dict(os.environ, env):
+                state = sync_issue._get_json_file_cache("sync_remain_prs.json")
+            self.assertIsNotNone(state.get("last_run"))
+            state.put("last_run", (self.now - datetime.timedelta(seconds=3600)).strftime("%Y-%m-%dT%H:%M:%S"))
+
+            prs = [self._make_pr(3, age=60), self._make_pr(2, age=7200)] + [self._make_pr(n, age=7200) for n in range(4, 20)]
+            m_repo, graphql_calls = self._run(prs, env)
+
+        # only the first page of PRs is fetched, most recently updated first
+        self.assertEqual([{"owner": "espressif", "name": "fake", "first": 5, "after": None, "orderBy": "UPDATED_AT"}], graphql_calls)
+        # the collaborators listed by the first run are still cached
+        m_repo.get_collaborators.assert_not_called()
+        self.assertEqual(["PR #1: PR 1", "PR #3: PR 3"], sorted(i.fields.summary for i in self.fake_jira.issues))
+
+
+class TestEventQueue(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['JIRA_PROJECT'] = 'TEST'
+        os.environ.pop('JIRA_COMPONENT', None)
+        queue_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(queue_dir.cleanup)
+        self.queue_dir = queue_dir.name
+        self.fake_jira = FakeJira()
+        self.queued = 0
+
+    def _gh_issue(self, number, title="Issue", labels=(), state="open"):
+        return {"html_url": "https://github.com/espressif/fake/issues/%d" % number,
+                "number": number,
+                "title": title,
+                "body": "Body of %s" % title,
+                "user": {"login": "testuser"},
+                "labels": [{"name": name} for name in labels],
+                "state": state,
+                }
+
+    def _queue(self, event_name, action, gh_issue, **extra):
+        event = dict(extra, action=action, issue=gh_issue, sender={"login": "testuser"})
+        self.queued += 1
+        with open(os.path.join(self.queue_dir, "%04d.json" % self.queued), "w") as f:
+            json.dump({"event_name": event_name, "event": event}, f)
+
+    def _queue_comment(self, action, gh_issue, comment_id, body):
+        comment = {"id": comment_id, "html_url": "%s#issuecomment-%d" % (gh_issue["html_url"], comment_id),
+                   "user": {"login": "commentuser"}, "body": body}
+        self._queue("issue_comment", action, gh_issue, comment=comment)
+
+    def _synced_issue(self, gh_issue, labels=()):
+        issue = self.fake_jira.create_issue({"summary": sync_issue._get_summary(gh_issue), "description": "", "labels": list(labels)})
+        self.fake_jira.add_remote_link(issue, {"url": gh_issue["html_url"], "title": gh_issue["title"]}, gh_issue["html_url"], "synced from")
+        return issue
+
+    def _sync(self):
+        fake_repo = FakeGitHubRepo(self._gh_issue(1))
+        with unittest.mock.patch("sync_issue._get_repo", return_value=fake_repo):
+            coalesce.sync_event_queue(self.fake_jira, self.queue_dir)
+
+    def test_burst_on_new_issue(self):
+        self._queue("issues", "opened", self._gh_issue(1, "First title"))
+        self._queue("issues", "labeled", self._gh_issue(1, "First title", ["bug"]), label={"name": "bug"})
+        self._queue("issues", "edited", self._gh_issue(1, "Final title", ["bug"]))
+        self._queue_comment("created", self._gh_issue(1, "Final title", ["bug"]), 100, "First version")
+        self._queue_comment("edited", self._gh_issue(1, "Final title", ["bug"]), 100, "Final version")
+
+        self._sync()
+
+        # one create with the final title and labels, no further updates
+        self.assertEqual(1, len(self.fake_jira.issues))
+        issue = self.fake_jira.issues[0]
+        self.assertEqual("GH #1: Final title", issue.fields.summary)
+        self.assertEqual(["bug"], issue.fields.labels)
+        issue.update.assert_not_called()
+        self.assertEqual(1, len(issue.comments))
+        self.assertIn("Final version", issue.comments[0].body)
+        self.assertEqual([], os.listdir(self.queue_dir))
+
+    def test_burst_on_synced_issue(self):
+        issue = self._synced_issue(self._gh_issue(2), labels=["old", "keep"])
+        self._queue("issues", "labeled", self._gh_issue(2, labels=["a"]), label={"name": "a"})
+        self._queue("issues", "labeled", self._gh_issue(2, labels=["a", "b"]), label={"name": "b"})
+        self._queue("issues", "unlabeled", self._gh_issue(2, labels=["b"]), label={"name": "a"})
+        self._queue("issues", "unlabeled", self._gh_issue(2, labels=["b"]), label={"name": "old"})
+        self._queue("issues", "edited", self._gh_issue(2, "New title", labels=["b"]))
+        self._queue("issues", "edited", self._gh_issue(2, "Newer title", labels=["b"]))
+        self._queue("issues", "closed", self._gh_issue(2, "Newer title", labels=["b"], state="closed"))
+        self._queue("issues", "reopened", self._gh_issue(2, "Newer title", labels=["b"]))
+        self._queue_comment("created", self._gh_issue(2, "Newer title", labels=["b"]), 200, "Created and deleted")
+        self._queue_comment("deleted", self._gh_issue(2, "Newer title", labels=["b"]), 200, "Created and deleted")
+
+        with unittest.mock.patch.object(self.fake_jira, "search_issues", wraps=self.fake_jira.search_issues) as m_search:
+            self._sync()
+
+        # one lookup, one update, one comment about the edit
+        self.assertEqual(1, m_search.call_count)
+        issue.update.assert_called_once()
+        self.assertEqual(["keep", "b"], issue.fields.labels)
+        self.assertEqual("GH #2: Newer title", issue.fields.summary)
+        self.assertEqual(1, len(issue.comments))
+        self.assertIn("has been edited", issue.comments[0].body)
+        self.assertEqual([], os.listdir(self.queue_dir))
+
+    def test_closed_and_deleted(self):
+        closed = self._synced_issue(self._gh_issue(3))
+        deleted = self._synced_issue(self._gh_issue(4))
+        self._queue("issues", "closed", self._gh_issue(3, state="closed"))
+        self._queue("issues", "edited", self._gh_issue(4, "Edited"))
+        self._queue("issues", "deleted", self._gh_issue(4, "Edited"))
+        self._queue("issues", "assigned", self._gh_issue(3, state="closed"))
+
+        self._sync()
+
+        self.assertEqual(["closed"], [re.search(r"has been (\w+)", c.body).group(1) for c in closed.comments])
+        self.assertTrue(closed.links[0].update.call_args[0][0]["status"]["resolved"])
+        self.assertEqual(["deleted"], [re.search(r"has been (\w+)", c.body).group(1) for c in deleted.comments])
+        deleted.update.assert_not_called()
+        self.assertEqual([], os.listdir(self.queue_dir))
+
+    def test_failed_issue_kept(self):
+        self._synced_issue(self._gh_issue(5))
+        self._queue("issues", "opened", self._gh_issue(6))
+        self._queue_comment("created", self._gh_issue(5), 500, "Comment")
+
+        with unittest.mock.patch.object(self.fake_jira, "create_issue", side_effect=jira.JIRAError(status_code=500)):
+            self.assertRaises(jira.JIRAError, self._sync)
+
+        # the event for the issue which failed is kept, the other one was synced
+        self.assertEqual(["0001.json"], os.listdir(self.queue_dir))
+        self.assertEqual(1, len(self.fake_jira.issues[0].comments))
+
+
+class TestManualSync(unittest.TestCase):
+
+    def _make_api_gh_issue(self, number):
+        api_gh_issue = create_autospec(github.Issue.Issue)
+        api_gh_issue.number = number
+        api_gh_issue.title = "Issue %d" % number
+        api_gh_issue.raw_data = {"html_url": "https://github.com/espressif/fake/issues/%d" % number,
+                                 "number": number,
+                                 "title": "Issue %d" % number,
+                                 "body": "Body of issue %d" % number,
+                                 "user": {"login": "testuser"},
+                                 "labels": [{"name": "bug"}],
+                                 "state": "closed" if number == 3 else "open",
+                                 }
+        return api_gh_issue
+
+    def test_mirror_issues_bulk(self):
+        api_gh_issues = [self._make_api_gh_issue(n) for n in (5, 4, 3, 2, 1)]
+        event = {"inputs": {"action": "mirror-issues-bulk", "issue-numbers": "1, 2,3 x"}}
+
+        synced_issue = create_autospec(jira.Issue)(None, None)
+        synced_issue.key = "TEST-2"
+        synced_issue.fields = unittest.mock.Mock(summary="GH #2: Issue 2")
+
+        def create_issues(field_list, prefetch=True):
+            results = []
+            for n, fields in enumerate(field_list):
+                issue = create_autospec(jira.Issue)(None, None)
+                issue.key = "TEST-%d" % (10 + n)
+                results.append({"status": "Success", "issue": issue, "error": None, "input_fields": fields})
+            return results
+
+        def setup_jira(m_jira):
+            m_jira.search_issues.return_value = [synced_issue]
+            m_jira.create_issues.side_effect = create_issues
+
+        with unittest.mock.patch("sync_issue._get_repo") as m_get_repo, unittest.mock.patch("sync_issue._get_github") as m_get_github:
+            m_repo = m_get_repo.return_value
+            m_repo.get_issue.side_effect = lambda number: api_gh_issues[5 - number]
+            m_jira = run_sync_issue("workflow_dispatch", event, setup_jira=setup_jira)
+
+        # only the wanted issues are fetched, without changing the shared client
+        self.assertEqual([1, 2, 3], sorted(c[0][0] for c in m_repo.get_issue.call_args_list))
+        m_repo.get_issues.assert_not_called()
+        self.assertEqual([], m_get_github.mock_calls)
+
+        # one JQL query for all issues, one bulk create for the missing ones
+        self.assertEqual(1, m_jira.search_issues.call_count)
+        self.assertIn("issues/1", m_jira.search_issues.call_args[0][0])
+        self.assertIn("issues/3", m_jira.search_issues.call_args[0][0])
+        self.assertEqual(1, m_jira.create_issues.call_count)
+        field_list = m_jira.create_issues.call_args[0][0]
+        self.assertEqual(["GH #1: Issue 1", "GH #3: Issue 3"], [f["summary"] for f in field_list])
+        self.assertEqual({"key": "TEST"}, field_list[0]["project"])
+        self.assertEqual({"id": 5001}, field_list[1]["issuetype"])
+        m_jira.create_issue.assert_not_called()
+        m_jira.issue_types.assert_called_once()
+
+        # remote links and titles updated for the new issues only
+        self.assertEqual(2, m_jira.add_remote_link.call_count)
+        api_gh_issues[4].edit.assert_called_once()
+        api_gh_issues[2].edit.assert_called_once()
+        api_gh_issues[3].edit.assert_not_called()
+        self.assertEqual(3, m_repo.get_issue.call_count)
+
+    def test_mirror_missing_issue(self):
+        def get_issue(number):
+            if number == 9:
+                raise github.UnknownObjectException(404, {"message": "Not Found"}, None)
+            return self._make_api_gh_issue(number)
+
+        with unittest.mock.patch("sync_issue._get_repo") as m_get_repo:
+            m_get_repo.return_value.get_issue.side_effect = get_issue
+            api_gh_issues = sync_issue._get_github_issues([1, 9])
+
+        self.assertEqual([1], list(api_gh_issues))
+
+
+class TestJiraMetadata(unittest.TestCase):
+
+    def _make_jira(self):
+        m_jira = create_autospec(jira.JIRA)(None)
+        issue_type_bug = create_autospec(jira.resources.IssueType)
+        issue_type_bug.name = "Bug"
+        issue_type_bug.id = "5001"
+        m_jira.issue_types.return_value = [issue_type_bug]
+        component = create_autospec(jira.resources.Component)
+        component.name = "SOMECOMPONENT"
+        m_jira.project_components.return_value = [component]
+        return m_jira
+
+    def test_issue_type_fetched_once(self):
+        m_jira = self._make_jira()
+        gh_issue = {"labels": [{"name": "help wanted"}, {"name": "Type: Bug"}]}
+        self.assertEqual({"id": "5001"}, sync_issue._get_jira_issue_type(m_jira, gh_issue))
+        self.assertEqual({"id": "5001"}, sync_issue._get_jira_issue_type(m_jira, {"labels": [{"name": "bug"}]}))
+        self.assertIsNone(sync_issue._get_jira_issue_type(m_jira, {"labels": [{"name": "question"}]}))
+        self.assertEqual({"id": sync_issue.JIRA_NEW_FEATURE_TYPE_ID},
+                         sync_issue._get_jira_issue_type(m_jira, {"labels": [{"name": "Type: Feature Request"}]}))
+        m_jira.issue_types.assert_called_once()
+
+    def test_components_fetched_once(self):
+        m_jira = self._make_jira()
+        with unittest.mock.patch.dict(os.environ, {"JIRA_COMPONENT": "SOMECOMPONENT", "JIRA_PROJECT": "TEST"}):
+            for _ in range(3):
+                fields = {}
+                sync_issue._update_components_field(m_jira, fields, None)
+                self.assertEqual([{"name": "SOMECOMPONENT"}], fields["components"])
+        m_jira.project_components.assert_called_once_with("TEST")
+        m_jira.project.assert_not_called()
+
+    def test_refreshed_after_ttl(self):
+        # the webhook server keeps the same JIRA client for longer than the TTL
+        m_jira = self._make_jira()
+        with unittest.mock.patch.dict(os.environ, {"JIRA_METADATA_CACHE_TTL": "60"}):
+            sync_issue._get_jira_issue_type(m_jira, {"labels": [{"name": "bug"}]})
+            with unittest.mock.patch("sync_issue.time.time", return_value=time.time() + 30):
+                sync_issue._get_jira_issue_type(m_jira, {"labels": [{"name": "bug"}]})
+            self.assertEqual(1, m_jira.issue_types.call_count)
+            with unittest.mock.patch("sync_issue.time.time", return_value=time.time() + 90):
+                sync_issue._get_jira_issue_type(m_jira, {"labels": [{"name": "bug"}]})
+            self.assertEqual(2, m_jira.issue_types.call_count)
+
+    def test_file_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with unittest.mock.patch.dict(os.environ, {"JIRA_SYNC_CACHE_DIR": cache_dir}):
+                first_run = self._make_jira()
+                sync_issue._get_jira_issue_type(first_run, {"labels": [{"name": "bug"}]})
+                first_run.issue_types.assert_called_once()
+
+                second_run = self._make_jira()
+                self.assertEqual({"id": "5001"}, sync_issue._get_jira_issue_type(second_run, {"labels": [{"name": "bug"}]}))
+                second_run.issue_types.assert_not_called()
+
+                with unittest.mock.patch.dict(os.environ, {"JIRA_METADATA_CACHE_TTL": "-1"}):
+                    expired_run = self._make_jira()
+                    sync_issue._get_jira_issue_type(expired_run, {"labels": [{"name": "bug"}]})
+                    expired_run.issue_types.assert_called_once()
+
+
+class TestMarkdown2Wiki(unittest.TestCase):
+
+    def setUp(self):
+        patcher = unittest.mock.patch.dict(os.environ, {"MARKDOWN_CONVERTER": "markdown2wiki"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_golden_files(self):
+        """
+        Every <name>.md file in the corpus should convert to the contents of <name>.txt
+        """
+        md_files = sorted(f for f in os.listdir(MARKDOWN2WIKI_CORPUS) if f.endswith(".md"))
+        self.assertNotEqual([], md_files)
+        for md_file in md_files:
+            with self.subTest(md_file=md_file):
+                with open(os.path.join(MARKDOWN2WIKI_CORPUS, md_file), "r") as f:
+                    markdown = f.read()
+                with open(os.path.join(MARKDOWN2WIKI_CORPUS, md_file[:-3] + ".txt"), "r") as f:
+                    expected = f.read()
+                self.assertEqual(expected, markdown2wiki(markdown))
+
+    @unittest.skipUnless(shutil.which("markdown2confluence"), "markdown2confluence is not installed")
+    def test_golden_files_match_markdown2confluence(self):
+        """
+        The golden files should be the output of markdown2confluence itself (installed in the Docker image).
+
+        Set MARKDOWN2WIKI_REGENERATE=1 to rewrite them from its output, then fix markdown2wiki.py until test_golden_files passes.
+        """
+        regenerate = os.environ.get("MARKDOWN2WIKI_REGENERATE") == "1"
+        for md_file in sorted(f for f in os.listdir(MARKDOWN2WIKI_CORPUS) if f.endswith(".md")):
+            with self.subTest(md_file=md_file):
+                with open(os.path.join(MARKDOWN2WIKI_CORPUS, md_file), "r") as f:
+                    converted = sync_issue._markdown2confluence(f.read())
+                self.assertIsNotNone(converted)
+                txt_path = os.path.join(MARKDOWN2WIKI_CORPUS, md_file[:-3] + ".txt")
+                if regenerate:
+                    with open(txt_path, "w") as f:
+                        f.write(converted)
+                with open(txt_path, "r") as f:
+                    self.assertEqual(f.read(), converted)
+
+    def test_empty_body(self):
+        self.assertEqual("\n", sync_issue._markdown2wiki(None))
+        self.assertEqual("", sync_issue._markdown2wiki(""))
+
+    def test_conversion_cached(self):
+        sync_issue._MARKDOWN_CACHE.clear()
+        markdown = "A *long* issue body\n\n```\nlog output\n```\n"
+        with unittest.mock.patch("sync_issue.markdown2wiki", wraps=markdown2wiki) as m_convert:
+            first = sync_issue._markdown2wiki(markdown)
+            second = sync_issue._markdown2wiki(markdown)
+        self.assertEqual(first, second)
+        self.assertEqual(1, m_convert.call_count)
+
+    def test_conversion_cached_on_disk(self):
+        markdown = "Body seen by more than one workflow run\n"
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with unittest.mock.patch.dict(os.environ, {"JIRA_SYNC_CACHE_DIR": cache_dir}):
+                sync_issue._MARKDOWN_CACHE.clear()
+                expected = sync_issue._markdown2wiki(markdown)
+                sync_issue._MARKDOWN_CACHE.clear()  # as if this was a new run
+                with unittest.mock.patch("sync_issue.markdown2wiki") as m_convert:
+                    self.assertEqual(expected, sync_issue._markdown2wiki(markdown))
+                m_convert.assert_not_called()
+
+    def test_disk_cache_evicts_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            disk_cache = cache.DiskCache(cache_dir, max_entries=2)
+            disk_cache.put("a", "A")
+            disk_cache.put("b", "B")
+            os.utime(os.path.join(cache_dir, "a"), (1000, 1000))
+            os.utime(os.path.join(cache_dir, "b"), (2000, 2000))
+            self.assertEqual("A", disk_cache.get("a"))  # now the most recently used
+            disk_cache.put("c", "C")
+            self.assertEqual(["a", "c"], sorted(os.listdir(cache_dir)))
+            self.assertIsNone(disk_cache.get("b"))
+
+    def test_markdown2confluence_by_default(self):
+        sync_issue._MARKDOWN_CACHE.clear()
+        os.environ.pop("MARKDOWN_CONVERTER")
+        with unittest.mock.patch("sync_issue._markdown2confluence", return_value="h1. Converted\n") as m_convert, \
+                unittest.mock.patch("sync_issue.markdown2wiki") as m_markdown2wiki:
+            self.assertEqual("h1. Converted\n", sync_issue._markdown2wiki("# Converted\n"))
+        m_convert.assert_called_once_with("# Converted\n")
+        m_markdown2wiki.assert_not_called()
+
+    def test_unclosed_links_and_tags_linear(self):
+        # these took seconds each when every '[' or '<' rescanned the rest of the body
+        for markdown in ["[a](" * 8000, "![a](" * 6000, "<a " * 10000, "<a:/" * 8000, "[[a]" * 8000, "[a] [" * 6000, "[" * 32000]:
+            start = time.monotonic()
+            markdown2wiki(markdown)
+            self.assertLess(time.monotonic() - start, 2, markdown[:5])
+
+    def test_truncate_long_body(self):
+        result = sync_issue._markdown2wiki("a" * 20000)
+        self.assertEqual(16376 + len("\n\n[...]"), len(result))
+        self.assertTrue(result.endswith("\n\n[...]"))
+
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    """ Responds with the next status from the server's 'statuses' list (200 once the list is empty) """
+    protocol_version = "HTTP/1.1"
+
+    def _respond(self):
+        self.server.requests.append((self.command, self.client_address[1]))
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    do_GET = do_POST = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHttpSession(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+        self.server.requests = []
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d/" % self.server.server_address[1]
+        self.session = http_session.new_session()
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for _ in range(5):
+            self.assertEqual(200, self.session.get(self.url).status_code)
+        # all requests used the same connection
+        self.assertEqual(1, len(set(port for _, port in self.server.requests)))
+
+    def test_retry(self):
+        self.server.statuses = [503, 429]
+        with unittest.mock.patch("http_session.HTTP_RETRY_BACKOFF", 0):
+            self.assertEqual(200, http_session.new_session().get(self.url).status_code)
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_retries_exhausted(self):
+        self.server.statuses = [503] * 10
+        with unittest.mock.patch("http_session.HTTP_RETRY_BACKOFF", 0):
+            self.assertEqual(503, http_session.new_session().get(self.url).status_code)
+        self.assertEqual(http_session.HTTP_RETRIES + 1, len(self.server.requests))
+
+    def test_no_post_retry(self):
+        self.server.statuses = [503]
+        self.assertEqual(503, self.session.post(self.url, json={}).status_code)
+        self.assertEqual([("POST", self.server.requests[0][1])], self.server.requests)
+
+    def test_jira_retry(self):
+        # ResilientSession doesn't retry 502/503/504 responses, the mounted adapter does
+        with unittest.mock.patch("http_session.HTTP_RETRY_BACKOFF", 0):
+            jira = REAL_JIRA_CLASS(self.url, basic_auth=("user", "password"), get_server_info=False)
+            del self.server.requests[:]
+            self.server.statuses = [503, 502, 429]
+            self.assertEqual(200, jira._session.get(self.url).status_code)
+        self.assertEqual(4, len(self.server.requests))
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        tracing.reset()
+        self.addCleanup(tracing.reset)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def test_handler_summary(self):
+        timings_file = os.path.join(self.tmp_dir.name, "timings.json")
+        spans_file = os.path.join(self.tmp_dir.name, "spans.jsonl")
+        event = {"action": "opened",
+                 "issue": {"html_url": "https://github.com/espressif/fake/issues/14", "number": 14, "title": "Traced issue",
+                           "body": "Body", "user": {"login": "testuser"}, "labels": [], "state": "open"}}
+
+        with unittest.mock.patch.dict(os.environ, {"JIRA_SYNC_TIMINGS_FILE": timings_file, "JIRA_SYNC_SPANS_FILE": spans_file}):
+            run_sync_issue("issues", event)
+
+        with open(timings_file) as f:
+            summary = json.load(f)
+        self.assertEqual({"event": "issues", "action": "opened"}, summary["attributes"])
+        for name in ["main", "connect_jira", "handle_event", "handle_issue_opened", "_create_jira_issue", "_markdown2wiki",
+                     "_update_github_with_jira_key"]:
+            self.assertEqual(1, summary["spans"][name]["count"], name)
+        self.assertGreaterEqual(summary["spans"]["main"]["total_s"], summary["spans"]["handle_issue_opened"]["total_s"])
+
+        with open(spans_file) as f:
+            lines = f.readlines()
+        self.assertEqual(1, len(lines))
+        spans = json.loads(lines[0])["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        by_name = dict((s["name"], s) for s in spans)
+        self.assertNotIn("parentSpanId", by_name["main"])
+        self.assertEqual(by_name["handle_event"]["spanId"], by_name["handle_issue_opened"]["parentSpanId"])
+        self.assertEqual(1, len(set(s["traceId"] for s in spans)))
+
+    def test_request_counts(self):
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+        server.requests = []
+        server.statuses = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:%d/" % server.server_address[1]
+        session = http_session.new_session()
+        self.addCleanup(session.close)
+
+        with tracing.span("outer"):
+            session.get(url)
+            with tracing.span("inner"):
+                session.get(url)
+            # requests made by side effects in other threads count for the span which started them
+            sync_issue._run_concurrently(lambda: session.get(url), lambda: session.get(url))
+        with self.assertRaises(ValueError), tracing.span("failed"):
+            raise ValueError("failed")
+
+        summary = tracing.get_summary()
+        self.assertEqual({"127.0.0.1": 4}, summary["spans"]["outer"]["requests"])
+        self.assertEqual({"127.0.0.1": 1}, summary["spans"]["inner"]["requests"])
+        self.assertEqual(1, summary["spans"]["failed"]["errors"])
+        self.assertEqual({"127.0.0.1": 4}, summary["requests"])
+
+
+class TestFakeApiServers(unittest.TestCase):
+    """
+    Runs main() against the fake JIRA and GitHub servers used by the replay benchmark
+    """
+
+    def setUp(self):
+        self.jira_server = FakeJiraServer().start()
+        self.addCleanup(self.jira_server.stop)
+        self.github_server = FakeGitHubServer("espressif/benchmark").start()
+        self.addCleanup(self.github_server.stop)
+        env = {"JIRA_URL": self.jira_server.url, "JIRA_USER": "test_user", "JIRA_PASS": "test_pass", "JIRA_PROJECT": FakeJiraServer.PROJECT,
+               "GITHUB_TOKEN": MOCK_GITHUB_TOKEN, "GITHUB_REPOSITORY": "espressif/benchmark", "GITHUB_API_URL": self.github_server.url}
+        for patcher in [unittest.mock.patch.dict(os.environ, env),
+                        unittest.mock.patch("sync_to_jira._JIRA", REAL_JIRA_CLASS),
+                        unittest.mock.patch("sync_issue.Github", REAL_GITHUB_CLASS),
+                        unittest.mock.patch("sync_issue._GITHUB_CLIENT", None)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for variable in ["JIRA_COMPONENT", "JIRA_SYNC_CACHE_DIR"]:
+            os.environ.pop(variable, None)
+
+    def _replay(self, scenario_name):
+        with open(os.path.join(BENCHMARK_EVENTS, scenario_name + ".json")) as f:
+            scenario = json.load(f)
+        for queued in scenario["events"]:
+            self.github_server.add_issue(queued["event"].get("issue") or queued["event"]["pull_request"])
+            with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as event_file:
+                json.dump(queued["event"], event_file)
+            self.addCleanup(os.unlink, event_file.name)
+            with unittest.mock.patch.dict(os.environ, {"GITHUB_EVENT_NAME": queued["event_name"], "GITHUB_EVENT_PATH": event_file.name}):
+                sync_to_jira.main()
+
+    def test_comment_burst(self):
+        self._replay("comment_burst")
+
+        self.assertEqual(["TEST-1"], list(self.jira_server.issues))
+        issue = self.jira_server.issues["TEST-1"]
+        self.assertEqual("GH #1: Wi-Fi crashes after restart", issue["fields"]["summary"])
+        self.assertEqual(["https://github.com/espressif/benchmark/issues/1"], [link["globalId"] for link in issue["links"]])
+        self.assertTrue(issue["links"][0]["object"]["status"]["resolved"])
+        self.assertEqual(7, len(issue["comments"]))
+        self.assertIn("Fixed by updating the driver", issue["comments"][1]["body"])
+        self.assertEqual("Wi-Fi crashes after restart (TEST-1)", self.github_server.issues[1]["title"])
+        self.assertEqual([], self.github_server.issues[1]["labels"])
+        # every request was to an endpoint which the fake servers implement
+        self.assertEqual([], [r for r in list(self.jira_server.requests) + list(self.github_server.requests) if "not found" in r])
+
+
+class TestWebhookServer(unittest.TestCase):
+    SECRET = "webhooksecret"
+
+    def _start(self, handle_event, workers=4, queue_size=100):
+        server = webhook_server.WebhookServer(("127.0.0.1", 0), None, self.SECRET, workers, queue_size, handle_event)
+        threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = "http://127.0.0.1:%d/" % server.server_address[1]
+        self.session = http_session.new_session()
+        self.addCleanup(self.session.close)
+        return server
+
+    def _post(self, event_name, event, secret=SECRET):
+        body = json.dumps(event).encode()
+        signature = "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        return self.session.post(self.url, data=body, headers={"X-GitHub-Event": event_name, "X-Hub-Signature-256": signature}).status_code
+
+    def _issue_event(self, number, action):
+        return {"action": action,
+                "issue": {"html_url": "https://github.com/espressif/fake/issues/%d" % number, "number": number},
+                "repository": {"full_name": "espressif/fake"}}
+
+    def test_order_per_issue(self):
+        handled = []
+
+        def handle_event(jira, event_name, event):
+            time.sleep(0.001 * (event["issue"]["number"] % 3))
+            handled.append((event["issue"]["number"], event["action"]))
+
+        server = self._start(handle_event)
+        actions = ["opened", "labeled", "edited", "closed"]
+        for action in actions:
+            for number in range(1, 9):
+                self.assertEqual(202, self._post("issues", self._issue_event(number, action)))
+        server.join()
+
+        for number in range(1, 9):
+            self.assertEqual(actions, [action for n, action in handled if n == number])
+
+    def test_bad_signature(self):
+        handle_event = unittest.mock.Mock()
+        server = self._start(handle_event)
+
+        self.assertEqual(401, self._post("issues", self._issue_event(1, "opened"), secret="wrong"))
+        self.assertEqual(200, self._post("ping", {"zen": "Keep it logically awesome."}))
+        server.join()
+
+        handle_event.assert_not_called()
+
+    def test_body_too_large(self):
+        handle_event = unittest.mock.Mock()
+        server = self._start(handle_event)
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+        self.addCleanup(conn.close)
+        conn.putrequest("POST", "/")
+        conn.putheader("Content-Length", str(webhook_server.MAX_BODY_SIZE + 1))
+        conn.endheaders()  # the body is never sent, the server must not wait for it
+
+        self.assertEqual(413, conn.getresponse().status)
+        handle_event.assert_not_called()
+
+    def test_other_owner(self):
+        handle_event = unittest.mock.Mock()
+        server = self._start(handle_event)
+        event = self._issue_event(1, "opened")
+        event["repository"]["full_name"] = "someone/fake"
+
+        self.assertEqual(202, self._post("issues", event))
+        server.join()
+
+        handle_event.assert_not_called()
+
+    def test_queue_full(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def handle_event(jira, event_name, event):
+            started.set()
+            release.wait()
+
+        server = self._start(handle_event, workers=1, queue_size=1)
+
+        statuses = [self._post("issues", self._issue_event(1, "opened"))]
+        started.wait()
+        statuses += [self._post("issues", self._issue_event(1, "edited")) for _ in range(3)]
+        release.set()
+        server.join()
+
+        # one event being handled, one queued, the rest refused
+        self.assertEqual([202, 202, 503, 503], statuses)
+
+    def test_repository_per_event(self):
+        repos = []
+
+        def handle_event(jira, event_name, event):
+            repos.append(sync_issue._get_repo())
+
+        github_class = create_autospec(github.Github)
+        github_class.return_value.get_repo.side_effect = lambda name, lazy: name
+        with unittest.mock.patch("sync_issue.Github", github_class), unittest.mock.patch("sync_issue._GITHUB_CLIENT", None), \
+                unittest.mock.patch.dict(os.environ, {"GITHUB_TOKEN": MOCK_GITHUB_TOKEN}):
+            server = self._start(handle_event)
+            for name in ("espressif/one", "espressif/two"):
+                event = self._issue_event(1, "opened")
+                event["repository"]["full_name"] = name
+                self._post("issues", event)
+            server.join()
+
+        self.assertEqual(["espressif/one", "espressif/two"], repos)
+        github_class.assert_called_once()
+
+    def test_repository_in_side_effects(self):
+        # the GitHub title is edited in the side effect thread pool, which must use the repository of the event
+        gh_issue = {"html_url": "https://github.com/espressif/two/issues/3", "number": 3, "title": "Issue in another repo",
+                    "body": "Body", "user": {"login": "testuser"}, "labels": [], "state": "open"}
+        repos = {name: FakeGitHubRepo(gh_issue) for name in ("espressif/one", "espressif/two")}
+        github_class = create_autospec(github.Github)
+        github_class.return_value.get_repo.side_effect = lambda name, lazy: repos[name]
+        fake_jira = FakeJira()
+        with unittest.mock.patch("sync_issue.Github", github_class), unittest.mock.patch("sync_issue._GITHUB_CLIENT", None), \
+                unittest.mock.patch.dict(os.environ, {"GITHUB_TOKEN": MOCK_GITHUB_TOKEN, "JIRA_PROJECT": "TEST"}):
+            os.environ.pop("GITHUB_REPOSITORY", None)
+            os.environ.pop("JIRA_COMPONENT", None)
+            server = self._start(sync_to_jira.handle_event)
+            server.jira = fake_jira
+            self.assertEqual(202, self._post("issues", {"action": "opened", "issue": gh_issue, "repository": {"full_name": "espressif/two"}}))
+            server.join()
+
+        self.assertEqual(1, len(fake_jira.issues))
+        self.assertEqual("Issue in another repo (TEST-1)", repos["espressif/two"].issue.title)
+        repos["espressif/one"].issue.edit.assert_not_called()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+#
+# Copyright 2019 Espressif Systems (Shanghai) PTE LTD
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Timing of the steps of a sync run.
+
+Functions decorated with @traced (and blocks in 'with span(name)') record how long they take and how
+many HTTP requests they make to each host, including the time and requests of the spans inside them.
+At the end of a run write_results() prints a summary, and writes it as JSON to the file named by
+JIRA_SYNC_TIMINGS_FILE. If JIRA_SYNC_SPANS_FILE is set, each span is also appended to that file in
+the OpenTelemetry OTLP/JSON format (one export request per line, as written by the OpenTelemetry
+Collector's file exporter).
+"""
+from collections import OrderedDict
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+import requests
+
+SERVICE_NAME = 'sync-issues-to-jira'
+
+# Spans open in the current thread (or copied into a thread pool task), innermost last
+_OPEN_SPANS = contextvars.ContextVar('open_spans', default=())
+_LOCK = threading.Lock()
+# Span name to {"count", "total_s", "max_s", "errors", "requests": {host: count}}
+_SUMMARY = OrderedDict()
+# Host to number of requests, including requests made outside any span
+_REQUESTS = OrderedDict()
+# Key/value pairs describing the run, for example the event name
+_ATTRIBUTES = OrderedDict()
+# Finished spans not yet written to JIRA_SYNC_SPANS_FILE
+_FINISHED = []
+_SEND = None
+
+
+class _Span(object):
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.requests = {}
+        self.error = None
+        self.start_ns = time.time_ns()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.end_ns = None
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+        self.end_ns = self.start_ns + int(self.duration * 1e9)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Record the time taken by the 'with' block as a span called 'name'
+    """
+    _instrument_requests()
+    parents = _OPEN_SPANS.get()
+    current = _Span(name, parents[-1] if parents else None, attributes)
+    token = _OPEN_SPANS.set(parents + (current,))
+    try:
+        yield current
+    except BaseException as e:
+        current.error = '%s: %s' % (type(e).__name__, e)
+        raise
+    finally:
+        _OPEN_SPANS.reset(token)
+        current.finish()
+        _record(current)
+
+
+def traced(func):
+    """
+    Decorator which records each call of the function as a span with the function's name
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def annotate(**attributes):
+    """
+    Add attributes describing the run (for example the event being synced) to the summary
+    """
+    with _LOCK:
+        _ATTRIBUTES.update(attributes)
+
+
+def _record(finished):
+    with _LOCK:
+        summary = _SUMMARY.setdefault(finished.name, {'count': 0, 'total_s': 0.0, 'max_s': 0.0, 'errors': 0, 'requests': {}})
+        summary['count'] += 1
+        summary['total_s'] += finished.duration
+        summary['max_s'] = max(summary['max_s'], finished.duration)
+        summary['errors'] += finished.error is not None
+        for host, count in finished.requests.items():
+            summary['requests'][host] = summary['requests'].get(host, 0) + count
+        if os.environ.get('JIRA_SYNC_SPANS_FILE'):
+            _FINISHED.append(finished)
+
+
+def _count_request(url):
+    host = urllib.parse.urlsplit(url).hostname or url
+    with _LOCK:
+        _REQUESTS[host] = _REQUESTS.get(host, 0) + 1
+        for open_span in _OPEN_SPANS.get():
+            open_span.requests[host] = open_span.requests.get(host, 0) + 1
+
+
+def _instrument_requests():
+    """
+    Count the requests made by all requests Sessions (which the JIRA and GitHub clients use)
+    """
+    global _SEND
+    with _LOCK:
+        if _SEND is not None:
+            return
+        _SEND = requests.Session.send
+
+    def send(session, request, **kwargs):
+        _count_request(request.url)
+        return _SEND(session, request, **kwargs)
+    requests.Session.send = send
+
+
+def get_summary():
+    """
+    Return the summary of all spans recorded so far, as a JSON-serializable dict
+    """
+    with _LOCK:
+        spans = OrderedDict()
+        for name, summary in _SUMMARY.items():
+            spans[name] = dict(summary, total_s=round(summary['total_s'], 6), max_s=round(summary['max_s'], 6),
+                               requests=dict(summary['requests']))
+        return {'attributes': dict(_ATTRIBUTES), 'spans': spans, 'requests': dict(_REQUESTS)}
+
+
+def write_results():
+    """
+    Print the summary of the run and write it (and the spans) to the files set in the environment
+    """
+    summary = get_summary()
+    for name, item in summary['spans'].items():
+        print('%s: %d calls, %.3fs total, %.3fs max, requests %s'
+              % (name, item['count'], item['total_s'], item['max_s'], json.dumps(item['requests'], sort_keys=True)))
+    path = os.environ.get('JIRA_SYNC_TIMINGS_FILE')
+    if path:
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=4)
+    flush_spans()
+
+
+def flush_spans():
+    """
+    Append the spans finished since the last call to JIRA_SYNC_SPANS_FILE, if it is set
+    """
+    path = os.environ.get('JIRA_SYNC_SPANS_FILE')
+    with _LOCK:
+        finished = list(_FINISHED)
+        del _FINISHED[:]
+    if not path or not finished:
+        return
+    with open(path, 'a') as f:
+        f.write(json.dumps(_otlp_request(finished)) + '\n')
+
+
+def reset():
+    """
+    Forget all recorded spans and requests
+    """
+    with _LOCK:
+        _SUMMARY.clear()
+        _REQUESTS.clear()
+        _ATTRIBUTES.clear()
+        del _FINISHED[:]
+
+
+def _otlp_request(finished):
+    spans = []
+    for s in finished:
+        attributes = dict(s.attributes)
+        attributes.update(('http.requests.%s' % host, count) for host, count in s.requests.items())
+        otlp_span = {
+            'traceId': s.trace_id,
+            'spanId': s.span_id,
+            'name': s.name,
+            'kind': 1,  # SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(s.start_ns),
+            'endTimeUnixNano': str(s.end_ns),
+            'attributes': [_otlp_attribute(key, value) for key, value in attributes.items()],
+            'status': {'code': 2, 'message': s.error} if s.error else {'code': 1},
+        }
+        if s.parent_id:
+            otlp_span['parentSpanId'] = s.parent_id
+        spans.append(otlp_span)
+    return {'resourceSpans': [{
+        'resource': {'attributes': [_otlp_attribute('service.name', SERVICE_NAME)]},
+        'scopeSpans': [{'scope': {'name': 'tracing'}, 'spans': spans}],
+    }]}
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+#
+# Copyright 2019 Espressif Systems (Shanghai) PTE LTD
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Long-running server which syncs GitHub webhook events to JIRA, as an alternative to running the action for each event.
+
+The JIRA and GitHub clients are created once and shared by all events. Events are handled by
+WEBHOOK_WORKERS threads. All events for one GitHub issue go to the same worker, so they are synced
+in the order they were received.
+"""
+import hashlib
+import hmac
+import http.server
+import json
+import os
+import queue
+import threading
+import traceback
+
+import sync_issue
+import sync_to_jira
+import tracing
+
+# Number of events synced at the same time
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 8))
+# Number of events waiting for each worker, before new events are refused
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 100))
+# Largest webhook body accepted, GitHub doesn't send payloads larger than 25 MB
+MAX_BODY_SIZE = 25 * 1024 * 1024
+
+
+class WebhookServer(http.server.ThreadingHTTPServer):
+    """
+    Receives webhook POSTs, checks their X-Hub-Signature-256 header against the webhook secret, and queues
+    them for the worker threads.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, jira, secret, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE, handle_event=None):
+        super().__init__(address, _WebhookHandler)
+        self.jira = jira
+        self.secret = secret.encode()
+        self.handle_event = handle_event or sync_to_jira.handle_event
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.workers = [threading.Thread(target=self._work, args=(q,), daemon=True) for q in self.queues]
+        for worker in self.workers:
+            worker.start()
+
+    def check_signature(self, body, signature):
+        expected = 'sha256=' + hmac.new(self.secret, body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature or '')
+
+    def enqueue(self, event_name, event):
+        """
+        Queue an event for its worker. Returns False if the worker's queue is full.
+        """
+        try:
+            self.queues[_worker_index(event, len(self.queues))].put_nowait((event_name, event))
+            return True
+        except queue.Full:
+            return False
+
+    def join(self):
+        """
+        Wait until all queued events have been handled
+        """
+        for q in self.queues:
+            q.join()
+
+    def _work(self, events):
+        while True:
+            event_name, event = events.get()
+            try:
+                repo_name = event.get("repository", {}).get("full_name")
+                if repo_name and not repo_name.startswith('espressif/'):
+                    print('Not an Espressif repo, nothing to sync to JIRA')
+                    continue
+                sync_issue._use_repository(repo_name)
+                self.handle_event(self.jira, event_name, event)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                tracing.flush_spans()
+                events.task_done()
+
+
+def _worker_index(event, workers):
+    """
+    Return the worker for an event, which is the same for all events of one GitHub issue
+    """
+    issue = event.get("issue") or event.get("pull_request") or {}
+    key = issue.get("html_url") or json.dumps(event, sort_keys=True)
+    return int(hashlib.sha1(key.encode()).hexdigest(), 16) % workers
+
+
+class _WebhookHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0 or length > MAX_BODY_SIZE:
+            self.close_connection = True  # the body isn't read
+            self._respond(413 if length > MAX_BODY_SIZE else 400, 'Bad Content-Length')
+            return
+        body = self.rfile.read(length)
+        if not self.server.check_signature(body, self.headers.get('X-Hub-Signature-256')):
+            self._respond(401, 'Bad signature')
+            return
+        try:
+            event = json.loads(body)
+        except ValueError:
+            self._respond(400, 'Bad JSON')
+            return
+
+        event_name = self.headers.get('X-GitHub-Event')
+        if event_name == 'ping':
+            self._respond(200, 'pong')
+        elif self.server.enqueue(event_name, event):
+            self._respond(202, 'Queued')
+        else:
+            self._respond(503, 'Queue is full')
+
+    def do_GET(self):
+        self._respond(200, 'OK')  # health check
+
+    def _respond(self, status, message):
+        body = message.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        headers = getattr(self, 'headers', None)  # not set if the request couldn't be parsed
+        print('%s %s' % (headers.get('X-GitHub-Delivery', '-') if headers else '-', format % args))
+
+
+def main():
+    print('Connecting to Jira Server...')
+    jira = sync_to_jira.connect_jira()
+    port = int(os.environ.get('WEBHOOK_PORT', 8080))
+    sync_issue._LIST_COLLABORATORS = True  # the list is reused for every PR event
+    server = WebhookServer(('', port), jira, os.environ['GITHUB_WEBHOOK_SECRET'])
+    print('Listening for webhooks on port %d' % port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()